@@ -64,7 +64,7 @@ class Expert(_RoomBot):
         _RoomBot.__init__(self, *args, **keys)
         self._augments = taskfarm.TaskFarm(self._handle_augment)
 
-    def _handle_augment(self, src_room, dst_room, args):
+    def _handle_augment(self, src_room, dst_room, args, stanza_options):
         return idiokit.pipe(
             self.from_room(src_room),
             events.stanzas_to_events(),
@@ -72,20 +72,34 @@ class Expert(_RoomBot):
             _create_eids(),
             self.augment(*args),
             _embed_eids(),
-            events.events_to_elements(),
+            events.events_to_elements(*stanza_options),
             self.to_room(dst_room)
         )
 
     @idiokit.stream
-    def session(self, state, src_room, dst_room=None, **keys):
+    def session(self, state, src_room, dst_room=None,
+                stanza_batch_size=1, stanza_batch_bytes=None,
+                stanza_batch_interval=1.0, stanza_body=None,
+                stanza_format=events.FORMAT_LEGACY, **keys):
         if dst_room is None:
             dst_room = src_room
 
+        if stanza_body is None:
+            stanza_body = events.default_body(src_room, dst_room)
+
+        stanza_options = (
+            stanza_batch_size,
+            stanza_batch_bytes,
+            stanza_batch_interval,
+            stanza_body,
+            stanza_format
+        )
+
         augments = list()
         for args in self.augment_keys(src_room=src_room,
                                       dst_room=dst_room,
                                       **keys):
-            augments.append(self._augments.inc(src_room, dst_room, args))
+            augments.append(self._augments.inc(src_room, dst_room, args, stanza_options))
         yield idiokit.pipe(*augments)
 
     def augment_keys(self, *args, **keys):
@@ -23,6 +23,7 @@ class Combiner(_RoomBot):
     def collect(self, ids, queue, time_window):
         while True:
             event = yield idiokit.next()
+            event = events.FrozenEvent(event)
 
             eid = events.hexdigest(event, sha1)
             unique, event_set, augment_set = self._add(ids, queue, time_window, eid)
@@ -45,13 +45,14 @@ class WindowBot(RoomBot):
     def process(self, ids, queue, window_time):
         while True:
             event = yield idiokit.next()
+            event = events.FrozenEvent(event)
 
             current_time = time.time()
             expire_time = current_time + window_time
 
             eid = events.hexdigest(event)
-            count, items = ids.get(eid, (0, event.items()))
-            ids[eid] = count + 1, items
+            count, frozen = ids.get(eid, (0, event))
+            ids[eid] = count + 1, frozen
 
             if count == 0:
                 yield idiokit.send(event.union({
@@ -69,11 +70,11 @@ class WindowBot(RoomBot):
             while queue and queue[0][0] <= current_time:
                 expire_time, eid = queue.popleft()
 
-                count, items = ids.pop(eid)
+                count, frozen = ids.pop(eid)
                 if count > 1:
-                    ids[eid] = count - 1, items
+                    ids[eid] = count - 1, frozen
                 else:
-                    yield idiokit.send(events.Event(items).union({
+                    yield idiokit.send(frozen.union({
                         "id:close": eid
                     }))
 
@@ -20,7 +20,7 @@ from idiokit.xmpp.core import XMPPError
 from idiokit.socket import SocketError
 from idiokit.dns import DNSTimeout, DNSError
 
-from . import log, events, taskfarm, utils, services
+from . import log, events, taskfarm, utils, services, parsecache
 from .. import __version__
 
 
@@ -374,6 +374,10 @@ class _Service(services.Service):
         services.Service.__init__(self, *args, **keys)
         self.bot = bot
 
+    @property
+    def partition(self):
+        return self.bot.service_partition
+
     def main(self, *args, **keys):
         return self.bot.main(*args, **keys)
 
@@ -390,6 +394,10 @@ class ServiceBot(XMPPBot):
         """)
     service_mock_session = ListParam(default=None)
 
+    # Several bots offering the same service divide the sessions between
+    # them by this session configuration key (see services.Service).
+    service_partition = None
+
     @idiokit.stream
     def _run(self):
         self.log.info("Starting service {0!r} version {1}".format(self.bot_name, __version__))
@@ -444,6 +452,16 @@ class ServiceBot(XMPPBot):
         return idiokit.consume()
 
 
+def _parse_source_time(value):
+    try:
+        return time.strptime(value, "%Y-%m-%d %H:%M:%SZ")
+    except ValueError:
+        return None
+
+
+_source_times = parsecache.cache("source time", _parse_source_time)
+
+
 class FeedBot(ServiceBot):
     xmpp_rate_limit = FloatParam("""
         how many XMPP stanzas the bot can send per second
@@ -452,10 +470,33 @@ class FeedBot(ServiceBot):
     drop_older_than = IntParam("""
         drop events with source time older that given number of seconds
         """, default=None)
+    xmpp_batch_size = IntParam("""
+        pack up to the given number of events into one XMPP stanza
+        (default: %default)
+        """, default=1)
+    xmpp_batch_bytes = IntParam("""
+        send a batch when its estimated size reaches the given number
+        of bytes (default: no size limit)
+        """, default=None)
+    xmpp_batch_interval = FloatParam("""
+        wait at most the given amount of seconds for a batch to fill up
+        (default: %default seconds)
+        """, default=1.0)
+    xmpp_body = Param("""
+        the body of sent XMPP stanzas: "full", "none" or the number of
+        key-value pairs shown in a truncated body (default: %default)
+        """, default="full")
+    xmpp_event_format = Param("""
+        the encoding of events in sent XMPP stanzas: "legacy" is
+        understood by all receivers, "compact" is smaller and faster
+        but needs up-to-date receivers (default: %default)
+        """, default="legacy")
 
     def __init__(self, *args, **keys):
         ServiceBot.__init__(self, *args, **keys)
 
+        self._element_options = events.element_options(self.xmpp_body, self.xmpp_event_format)
+
         self._feeds = taskfarm.TaskFarm(self.feed)
         self._rooms = taskfarm.TaskFarm(self.manage_room)
         self._connections = taskfarm.TaskFarm(self.manage_connection, grace_period=0.0)
@@ -476,11 +517,7 @@ class FeedBot(ServiceBot):
             event = yield idiokit.next()
 
             latest = None
-            for value in event.values("source time"):
-                try:
-                    source_time = time.strptime(value, "%Y-%m-%d %H:%M:%SZ")
-                except ValueError:
-                    continue
+            for source_time in event.values("source time", parser=_source_times):
                 latest = max(latest, source_time)
 
             cutoff = time.gmtime(time.time() - self.drop_older_than)
@@ -533,11 +570,16 @@ class FeedBot(ServiceBot):
                 if self.drop_older_than is not None:
                     head = self._cutoff() | head
 
-                tail = self._stats(name) | room | idiokit.consume()
+                tail = room | idiokit.consume()
                 if self.xmpp_rate_limit is not None:
                     tail = self._output_rate_limiter() | tail
 
-                yield head | events.events_to_elements() | tail
+                to_elements = events.events_to_elements(
+                    self.xmpp_batch_size,
+                    self.xmpp_batch_bytes,
+                    self.xmpp_batch_interval,
+                    options=self._element_options)
+                yield head | self._stats(name) | to_elements | tail
             finally:
                 log.close("Left " + msg, attrs, status="left")
 
@@ -4,7 +4,7 @@ import socket
 import idiokit
 from idiokit import dns
 
-from . import utils, transformation
+from . import utils, transformation, parsecache
 
 
 def _parse_ip(string, families=(socket.AF_INET, socket.AF_INET6)):
@@ -16,6 +16,9 @@ def _parse_ip(string, families=(socket.AF_INET, socket.AF_INET6)):
     return None
 
 
+_ip_addresses = parsecache.cache("ip address", _parse_ip)
+
+
 def _nibbles(ipv6, _hex="0123456789abcdef"):
     result = []
     for ch in socket.inet_pton(socket.AF_INET6, ipv6):
@@ -140,7 +143,7 @@ class CymruWhois(object):
 
     def _ip_values(self, event, keys):
         for key in keys:
-            for value in event.values(key, parser=_parse_ip):
+            for value in event.values(key, parser=_ip_addresses):
                 yield value
 
     @idiokit.stream
@@ -148,7 +151,7 @@ class CymruWhois(object):
         while True:
             event = yield idiokit.next()
             if not ip_keys:
-                values = event.values(parser=_parse_ip)
+                values = event.values(parser=_ip_addresses)
             else:
                 values = self._ip_values(event, ip_keys)
 
@@ -1,14 +1,18 @@
 import re
 import hashlib
 import inspect
+import logging
 import collections
 
-from base64 import b64decode
+from base64 import b64decode, b64encode
 
 import idiokit
 from idiokit.xmlcore import Element, Elements
 
 
+_log = logging.getLogger(__name__)
+
+
 def _replace_non_xml_chars(unicode_obj, replacement=u"\ufffd"):
     return _NON_XML.sub(replacement, unicode_obj)
 
@@ -49,9 +53,229 @@ def _normalize(value):
     raise TypeError(msg)
 
 
+# Most keys and many values (feed names, types, country codes, ...)
+# repeat across events. Share them between events by interning them
+# into a bounded table that gets cleared whenever it fills up.
+_INTERN_MAX_LENGTH = 128
+_INTERN_MAX_COUNT = 2 ** 16
+
+_interned = {}
+_singletons = {}
+
+
+def _intern(string):
+    """Return a shared instance of a string equal to the given one.
+
+    >>> a = _intern(u"".join([u"ke", u"y"]))
+    >>> b = _intern(u"".join([u"k", u"ey"]))
+    >>> a is b
+    True
+    """
+
+    interned = _interned.get(string, None)
+    if interned is not None:
+        return interned
+
+    if len(string) > _INTERN_MAX_LENGTH:
+        return string
+
+    if len(_interned) >= _INTERN_MAX_COUNT:
+        _interned.clear()
+        _singletons.clear()
+    _interned[string] = string
+    return string
+
+
+def _pack(values):
+    """Return the values as a sorted tuple without duplicates.
+
+    Values should already be normalized and interned. One-value tuples
+    are shared between events.
+
+    >>> _pack([u"b", u"a", u"b"])
+    (u'a', u'b')
+    >>> _pack([u"a"]) is _pack([u"a"])
+    True
+    """
+
+    values = set(values)
+    if len(values) != 1:
+        return tuple(sorted(values))
+
+    value, = values
+    singleton = _singletons.get(value, None)
+    if singleton is None:
+        singleton = (value,)
+        if _interned.get(value, None) is value:
+            _singletons[value] = singleton
+    return singleton
+
+
+def _merge(packed, values):
+    """Return the union of a packed tuple and some values as a packed
+    tuple. Return the original tuple when there is nothing new to add.
+
+    >>> packed = _pack([u"a"])
+    >>> _merge(packed, [u"a"]) is packed
+    True
+    >>> _merge(packed, [u"b", u"a"])
+    (u'a', u'b')
+    """
+
+    new = set(values)
+    new.difference_update(packed)
+    if not new:
+        return packed
+    new.update(packed)
+    return _pack(new)
+
+
 EVENT_NS = "abusehelper#event"
 
 
+def _unpickle_packed(cls, attrs):
+    # Pickled events contain already normalized and packed values, so
+    # unpickling only needs to intern them again instead of going through
+    # the normalization of Event.__init__.
+
+    interned = {}
+    for key, values in attrs.iteritems():
+        if len(values) == 1:
+            interned[_intern(key)] = _pack((_intern(values[0]),))
+        else:
+            interned[_intern(key)] = tuple(_intern(x) for x in values)
+    return cls._from_layers((interned,), owned=True)
+
+
+def _write_uint(out, number):
+    while number >= 0x80:
+        out.append(chr((number & 0x7f) | 0x80))
+        number >>= 7
+    out.append(chr(number))
+
+
+def _read_uint(data, index):
+    byte = ord(data[index])
+    if byte < 0x80:
+        return byte, index + 1
+
+    number = 0
+    shift = 0
+    while byte >= 0x80:
+        number |= (byte & 0x7f) << shift
+        shift += 7
+        index += 1
+        byte = ord(data[index])
+    return number | (byte << shift), index + 1
+
+
+def _write_string(out, string):
+    encoded = string.encode("utf-8")
+    _write_uint(out, len(encoded))
+    out.append(encoded)
+
+
+def _read_string(data, index):
+    length, index = _read_uint(data, index)
+    end = index + length
+    if end > len(data):
+        raise ValueError("truncated compact event data")
+    return data[index:end].decode("utf-8"), end
+
+
+_COMPACT_VERSION = 1
+
+
+def _encode_compact(events):
+    r"""Return a list of events encoded into a compact binary format.
+
+    The format starts with a version number and a table of the keys used
+    by the events, followed by the events' key-value pairs. Each key is
+    a reference to the key table. All integers are encoded as unsigned
+    varints and all strings as length-prefixed UTF-8.
+
+    >>> data = _encode_compact([Event(a="1"), Event(a=["1", "2"], b="3")])
+    >>> [Event(x) for x in _decode_compact(data)] == [Event(a="1"), Event(a=["1", "2"], b="3")]
+    True
+
+    Unlike the XML based formats the compact format preserves all
+    characters, including the ones forbidden in XML.
+
+    >>> [Event(x) for x in _decode_compact(_encode_compact([Event(a=u"")]))] == [Event(a=u"")]
+    True
+    """
+
+    keys = {}
+    key_out = []
+    event_out = []
+
+    _write_uint(event_out, len(events))
+    for event in events:
+        attrs = event._attrs
+        _write_uint(event_out, sum(len(x) for x in attrs.itervalues()))
+
+        for key, values in attrs.iteritems():
+            index = keys.get(key, None)
+            if index is None:
+                index = len(keys)
+                keys[key] = index
+                _write_string(key_out, key)
+
+            for value in values:
+                _write_uint(event_out, index)
+                _write_string(event_out, value)
+
+    header = [chr(_COMPACT_VERSION)]
+    _write_uint(header, len(keys))
+    return "".join(header + key_out + event_out)
+
+
+def _check_count(count, min_size, data, index):
+    # Reject counts that can't fit the remaining data before looping
+    # over them, as a corrupted count can be arbitrarily large.
+    if count * min_size > len(data) - index:
+        raise ValueError("truncated compact event data")
+
+
+def _read_compact(data):
+    if not data or ord(data[0]) != _COMPACT_VERSION:
+        raise ValueError("unknown compact event format version")
+
+    keys = []
+    key_count, index = _read_uint(data, 1)
+    _check_count(key_count, 1, data, index)
+    for _ in xrange(key_count):
+        key, index = _read_string(data, index)
+        keys.append(_intern(key))
+
+    results = []
+    event_count, index = _read_uint(data, index)
+    _check_count(event_count, 1, data, index)
+    for _ in xrange(event_count):
+        attrs = {}
+        pair_count, index = _read_uint(data, index)
+        _check_count(pair_count, 2, data, index)
+        for _ in xrange(pair_count):
+            key_index, index = _read_uint(data, index)
+            value, index = _read_string(data, index)
+            attrs.setdefault(keys[key_index], []).append(_intern(value))
+
+        for key, values in attrs.iteritems():
+            attrs[key] = _pack(values)
+        results.append(attrs)
+    return results
+
+
+def _decode_compact(data):
+    # Return the decoded events as dicts of already interned and packed
+    # values, ready to be used as event layers.
+
+    try:
+        return _read_compact(data)
+    except IndexError:
+        raise ValueError("malformed compact event data")
+
+
 def _unicode_quote(string):
     r"""
     >>> _unicode_quote(u"a")
@@ -88,21 +312,76 @@ _UNICODE_PART = re.compile(r'\s*(?:(?:"((?:\\.|[^"])*)")|([^\s"=,]+)|)\s*', re.U
 
 
 class Event(object):
-    __slots__ = ["_attrs"]
+    # The attributes are stored as dicts mapping interned keys to sorted
+    # tuples of interned values. The tuples are never modified in place,
+    # so they can be freely shared between events.
+    #
+    # Copies and unions share the dicts of the original event as layers
+    # instead of copying them. The layers are merged into one dict when
+    # the attributes are first read, or when the layering gets too deep.
+    # A shared dict is copied before it gets modified.
+    __slots__ = ["_layers", "_flat", "_owned"]
 
     _UNDEFINED = object()
+    _MAX_LAYERS = 16
+
+    @classmethod
+    def _from_layers(cls, layers, owned=False):
+        event = cls.__new__(cls)
+        event._set_layers(layers, owned)
+        return event
+
+    def _set_layers(self, layers, owned):
+        if len(layers) == 1:
+            self._layers = None
+            self._flat = layers[0]
+        else:
+            self._layers = layers
+            self._flat = None
+        self._owned = owned
+
+    def _share_layers(self):
+        self._owned = False
+        if self._flat is None:
+            return self._layers
+        return (self._flat,)
+
+    def _flatten(self):
+        layers = self._layers
+
+        flat = dict(layers[0])
+        for layer in layers[1:]:
+            for key, values in layer.iteritems():
+                existing = flat.get(key, None)
+                flat[key] = values if existing is None else _merge(existing, values)
+        self._set_layers((flat,), True)
+        return flat
+
+    @property
+    def _attrs(self):
+        flat = self._flat
+        if flat is None:
+            flat = self._flatten()
+        return flat
+
+    def _own_attrs(self):
+        attrs = self._attrs
+        if not self._owned:
+            attrs = dict(attrs)
+            self._set_layers((attrs,), True)
+        return attrs
 
     @classmethod
     def _itemize(cls, *args, **keys):
         result = dict()
 
         for obj in args + (keys,):
-            if type(obj) == Event:
+            if isinstance(obj, Event):
                 for key, values in obj._attrs.iteritems():
                     if key not in result:
-                        result[key] = values.copy()
+                        result[key] = values
                     else:
-                        result[key].update(values)
+                        result[key] = _merge(result[key], values)
                 continue
 
             if hasattr(obj, "iteritems"):
@@ -112,15 +391,17 @@ class Event(object):
 
             for key, values in obj:
                 if isinstance(values, basestring):
-                    values = (_normalize(values),)
+                    values = (_intern(_normalize(values)),)
                 else:
-                    values = (_normalize(x) for x in values)
+                    values = [_intern(_normalize(x)) for x in values]
+                if not values:
+                    continue
 
-                key = _normalize(key)
+                key = _intern(_normalize(key))
                 if key not in result:
-                    result[key] = set(values)
+                    result[key] = _pack(values)
                 else:
-                    result[key].update(values)
+                    result[key] = _merge(result[key], values)
 
         return result
 
@@ -190,8 +471,35 @@ class Event(object):
         >>> element.add(event.to_elements())
         >>> list(Event.from_elements(element)) == [Event({u"\\ufffd": u"\\ufffd"})]
         True
+
+        Stanzas using the compact format (see events_to_elements) are
+        recognized automatically.
+
+        >>> element = Element("message")
+        >>> element.add(batch_to_elements([Event(a="1"), Event(b="2")], compact=True))
+        >>> list(Event.from_elements(element)) == [Event(a="1"), Event(b="2")]
+        True
+
+        Malformed compact payloads get logged and skipped, so one bad
+        stanza can't break the streams parsing the room's stanzas.
+
+        >>> element = Element("message")
+        >>> element.add(Element("c", xmlns=EVENT_NS))
+        >>> list(Event.from_elements(element))
+        []
         """
 
+        # Compact event format
+        for compact_element in elements.children("c", EVENT_NS):
+            try:
+                decoded = _decode_compact(b64decode(compact_element.text))
+            except (TypeError, ValueError) as error:
+                _log.warning("Skipped malformed compact event data: %s", error)
+                continue
+
+            for attrs in decoded:
+                yield Event._from_layers((attrs,), owned=True)
+
         # Future event format
         for event_element in elements.children("e", EVENT_NS):
             attrs = collections.defaultdict(list)
@@ -219,9 +527,20 @@ class Event(object):
         >>> event = Event({u"\xe4": u"\xe4"})
         >>> Event(event).items()
         ((u'\\xe4', u'\\xe4'),)
+
+        Copies share the key-value pairs with the original event until
+        either of them gets modified.
+
+        >>> copy = Event(event)
+        >>> copy.add(u"\xe4", u"b")
+        >>> event.items()
+        ((u'\\xe4', u'\\xe4'),)
         """
 
-        self._attrs = self._itemize(*args, **keys)
+        if len(args) == 1 and not keys and isinstance(args[0], Event):
+            self._set_layers(args[0]._share_layers(), False)
+        else:
+            self._set_layers((self._itemize(*args, **keys),), True)
 
     def union(self, *args, **keys):
         """Return a new event that contains all key-value pairs from
@@ -229,9 +548,33 @@ class Event(object):
 
         >>> sorted(Event(a=["1", "2"]).union(a=["1", "3"]).items())
         [(u'a', u'1'), (u'a', u'2'), (u'a', u'3')]
+
+        The result is layered over the original event without copying it,
+        so repeated unions stay cheap.
+
+        >>> event = Event(a="1")
+        >>> for value in ["2", "3", "4"]:
+        ...     event = event.union(a=value)
+        >>> event.values("a")
+        (u'1', u'2', u'3', u'4')
         """
 
-        return type(self)(self, *args, **keys)
+        if keys or not all(isinstance(x, Event) for x in args):
+            overlays = (self._itemize(*args, **keys),)
+        else:
+            overlays = ()
+            for other in args:
+                overlays += other._share_layers()
+
+        if self._flat is None and len(self._layers) + len(overlays) > self._MAX_LAYERS:
+            self._flatten()
+        layers = self._share_layers()
+        layers += tuple(x for x in overlays if x)
+
+        event = type(self)._from_layers(layers)
+        if len(layers) > self._MAX_LAYERS:
+            event._flatten()
+        return event
 
     def difference(self, *args, **keys):
         """Return a new event that contains all key-value pairs
@@ -243,12 +586,25 @@ class Event(object):
         """
 
         other = self._itemize(*args, **keys)
-        result = dict()
-        for key, values in self._attrs.iteritems():
-            diff = values.difference(other.get(key, ()))
+        attrs = self._attrs
+
+        result = None
+        for key, removed in other.iteritems():
+            values = attrs.get(key, ())
+            diff = [x for x in values if x not in removed]
+            if len(diff) == len(values):
+                continue
+
+            if result is None:
+                result = dict(attrs)
             if diff:
-                result[key] = diff
-        return type(self)(result)
+                result[key] = _pack(diff)
+            else:
+                del result[key]
+
+        if result is None:
+            return type(self)._from_layers(self._share_layers())
+        return type(self)._from_layers((result,), owned=True)
 
     def add(self, key, value, *values):
         """Add value(s) for a key.
@@ -294,10 +650,15 @@ class Event(object):
         False
         """
 
-        key = _normalize(key)
-        if key not in self._attrs:
-            self._attrs[key] = set()
-        self._attrs[key].update(_normalize(value) for value in values)
+        values = [_intern(_normalize(value)) for value in values]
+        if not values:
+            return
+
+        key = _intern(_normalize(key))
+        existing = self._attrs.get(key, ())
+        merged = _merge(existing, values)
+        if merged is not existing:
+            self._own_attrs()[key] = merged
 
     def discard(self, key, value, *values):
         """Discard some value(s) of a key.
@@ -320,10 +681,16 @@ class Event(object):
         key = _normalize(key)
         if key not in self._attrs:
             return
-        valueset = self._attrs[key]
-        valueset.difference_update(_normalize(value) for value in (value,) + values)
-        if not valueset:
-            del self._attrs[key]
+
+        existing = self._attrs[key]
+        discarded = set(_normalize(value) for value in (value,) + values)
+        remaining = [x for x in existing if x not in discarded]
+        if len(remaining) == len(existing):
+            return
+        if remaining:
+            self._own_attrs()[key] = _pack(remaining)
+        else:
+            del self._own_attrs()[key]
 
     def clear(self, key):
         """Clear all values of a key.
@@ -341,7 +708,8 @@ class Event(object):
         """
 
         key = _normalize(key)
-        self._attrs.pop(key, None)
+        if key in self._attrs:
+            del self._own_attrs()[key]
 
     def _unkeyed(self):
         for values in self._attrs.itervalues():
@@ -547,6 +915,20 @@ class Event(object):
         False
         """
 
+        if parser is None and filter is None:
+            if key is self._UNDEFINED:
+                valuesets = self._attrs.itervalues()
+            else:
+                valuesets = (self._attrs.get(_normalize(key), ()),)
+
+            for values in valuesets:
+                if value is self._UNDEFINED:
+                    if values:
+                        return True
+                elif value in values:
+                    return True
+            return False
+
         if key is self._UNDEFINED:
             values = set(self._unkeyed())
         else:
@@ -632,7 +1014,14 @@ class Event(object):
         return tuple(key for key in self._attrs
                      if self.contains(key, parser=parser, filter=filter))
 
-    def to_elements(self, include_body=True):
+    def to_elements(self, include_body=True, body_limit=None):
+        """Return the event as XML element(s).
+
+        By default the result also contains a human-readable <body>
+        element. Leave it out by setting include_body to False, or
+        show at most body_limit key-value pairs in it.
+        """
+
         element = Element("event", xmlns=EVENT_NS)
 
         for key, value in self.items():
@@ -645,11 +1034,27 @@ class Event(object):
             return element
 
         body = Element("body")
-        body.text = _replace_non_xml_chars(unicode(self))
+        body.text = _replace_non_xml_chars(self._body_text(body_limit))
         return Elements(body, element)
 
+    def _body_text(self, limit=None):
+        """
+        >>> Event(a=["1", "2", "3"])._body_text(1)
+        u'a=1 (2 more)'
+        """
+
+        if limit is None:
+            return unicode(self)
+
+        items = self.items()
+        text = u", ".join(_unicode_quote(key) + u"=" + _unicode_quote(value)
+                          for (key, value) in items[:limit])
+        if len(items) > limit:
+            text += u" ({0} more)".format(len(items) - limit)
+        return text
+
     def __reduce__(self):
-        return self.__class__, (self._attrs,)
+        return _unpickle_packed, (self.__class__, self._attrs)
 
     def __eq__(self, other):
         if not isinstance(other, Event):
@@ -683,6 +1088,117 @@ class Event(object):
         return self.__class__.__name__ + "(" + repr(attrs) + ")"
 
 
+class FrozenEvent(Event):
+    """An immutable and hashable version of Event.
+
+    >>> event = FrozenEvent(a="b")
+    >>> event.add("c", "d")
+    Traceback (most recent call last):
+        ...
+    TypeError: FrozenEvent objects are immutable
+
+    Frozen events compare equal to other events with the same key-value
+    pairs, and can be used as dictionary keys and set members.
+
+    >>> event == Event(a="b")
+    True
+    >>> event in set([FrozenEvent(a="b")])
+    True
+
+    Digests are calculated once per hash function and then reused
+    (see hexdigest).
+
+    >>> event.hexdigest() == hexdigest(Event(a="b"))
+    True
+
+    XML elements and body texts are likewise built once per set of
+    options and then reused, so an event sent to several rooms is
+    converted only once. The returned elements must not be modified.
+
+    >>> event.to_elements() is event.to_elements()
+    True
+
+    .union and .difference return new FrozenEvent objects that share
+    their values with the original event.
+
+    >>> event.union(c="d") == FrozenEvent(a="b", c="d")
+    True
+    >>> event.difference(a="x") is event
+    True
+    """
+
+    __slots__ = ["_hash", "_digests", "_rendered"]
+
+    def _immutable(self, *args, **keys):
+        raise TypeError(self.__class__.__name__ + " objects are immutable")
+
+    add = update = discard = clear = pop = _immutable
+
+    def union(self, *args, **keys):
+        if not args and not keys:
+            return self
+        return Event.union(self, *args, **keys)
+
+    def difference(self, *args, **keys):
+        result = Event.difference(self, *args, **keys)
+        if result._flat is self._flat:
+            return self
+        return result
+
+    def hexdigest(self, func=hashlib.sha1):
+        try:
+            digests = self._digests
+        except AttributeError:
+            digests = self._digests = dict()
+
+        digest = digests.get(func, None)
+        if digest is None:
+            digest = _hexdigest(self, func)
+            digests[func] = digest
+        return digest
+
+    def _render(self, key, func, *args):
+        try:
+            rendered = self._rendered
+        except AttributeError:
+            rendered = self._rendered = dict()
+
+        result = rendered.get(key, None)
+        if result is None:
+            result = func(self, *args)
+            rendered[key] = result
+        return result
+
+    def to_elements(self, include_body=True, body_limit=None):
+        key = "elements", include_body, body_limit
+        return self._render(key, Event.to_elements, include_body, body_limit)
+
+    def _body_text(self, limit=None):
+        return self._render(("body", limit), Event._body_text, limit)
+
+    def __hash__(self):
+        try:
+            return self._hash
+        except AttributeError:
+            self._hash = hash(frozenset(self._attrs.iteritems()))
+        return self._hash
+
+
+def _hexdigest(event, func):
+    result = func()
+
+    attrs = event._attrs
+    for key in sorted(attrs):
+        encoded_key = key.encode("utf-8")
+        for value in attrs[key]:
+            result.update(encoded_key)
+            result.update("\xc0")
+            result.update(value.encode("utf-8"))
+            result.update("\xc0")
+
+    return result.hexdigest()
+
+
 def hexdigest(event, func=hashlib.sha1):
     """Return a hexadecimal digest string created by from the given event's
     key-value pairs.
@@ -719,22 +1235,223 @@ def hexdigest(event, func=hashlib.sha1):
     >>> import hashlib
     >>> hexdigest(Event(a="b"), hashlib.sha1)
     'edf6294fc1d3f9fe8be4a2d5626788bcfde05e62'
+
+    The digests of FrozenEvent objects are cached, so calculating the
+    same digest for the same frozen event again is cheap.
     """
 
-    result = func()
+    if isinstance(event, FrozenEvent):
+        return event.hexdigest(func)
+    return _hexdigest(event, func)
 
-    for key, value in sorted(event.items()):
-        result.update(key.encode("utf-8"))
-        result.update("\xc0")
-        result.update(value.encode("utf-8"))
-        result.update("\xc0")
 
-    return result.hexdigest()
+def stanzas_to_events():
+    """Return a stream that turns XML stanzas into events.
 
+    A stanza may contain more than one event (see events_to_elements),
+    in which case all of them are sent forward.
+    """
 
-def stanzas_to_events():
     return idiokit.map(Event.from_elements)
 
 
-def events_to_elements():
-    return idiokit.map(lambda x: (x.to_elements(),))
+def _estimate_size(event):
+    # A rough estimate of the serialized size of an event: the escaping
+    # overhead is ignored, 24 bytes are added per key-value pair for the
+    # surrounding markup and the body doubles the whole thing.
+    return 2 * sum(len(key) + len(value) + 24 for (key, value) in event.items())
+
+
+BODY_FULL = "full"
+BODY_NONE = "none"
+
+FORMAT_LEGACY = "legacy"
+FORMAT_COMPACT = "compact"
+
+
+def body_options(body):
+    """Return the to_elements keyword arguments for a body policy.
+
+    The policy is either "full" (the default), "none" (leave the body
+    out), or a number of key-value pairs to show in a truncated body.
+
+    >>> body_options("full") == {"include_body": True, "body_limit": None}
+    True
+    >>> body_options("none") == {"include_body": False, "body_limit": None}
+    True
+    >>> body_options("3") == {"include_body": True, "body_limit": 3}
+    True
+    >>> body_options("some")
+    Traceback (most recent call last):
+        ...
+    ValueError: invalid body policy 'some'
+    """
+
+    if body == BODY_FULL:
+        return dict(include_body=True, body_limit=None)
+    if body == BODY_NONE:
+        return dict(include_body=False, body_limit=None)
+
+    try:
+        limit = int(body)
+    except (TypeError, ValueError):
+        limit = -1
+    if limit < 0:
+        raise ValueError("invalid body policy " + repr(body))
+    return dict(include_body=True, body_limit=limit)
+
+
+def default_body(src_room, dst_room):
+    """Return the default body policy for an expert reading events
+    from src_room and sending its augmentations to dst_room.
+
+    Augmentations sent back to the source room get the full body, as
+    people following that room read them there. A separate augment room
+    is only read by other bots (such as combiners), so the body is left
+    out there.
+
+    >>> default_body("room", "room")
+    'full'
+    >>> default_body("room", "other room")
+    'none'
+    """
+
+    return BODY_FULL if src_room == dst_room else BODY_NONE
+
+
+def format_options(event_format):
+    """Return the batch_to_elements keyword arguments for an event format.
+
+    >>> format_options("legacy") == {"compact": False}
+    True
+    >>> format_options("compact") == {"compact": True}
+    True
+    >>> format_options("binary")
+    Traceback (most recent call last):
+        ...
+    ValueError: invalid event format 'binary'
+    """
+
+    if event_format == FORMAT_LEGACY:
+        return dict(compact=False)
+    if event_format == FORMAT_COMPACT:
+        return dict(compact=True)
+    raise ValueError("invalid event format " + repr(event_format))
+
+
+def element_options(body=BODY_FULL, event_format=FORMAT_LEGACY):
+    """Return the batch_to_elements keyword arguments for a body policy
+    and an event format. Parse the options once (e.g. when a bot
+    starts) and pass them to events_to_elements.
+
+    >>> element_options("none", "compact") == {"include_body": False, "body_limit": None, "compact": True}
+    True
+    """
+
+    options = body_options(body)
+    options.update(format_options(event_format))
+    return options
+
+
+def batch_to_elements(batch, include_body=True, body_limit=None, compact=False):
+    """Return XML elements containing all events from the given list.
+
+    >>> elements = batch_to_elements([Event(a="1"), Event(a="2")])
+    >>> message = Element("message")
+    >>> message.add(elements)
+    >>> list(Event.from_elements(message)) == [Event(a="1"), Event(a="2")]
+    True
+    """
+
+    if compact:
+        # The compact format needs an element of its own. The "future"
+        # <e> format that receivers already understand holds one event
+        # per element with every key and value base64 encoded separately,
+        # so it has no room for a key table shared by the whole stanza.
+        compact_element = Element("c", xmlns=EVENT_NS)
+        compact_element.text = b64encode(_encode_compact(batch))
+        elements = [compact_element]
+    elif len(batch) == 1:
+        return batch[0].to_elements(include_body, body_limit)
+    else:
+        elements = [x.to_elements(include_body=False) for x in batch]
+
+    if not include_body:
+        return Elements(*elements)
+
+    body = Element("body")
+    body.text = u"\n".join(_replace_non_xml_chars(x._body_text(body_limit)) for x in batch)
+    return Elements(body, *elements)
+
+
+_FLUSH = object()
+
+
+@idiokit.stream
+def _flush_timer(interval):
+    while True:
+        yield idiokit.sleep(interval)
+        yield idiokit.send(_FLUSH)
+
+
+@idiokit.stream
+def _batch(batch_size, batch_bytes, options):
+    batch = []
+    size = 0
+
+    while True:
+        try:
+            obj = yield idiokit.next()
+        except StopIteration:
+            if batch:
+                yield idiokit.send(batch_to_elements(batch, **options))
+            raise
+
+        if obj is not _FLUSH:
+            batch.append(obj)
+            size += _estimate_size(obj)
+            if len(batch) < batch_size and (batch_bytes is None or size < batch_bytes):
+                continue
+
+        if batch:
+            yield idiokit.send(batch_to_elements(batch, **options))
+            batch = []
+            size = 0
+
+
+def events_to_elements(batch_size=1, batch_bytes=None, batch_interval=1.0,
+                       body=BODY_FULL, event_format=FORMAT_LEGACY, options=None):
+    """Return a stream that turns events into XML stanzas.
+
+    By default every event gets its own stanza. When batch_size is
+    larger than 1 up to batch_size events are packed into one stanza.
+    A stanza is also sent when the estimated size of the packed events
+    reaches batch_bytes (when given), and no event waits longer than
+    batch_interval seconds for its stanza.
+
+    Receivers need no configuration for batched stanzas, as
+    stanzas_to_events handles them transparently.
+
+    The body argument sets the policy for rendering the human-readable
+    <body> element (see body_options). Machine-to-machine rooms
+    can save the rendering cost and roughly half of the stanza size
+    with body="none".
+
+    The events are encoded in the format given by event_format. The
+    "legacy" format is understood by all AbuseHelper versions. The
+    "compact" format puts all events of a stanza into a single base64
+    payload with a shared key table. It is smaller and faster to encode
+    and decode, but understood only by newer receivers.
+
+    Options already parsed with element_options can be given instead
+    of body and event_format.
+    """
+
+    if options is None:
+        options = element_options(body, event_format)
+    if batch_size <= 1:
+        return idiokit.map(lambda x: (batch_to_elements([x], **options),))
+
+    result = _batch(batch_size, batch_bytes, options)
+    idiokit.pipe(_flush_timer(batch_interval), result)
+    return result
@@ -0,0 +1,95 @@
+"""
+Consistent hashing: map keys to a changing set of nodes so that adding
+or removing a node moves only the keys that have to move.
+
+>>> ring = HashRing(["a", "b", "c"])
+>>> ring.get("some key") in ("a", "b", "c")
+True
+
+Each node owns several points on the ring, and a key belongs to the
+node owning the next point after the key's hash. Removing a node hands
+its keys to the remaining nodes and leaves the other keys where they
+were.
+
+>>> keys = ["key " + str(x) for x in range(100)]
+>>> before = dict((key, ring.get(key)) for key in keys)
+>>> ring.remove("c")
+>>> all(ring.get(key) == node for (key, node) in before.items() if node != "c")
+True
+>>> sorted(ring.nodes)
+['a', 'b']
+"""
+
+import bisect
+import struct
+import hashlib
+
+
+def _hash(key):
+    if isinstance(key, unicode):
+        key = key.encode("utf-8")
+    return struct.unpack_from("!Q", hashlib.md5(key).digest())[0]
+
+
+class HashRing(object):
+    def __init__(self, nodes=(), replicas=64):
+        self._replicas = replicas
+        self._points = []
+        self._owners = []
+        self._nodes = set()
+
+        for node in nodes:
+            self.add(node)
+
+    @property
+    def nodes(self):
+        return frozenset(self._nodes)
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def _node_points(self, node):
+        return [_hash(node + "-" + str(x)) for x in xrange(self._replicas)]
+
+    def add(self, node):
+        """
+        Add a node, given as a string that also identifies the node to
+        other processes. Adding a node that is already on the ring does
+        nothing.
+        """
+
+        if node in self._nodes:
+            return
+        self._nodes.add(node)
+
+        for point in self._node_points(node):
+            index = bisect.bisect_left(self._points, point)
+            self._points.insert(index, point)
+            self._owners.insert(index, node)
+
+    def remove(self, node):
+        """
+        Remove a node. Removing a node that is not on the ring does nothing.
+        """
+
+        if node not in self._nodes:
+            return
+        self._nodes.discard(node)
+
+        keep = [x for x in xrange(len(self._points)) if self._owners[x] != node]
+        self._points = [self._points[x] for x in keep]
+        self._owners = [self._owners[x] for x in keep]
+
+    def get(self, key):
+        """
+        Return the node the given string key belongs to, or None when the
+        ring has no nodes.
+        """
+
+        if not self._points:
+            return None
+
+        index = bisect.bisect_right(self._points, _hash(key))
+        if index == len(self._points):
+            index = 0
+        return self._owners[index]
@@ -0,0 +1,129 @@
+"""
+Bounded, process-wide caches for parsed event values.
+
+The same strings (IP addresses, domain names, timestamps) get parsed
+over and over again as events pass through rules, experts and bots.
+Event values are interned (see abusehelper.core.events), so caching the
+parse results by the string value is cheap and effectively memoizes the
+parsing per event as well.
+
+>>> calls = []
+>>> def parse(string):
+...     calls.append(string)
+...     return string.upper()
+>>> upper = ParseCache(parse, max_size=2)
+>>> upper("a"), upper("a")
+('A', 'A')
+>>> calls
+['a']
+>>> upper.hits, upper.misses
+(1, 1)
+"""
+
+import threading
+
+
+class ParseCache(object):
+    """
+    Cache the results of a one-argument parser function.
+
+    The cache holds two generations of results. When the current
+    generation gets full it becomes the old one and the previous old
+    generation gets dropped. Results found from the old generation are
+    moved back to the current one. This keeps the most used values cached
+    while bounding the memory use to 2 * max_size entries.
+
+    >>> cache = ParseCache(len, max_size=2)
+    >>> [cache(x) for x in ["a", "bb", "ccc", "dddd"]]
+    [1, 2, 3, 4]
+    >>> len(cache)
+    4
+    >>> cache("eeeee")
+    5
+    >>> len(cache)
+    3
+
+    The parser function should not raise exceptions for invalid values.
+    Return e.g. None instead, so that the negative result gets cached too.
+    """
+
+    def __init__(self, func, max_size=2 ** 14):
+        self._func = func
+        self._max_size = max_size
+
+        self._current = {}
+        self._old = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, value):
+        try:
+            result = self._current[value]
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            return result
+
+        try:
+            result = self._old.pop(value)
+        except KeyError:
+            self.misses += 1
+            result = self._func(value)
+        else:
+            self.hits += 1
+
+        if len(self._current) >= self._max_size:
+            self._old = self._current
+            self._current = {}
+        self._current[value] = result
+        return result
+
+    def __len__(self):
+        return len(self._current) + len(self._old)
+
+    def clear(self):
+        self._current = {}
+        self._old = {}
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def cache(name, func, max_size=2 ** 14):
+    """
+    Return a named process-wide ParseCache for the given parser function.
+    Return the already existing cache if one with the same name has
+    already been created.
+
+    >>> a = cache("doctest", len)
+    >>> b = cache("doctest", len)
+    >>> a is b
+    True
+    """
+
+    with _caches_lock:
+        result = _caches.get(name, None)
+        if result is None:
+            result = ParseCache(func, max_size)
+            _caches[name] = result
+        return result
+
+
+def stats():
+    """
+    Return a dictionary mapping the names of the process-wide caches to
+    (hits, misses, size) tuples.
+
+    >>> counting = cache("doctest stats", len)
+    >>> counting("x")
+    1
+    >>> stats()["doctest stats"]
+    (0, 1, 1)
+    """
+
+    with _caches_lock:
+        caches = list(_caches.items())
+    return dict((name, (x.hits, x.misses, len(x))) for (name, x) in caches)
@@ -2,15 +2,19 @@ from __future__ import absolute_import
 
 import os
 import sys
+import time
 import errno
 import struct
 import cPickle
 import idiokit
 import subprocess
+import itertools
 import contextlib
+import collections
 import socket as native_socket
 from idiokit import socket, select
-from . import events, rules, taskfarm, bot
+from . import events, rules, taskfarm, bot, hashring, services
+from .rules import optimizer
 
 
 class _ConnectionLost(Exception):
@@ -41,9 +45,13 @@ def _recvall_blocking(conn, amount):
     return "".join(data)
 
 
-def send_encoded(conn, obj):
+def _encode(obj):
     msg_bytes = cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
-    data = struct.pack("!I", len(msg_bytes)) + msg_bytes
+    return struct.pack("!I", len(msg_bytes)) + msg_bytes
+
+
+def send_encoded(conn, obj):
+    data = _encode(obj)
 
     with wrapped_socket_errnos(errno.ECONNRESET, errno.EPIPE):
         conn.sendall(data)
@@ -57,6 +65,11 @@ def recv_decoded(sock):
     return cPickle.loads(msg_bytes)
 
 
+# How often (in seconds) the collector checks for added workers when the
+# worker pool can grow.
+RESCAN_INTERVAL = 0.05
+
+
 @idiokit.stream
 def _recvall_stream(sock, amount, timeout=None):
     data = []
@@ -71,33 +84,345 @@ def _recvall_stream(sock, amount, timeout=None):
     idiokit.stop("".join(data))
 
 
+_FLUSH = object()
+
+
+@idiokit.stream
+def _flush_timer(interval):
+    while True:
+        yield idiokit.sleep(interval)
+        yield idiokit.send(_FLUSH)
+
+
 @idiokit.stream
-def distribute_encode(socks):
+def _wait_writable(socks, writable):
+    while not writable:
+        _, ready, _ = yield select.select((), socks, ())
+        writable.extend(ready)
+    idiokit.stop(writable.pop())
+
+
+class _Dispatch(object):
+    # Send each batch of events to whichever connection is writable
+    # first.
+
+    def __init__(self, conns, in_flight):
+        self._conns = conns
+        self._in_flight = in_flight
+
+    def key(self, src, event):
+        # Return a key telling which events can share a batch.
+        return None
+
+    def add(self, conn):
+        pass
+
+    def remove(self, conn):
+        pass
+
+    def choose(self, key):
+        # Return the connection for a batch, or None for any writable one.
+        return None
+
+
+class _LeastInFlightDispatch(_Dispatch):
+    def choose(self, key):
+        return min(self._conns, key=self._in_flight.__getitem__)
+
+
+class _HashDispatch(_Dispatch):
+    def __init__(self, conns, in_flight, key_func):
+        _Dispatch.__init__(self, conns, in_flight)
+
+        self._key_func = key_func
+        self._names = itertools.count()
+        self._by_node = {}
+        self._ring = hashring.HashRing()
+        for conn in conns:
+            self.add(conn)
+
+    def key(self, src, event):
+        return self._ring.get(self._key_func(src, event))
+
+    def choose(self, node):
+        return self._by_node[node]
+
+    def add(self, conn):
+        node = str(next(self._names))
+        self._by_node[node] = conn
+        self._ring.add(node)
+
+    def remove(self, conn):
+        for node, other in self._by_node.items():
+            if other is conn:
+                del self._by_node[node]
+                self._ring.remove(node)
+
+
+def _event_key(src, event):
+    # Only this process maps events to workers, so the built-in hash is
+    # enough to send identical events to the same worker. It is much
+    # cheaper than a digest over all the values, and FrozenEvent objects
+    # cache it.
+    if not isinstance(event, events.FrozenEvent):
+        event = events.FrozenEvent(event)
+    return str(hash(event))
+
+
+DISPATCH_STRATEGIES = {
+    "any": _Dispatch,
+    "least-in-flight": _LeastInFlightDispatch,
+    "source-room": lambda conns, in_flight: _HashDispatch(
+        conns, in_flight, lambda src, event: unicode(src)),
+    "event-digest": lambda conns, in_flight: _HashDispatch(
+        conns, in_flight, _event_key)
+}
+
+
+class ReorderBuffer(object):
+    """
+    Hold back answers to event batches so that the events of each source
+    room come out in the order they were sent, even when the batches get
+    answered out of order. Each batch waits only for the earlier batches
+    that share source rooms with it.
+
+    >>> reorder = ReorderBuffer()
+    >>> reorder.add(1, ["a"])
+    >>> reorder.add(2, ["a", "b"])
+    >>> reorder.add(3, ["b"])
+    >>> reorder.add(4, ["c"])
+    >>> reorder.complete(3, "third")
+    []
+    >>> reorder.complete(4, "fourth")
+    ['fourth']
+    >>> reorder.complete(2, "second")
+    []
+    >>> reorder.complete(1, "first")
+    ['first', 'second', 'third']
+
+    At most max_pending batches can be added before they have been
+    completed and released, which bounds the memory used for reordering.
+    """
+
+    def __init__(self, max_pending=256):
+        self._max_pending = max_pending
+        self._queues = {}
+        self._srcs = {}
+        self._results = {}
+        self._space = None
+
+    def is_full(self):
+        return len(self._srcs) >= self._max_pending
+
+    def wait(self):
+        """
+        Return a stream that finishes when some batch gets released.
+        """
+
+        if self._space is None:
+            self._space = idiokit.Event()
+        return self._space.fork()
+
+    def add(self, batch_id, srcs):
+        srcs = frozenset(srcs)
+        self._srcs[batch_id] = srcs
+        for src in srcs:
+            self._queues.setdefault(src, collections.deque()).append(batch_id)
+
+    def _is_first(self, batch_id):
+        return all(self._queues[src][0] == batch_id for src in self._srcs[batch_id])
+
+    def complete(self, batch_id, result):
+        """
+        Record the result for the given batch and return a list of the
+        results that can be released.
+        """
+
+        self._results[batch_id] = result
+
+        released = []
+        candidates = [batch_id]
+        while candidates:
+            candidate = candidates.pop()
+            if candidate not in self._results or not self._is_first(candidate):
+                continue
+
+            released.append(self._results.pop(candidate))
+            for src in self._srcs.pop(candidate):
+                queue = self._queues[src]
+                queue.popleft()
+                if queue:
+                    candidates.append(queue[0])
+                else:
+                    del self._queues[src]
+
+        if released and self._space is not None:
+            space = self._space
+            self._space = None
+            space.succeed()
+        return released
+
+
+@idiokit.stream
+def _distribute_batches(socks, batch_size, dispatch, in_flight, reorder):
     writable = []
+    batches = {}
+    batch_ids = itertools.count()
+    rule_counts = {}
+
+    @idiokit.stream
+    def _send_batch(key):
+        batch = batches.pop(key)
+        batch_id = next(batch_ids)
+
+        if reorder is not None:
+            while reorder.is_full():
+                yield reorder.wait()
+            reorder.add(batch_id, set(src for (src, _) in batch))
+
+        sock = dispatch.choose(key)
+        if sock is None:
+            sock = yield _wait_writable(socks, writable)
+
+        # Count the events before sending them, as the answer may arrive
+        # before sendall returns.
+        in_flight[sock] += len(batch)
+        yield sock.sendall(_encode(("events", (batch_id, batch))))
 
     while True:
-        to_all, msg = yield idiokit.next()
-        msg_bytes = cPickle.dumps(msg, cPickle.HIGHEST_PROTOCOL)
-        data = struct.pack("!I", len(msg_bytes)) + msg_bytes
+        obj = yield idiokit.next()
+
+        if obj is _FLUSH:
+            to_all, msg = False, None
+        else:
+            to_all, msg = obj
+            if not to_all and msg[0] == "event":
+                key = dispatch.key(*msg[1])
+                batch = batches.setdefault(key, [])
+                batch.append(msg[1])
+                if len(batch) >= batch_size:
+                    yield _send_batch(key)
+                continue
+
+        # Send the pending events before anything else, so that e.g.
+        # rule changes don't overtake them.
+        for key in list(batches):
+            yield _send_batch(key)
+
+        if msg is None:
+            continue
 
+        type_id, args = msg
+        if type_id == "add_worker":
+            # Bring the new worker up to date with the current rules
+            # before giving it any events.
+            for rule_args, count in rule_counts.iteritems():
+                data = _encode(("inc_rule", rule_args))
+                for _ in xrange(count):
+                    yield args.sendall(data)
+
+            in_flight.setdefault(args, 0)
+            socks.append(args)
+            dispatch.add(args)
+            continue
+        elif type_id == "retire_worker":
+            # The worker answers the events it already has before
+            # answering the stop message.
+            socks.remove(args)
+            dispatch.remove(args)
+            del writable[:]
+            yield args.sendall(_encode(("stop", None)))
+            continue
+
+        if type_id == "inc_rule":
+            rule_counts[args] = rule_counts.get(args, 0) + 1
+        elif type_id == "dec_rule" and args in rule_counts:
+            rule_counts[args] -= 1
+            if rule_counts[args] <= 0:
+                del rule_counts[args]
+
+        data = _encode(msg)
         if to_all:
             for sock in socks:
                 yield sock.sendall(data)
-            writable = []
+            del writable[:]
         else:
-            while not writable:
-                _, writable, _ = yield select.select((), socks, ())
-                writable = list(writable)
-            yield writable.pop().sendall(data)
+            sock = dispatch.choose(None)
+            if sock is None:
+                sock = yield _wait_writable(socks, writable)
+            yield sock.sendall(data)
+
+
+def distribute_encode(socks, batch_size=1, batch_interval=0.01, dispatch="any", in_flight=None, reorder=None):
+    """
+    Return a stream that takes (to_all, msg) pairs and sends each msg to
+    all of the given sockets or to any one of them.
+
+    ("event", (src, event)) messages sent to any socket are packed into
+    ("events", (batch_id, [(src, event), ...])) messages of up to
+    batch_size events, and no event waits longer than batch_interval
+    seconds for its batch. When a ReorderBuffer is given, each batch gets
+    added to it, waiting for room in the buffer when necessary.
+
+    ("add_worker", sock) and ("retire_worker", sock) messages change the
+    set of sockets. An added socket first gets an ("inc_rule", ...)
+    message for each rule added and not yet removed, and a retired socket
+    gets a ("stop", None) message after the events already sent to it.
+
+    The dispatch strategy (a key of DISPATCH_STRATEGIES) decides which
+    socket gets each batch: "any" picks the first writable socket,
+    "least-in-flight" the one with the fewest unanswered events, and
+    "source-room" and "event-digest" use consistent hashing so that the
+    events from the same source room, or identical events, go to the same
+    worker. The in_flight dict, when given, maps each socket to the number
+    of events sent to it and not yet answered (see collect_decode).
+    """
+
+    if in_flight is None:
+        in_flight = {}
+    for sock in socks:
+        in_flight.setdefault(sock, 0)
+
+    strategy = DISPATCH_STRATEGIES[dispatch](socks, in_flight)
+    result = _distribute_batches(socks, batch_size, strategy, in_flight, reorder)
+    if batch_size > 1:
+        idiokit.pipe(_flush_timer(batch_interval), result)
+    return result
+
+
+def _answered(msg):
+    # Return the number of events a message from a worker answers.
+    type_id, args = msg
+    if type_id == "matches":
+        return args[1]
+    return 0
+
+
+def _check_stopped(socks, sock, msg):
+    # A stopped worker sends nothing more, so stop listening to it and
+    # tell which worker stopped.
+
+    if msg[0] != "stopped":
+        return msg
+    socks.remove(sock)
+    return "stopped", sock
 
 
 @idiokit.stream
-def collect_decode(socks):
+def collect_decode(socks, in_flight=None, timeout=None):
+    """
+    Return a stream that receives messages from the given sockets and
+    sends them forward. Sockets added to the list get listened to after
+    at most timeout seconds (when given). When a worker answers
+    ("stopped", None) to a ("stop", None) message, its socket gets removed
+    from the list and ("stopped", sock) gets sent forward.
+    """
+
     readable = []
 
     while True:
         while not readable:
-            readable, _, _ = yield select.select(socks, (), ())
+            readable, _, _ = yield select.select(socks, (), (), timeout)
             readable = list(readable)
 
         sock = readable.pop()
@@ -106,7 +431,80 @@ def collect_decode(socks):
         length, = struct.unpack("!I", length_bytes)
 
         msg_bytes = yield _recvall_stream(sock, length)
-        yield idiokit.send(cPickle.loads(msg_bytes))
+        msg = cPickle.loads(msg_bytes)
+        if in_flight is not None:
+            in_flight[sock] -= _answered(msg)
+
+        msg = _check_stopped(socks, sock, msg)
+        yield idiokit.send(msg)
+
+
+def _cpu_seconds(pid):
+    # Return the CPU time the given process has used, or None if it can't
+    # be read (e.g. when /proc is not available).
+
+    try:
+        with open("/proc/{0}/stat".format(pid)) as stat_file:
+            fields = stat_file.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / float(os.sysconf("SC_CLK_TCK"))
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+# The average share of CPU time per worker above which the worker pool
+# grows, and below which it may shrink.
+SCALE_UP_USAGE = 0.8
+SCALE_DOWN_USAGE = 0.25
+
+
+def scale(size, min_size, max_size, depth, usage, high_depth):
+    """
+    Return 1 when a worker pool of the given size should grow, -1 when it
+    should shrink and 0 otherwise. The depth is the average number of
+    events waiting per worker, and usage the average share of CPU time
+    the workers used (or None when not known).
+
+    The pool grows when the workers have more than high_depth events
+    waiting or are mostly busy.
+
+    >>> scale(2, 1, 4, depth=500, usage=None, high_depth=200)
+    1
+    >>> scale(2, 1, 4, depth=0, usage=0.9, high_depth=200)
+    1
+
+    It shrinks when the workers have nothing waiting and are mostly idle.
+
+    >>> scale(2, 1, 4, depth=0, usage=0.1, high_depth=200)
+    -1
+    >>> scale(2, 1, 4, depth=0, usage=0.5, high_depth=200)
+    0
+
+    The size stays between min_size and max_size.
+
+    >>> scale(4, 1, 4, depth=500, usage=0.9, high_depth=200)
+    0
+    >>> scale(1, 1, 4, depth=0, usage=0.0, high_depth=200)
+    0
+    """
+
+    busy = depth > high_depth or (usage is not None and usage > SCALE_UP_USAGE)
+    if busy:
+        return 1 if size < max_size else 0
+
+    idle = depth < 1 and (usage is None or usage < SCALE_DOWN_USAGE)
+    if idle:
+        return -1 if size > min_size else 0
+    return 0
+
+
+# The default number of classification results cached per worker and
+# cache generation (see _MatchCache).
+CACHE_SIZE = 2 ** 14
+
+
+# How long (in seconds) a session waits before handing its source room
+# off to the instance it belongs to.
+HAND_OFF_DELAY = 1.0
 
 
 class RoomGraphBot(bot.ServiceBot):
@@ -114,57 +512,253 @@ class RoomGraphBot(bot.ServiceBot):
         the number of worker processes used for rule matching
         (default: %default)
         """, default=1)
+    min_concurrency = bot.IntParam("""
+        let the number of worker processes shrink down to the given
+        number when the workers are idle (default: concurrency)
+        """, default=None)
+    max_concurrency = bot.IntParam("""
+        let the number of worker processes grow up to the given number
+        when the workers are busy (default: concurrency)
+        """, default=None)
+    autoscale_interval = bot.FloatParam("""
+        how often the number of worker processes is adjusted, when
+        min_concurrency or max_concurrency allow it (default: %default
+        seconds)
+        """, default=10.0)
+    xmpp_batch_size = bot.IntParam("""
+        pack up to the given number of events into one XMPP stanza
+        (default: %default)
+        """, default=1)
+    xmpp_batch_bytes = bot.IntParam("""
+        send a batch when its estimated size reaches the given number
+        of bytes (default: no size limit)
+        """, default=None)
+    xmpp_batch_interval = bot.FloatParam("""
+        wait at most the given amount of seconds for a batch to fill up
+        (default: %default seconds)
+        """, default=1.0)
+    xmpp_body = bot.Param("""
+        the body of sent XMPP stanzas: "full", "none" or the number of
+        key-value pairs shown in a truncated body (default: %default)
+        """, default="full")
+    xmpp_event_format = bot.Param("""
+        the encoding of events in sent XMPP stanzas: "legacy" is
+        understood by all receivers, "compact" is smaller and faster
+        but needs up-to-date receivers (default: %default)
+        """, default="legacy")
+    profile_rules = bot.BoolParam("""
+        measure how much time the worker processes spend evaluating
+        each rule and periodically log the most expensive rules
+        """)
+    profile_top = bot.IntParam("""
+        the number of the most expensive rules logged per period when
+        profiling rules (default: %default)
+        """, default=10)
+    ipc_batch_size = bot.IntParam("""
+        pack up to the given number of events into one message sent
+        to the worker processes, e.g. 100 for busy deployments: this
+        cuts the per-event overhead but delays each event by up to
+        ipc_batch_interval seconds (default: %default, no batching)
+        """, default=1)
+    ipc_batch_interval = bot.FloatParam("""
+        when ipc_batch_size is over 1, wait at most the given amount
+        of seconds for a worker message batch to fill up
+        (default: %default seconds)
+        """, default=0.01)
+    ipc_dispatch = bot.Param("""
+        how events are divided between the worker processes: "any"
+        (the first worker ready to receive), "least-in-flight" (the
+        worker with the fewest events waiting), "source-room" or
+        "event-digest" (events from the same source room or identical
+        events go to the same worker) (default: %default)
+        """, default="any")
+    classify_cache_size = bot.IntParam("""
+        the number of recent classification results each worker process
+        keeps cached for re-sent identical events, or 0 to disable
+        caching (default: %default)
+        """, default=CACHE_SIZE)
+    ordered = bot.BoolParam("""
+        keep the events from each source room in their original order
+        also when using several worker processes
+        """)
+    ordered_max_batches = bot.IntParam("""
+        the maximum number of worker message batches held back for
+        keeping the events in order (default: %default)
+        """, default=256)
+
+    # Run several roomgraph instances with the same bot name to divide
+    # the source rooms between them.
+    service_partition = "src_room"
 
     def __init__(self, *args, **keys):
         bot.ServiceBot.__init__(self, *args, **keys)
 
+        self._element_options = events.element_options(self.xmpp_body, self.xmpp_event_format)
+        if self.ipc_dispatch not in DISPATCH_STRATEGIES:
+            raise ValueError("unknown IPC dispatch strategy " + repr(self.ipc_dispatch))
+
+        self._min_workers = self.concurrency if self.min_concurrency is None else self.min_concurrency
+        self._max_workers = self.concurrency if self.max_concurrency is None else self.max_concurrency
+        if not 1 <= self._min_workers <= self.concurrency <= self._max_workers:
+            raise ValueError("expected 1 <= min_concurrency <= concurrency <= max_concurrency")
+
         self._rooms = taskfarm.TaskFarm(self._handle_room, grace_period=0.0)
         self._srcs = {}
         self._ready = idiokit.Event()
         self._stats = {}
+        self._rule_stats = {}
+        self._rule_origins = {}
+        self._workers = []
+        self._in_flight = {}
+        self._cache_hits = 0
+        self._cache_lookups = 0
+        self._reorder = None
+
+    def _inc_stats(self, room, seen=0, sent=0, dropped=0):
+        seen_count, sent_count, dropped_count = self._stats.get(room, (0, 0, 0))
+        self._stats[room] = seen_count + seen, sent_count + sent, dropped_count + dropped
+
+    def _inc_rule_stats(self, profile):
+        for src, rule, origins, evaluations, matches, seconds in profile:
+            key = src, rule
+            old_evaluations, old_matches, old_seconds = self._rule_stats.get(key, (0, 0, 0.0))
+            self._rule_stats[key] = old_evaluations + evaluations, old_matches + matches, old_seconds + seconds
+            self._rule_origins.setdefault(key, set()).update(origins)
+
+    def _log_rule_stats(self):
+        by_cost = sorted(self._rule_stats.iteritems(), key=lambda (_, stats): stats[2], reverse=True)
+
+        for key, (evaluations, matches, seconds) in by_cost[:self.profile_top]:
+            room, rule = key
 
-    def _inc_stats(self, room, seen=0, sent=0):
-        seen_count, sent_count = self._stats.get(room, (0, 0))
-        self._stats[room] = seen_count + seen, sent_count + sent
+            # The workers evaluate optimized rules. Report the session
+            # rules and destination rooms they were optimized from, as
+            # those are what the configuration contains.
+            origins = sorted((rules.format(x), unicode(dst)) for (x, dst) in self._rule_origins.get(key, ()))
+            sessions = [u"rule {0} to room {1}".format(x, dst) for (x, dst) in origins]
+            self.log.info(
+                u"Room {0}: {1} evaluated {2} times, matched {3} times, took {4:.3f} seconds".format(
+                    room, u"; ".join(sessions) or u"rule " + rules.format(rule), evaluations, matches, seconds),
+                event=events.Event({
+                    "type": "rule",
+                    "service": self.bot_name,
+                    "room": unicode(room),
+                    "rule": [x for (x, _) in origins],
+                    "dst_room": [dst for (_, dst) in origins],
+                    "session": sessions,
+                    "optimized_rule": rules.format(rule),
+                    "evaluations": unicode(evaluations),
+                    "matches": unicode(matches),
+                    "seconds": u"{0:.6f}".format(seconds)
+                })
+            )
+        self._rule_stats.clear()
+        self._rule_origins.clear()
+
+    def _log_cache_stats(self):
+        hits = self._cache_hits
+        lookups = self._cache_lookups
+        ratio = float(hits) / lookups if lookups else 0.0
+
+        self.log.info(
+            u"Worker cache: {0} hits in {1} lookups ({2:.1%})".format(hits, lookups, ratio),
+            event=events.Event({
+                "type": "cache",
+                "service": self.bot_name,
+                "hits": unicode(hits),
+                "lookups": unicode(lookups),
+                "hit ratio": u"{0:.3f}".format(ratio)
+            })
+        )
+        self._cache_hits = 0
+        self._cache_lookups = 0
 
     @idiokit.stream
     def _log_stats(self, interval=15.0):
         while True:
             yield idiokit.sleep(interval)
 
-            for room, (seen, sent) in self._stats.iteritems():
+            for room, (seen, sent, dropped) in self._stats.iteritems():
                 self.log.info(
-                    u"Room {0}: seen {1}, sent {2} events".format(room, seen, sent),
+                    u"Room {0}: seen {1}, sent {2} events, dropped {3} and forwarded {4} events before classification".format(
+                        room, seen, sent, dropped, seen - dropped),
                     event=events.Event({
                         "type": "room",
                         "service": self.bot_name,
                         "seen events": unicode(seen),
                         "sent events": unicode(sent),
+                        "dropped events": unicode(dropped),
+                        "forwarded events": unicode(seen - dropped),
                         "room": unicode(room)
                     })
                 )
             self._stats.clear()
 
+            for index, worker in enumerate(self._workers):
+                in_flight = self._in_flight.get(worker, 0)
+                self.log.info(
+                    u"Worker {0}: {1} events in flight".format(index, in_flight),
+                    event=events.Event({
+                        "type": "worker",
+                        "service": self.bot_name,
+                        "worker": unicode(index),
+                        "in flight events": unicode(in_flight)
+                    })
+                )
+
+            if self.classify_cache_size > 0:
+                self._log_cache_stats()
+
+            if self.profile_rules:
+                self._log_rule_stats()
+
     @idiokit.stream
     def _distribute(self):
         while True:
-            src, event, dsts = yield idiokit.next()
+            type_id, args = yield idiokit.next()
+            if type_id == "profile":
+                self._inc_rule_stats(args)
+                continue
+            elif type_id == "stopped":
+                yield self._retire(args)
+                continue
+            elif type_id != "matches":
+                raise RuntimeError("unknown type id {0!r}".format(type_id))
 
-            count = 0
-            for dst in dsts:
-                dst_room = self._rooms.get(dst)
-                if dst_room is not None:
-                    count += 1
-                    yield dst_room.send(event.to_elements())
+            batch_id, count, hits, matches = args
+            self._cache_hits += hits
+            self._cache_lookups += count
 
-            if count > 0:
-                self._inc_stats(src, sent=1)
+            if self._reorder is None:
+                released = [matches]
+            else:
+                released = self._reorder.complete(batch_id, matches)
+
+            for src, event, dsts in itertools.chain.from_iterable(released):
+                # Events sent to several rooms get converted to XML only once.
+                if len(dsts) > 1:
+                    event = events.FrozenEvent(event)
+
+                count = 0
+                for dst in dsts:
+                    dst_room = self._rooms.get(dst)
+                    if dst_room is not None:
+                        count += 1
+                        yield dst_room.send(event)
+
+                if count > 0:
+                    self._inc_stats(src, sent=1)
 
     @idiokit.stream
     def _handle_room(self, room_name):
         room = yield self.xmpp.muc.join(room_name, self.bot_name)
         distributor = yield self._ready.fork()
         yield idiokit.pipe(
+            events.events_to_elements(
+                self.xmpp_batch_size,
+                self.xmpp_batch_bytes,
+                self.xmpp_batch_interval,
+                options=self._element_options),
             room,
             idiokit.map(self._map, room_name),
             distributor.fork(),
@@ -172,15 +766,43 @@ class RoomGraphBot(bot.ServiceBot):
         )
 
     def _map(self, elements, room_name):
-        if room_name not in self._srcs:
+        key_filter = self._srcs.get(room_name, None)
+        if key_filter is None:
             return
 
         for event in events.Event.from_elements(elements):
+            # Don't bother the workers with events that can't match
+            # any of the room's rules.
+            if not key_filter.may_match(event):
+                self._inc_stats(room_name, seen=1, dropped=1)
+                continue
+
             self._inc_stats(room_name, seen=1)
             yield False, ("event", (room_name, event))
 
+    @idiokit.stream
+    def _hand_off(self, src_room):
+        lobby = getattr(self, "lobby", None)
+        if lobby is None:
+            # Without a lobby (e.g. a mock session) there is nobody to
+            # hand the room off to.
+            yield idiokit.consume()
+            idiokit.stop()
+
+        owner = yield lobby.moved(self.bot_name, src_room)
+
+        # The member that requested the session may not have seen the
+        # same providers as this one. Give its view time to catch up,
+        # so that the room doesn't bounce straight back here.
+        yield idiokit.sleep(HAND_OFF_DELAY)
+        owner = yield lobby.moved(self.bot_name, src_room)
+
+        self.log.info(u"Handing room {0!r} off to {1}".format(src_room, owner))
+        raise services.Stop()
+
     @idiokit.stream
     def session(self, _, src_room, dst_room, rule=None, **keys):
+        partition_key = src_room
         rule = rules.Anything() if rule is None else rules.rule(rule)
         src_room = yield self.xmpp.muc.get_full_room_jid(src_room)
         dst_room = yield self.xmpp.muc.get_full_room_jid(dst_room)
@@ -188,12 +810,13 @@ class RoomGraphBot(bot.ServiceBot):
         distributor = yield self._ready.fork()
         yield distributor.send(True, ("inc_rule", (src_room, rule, dst_room)))
         try:
-            self._srcs[src_room] = self._srcs.get(src_room, 0) + 1
+            key_filter = self._srcs.setdefault(src_room, rules.KeyFilter())
+            key_filter.inc(rule)
             try:
-                yield self._rooms.inc(src_room) | self._rooms.inc(dst_room)
+                yield self._rooms.inc(src_room) | self._rooms.inc(dst_room) | self._hand_off(partition_key)
             finally:
-                self._srcs[src_room] = self._srcs[src_room] - 1
-                if self._srcs[src_room] <= 0:
+                key_filter.dec(rule)
+                if key_filter.is_empty():
                     del self._srcs[src_room]
         finally:
             distributor.send(True, ("dec_rule", (src_room, rule, dst_room)))
@@ -201,6 +824,9 @@ class RoomGraphBot(bot.ServiceBot):
     def _start_worker(self):
         env = dict(os.environ)
         env["ABUSEHELPER_SUBPROCESS"] = ""
+        if self.profile_rules:
+            env["ABUSEHELPER_ROOMGRAPH_PROFILE"] = ""
+        env["ABUSEHELPER_ROOMGRAPH_CACHE_SIZE"] = str(self.classify_cache_size)
 
         # Find out the full package & module name. Don't refer to the
         # variable __loader__ directly to keep flake8 (version 2.5.0)
@@ -228,58 +854,328 @@ class RoomGraphBot(bot.ServiceBot):
             other_conn.close()
         return process, conn
 
+    def _add_worker(self):
+        process, conn = self._start_worker()
+        self._processes[conn] = process
+        self._workers.append(conn)
+        self._collected.append(conn)
+        self._in_flight[conn] = 0
+        return conn
+
+    def _cpu_usage(self, cpu_times, interval):
+        # Return the average share of CPU time the workers used during
+        # the last interval, or None if it could not be determined.
+
+        usages = []
+        for conn in self._workers:
+            pid = self._processes[conn].pid
+            seconds = _cpu_seconds(pid)
+            previous = cpu_times.get(pid, None)
+            if seconds is not None:
+                cpu_times[pid] = seconds
+            if seconds is not None and previous is not None:
+                usages.append((seconds - previous) / interval)
+
+        if not usages:
+            return None
+        return sum(usages) / len(usages)
+
+    @idiokit.stream
+    def _autoscale(self):
+        distributor = yield self._ready.fork()
+        cpu_times = {}
+        high_depth = 2 * max(self.ipc_batch_size, 1)
+
+        while True:
+            yield idiokit.sleep(self.autoscale_interval)
+
+            for process in list(self._retired):
+                if process.poll() is not None:
+                    self._retired.remove(process)
+
+            size = len(self._workers)
+            depth = sum(self._in_flight.get(x, 0) for x in self._workers) / float(size)
+            usage = self._cpu_usage(cpu_times, self.autoscale_interval)
+            change = scale(size, self._min_workers, self._max_workers, depth, usage, high_depth)
+
+            if change > 0:
+                conn = self._add_worker()
+                yield distributor.send(False, ("add_worker", conn))
+                self.log.info(u"Started a worker process, now running {0}".format(size + 1))
+            elif change < 0:
+                conn = self._workers.pop()
+                yield distributor.send(False, ("retire_worker", conn))
+                self.log.info(u"Retiring a worker process, now running {0}".format(size - 1))
+
+    @idiokit.stream
+    def _retire(self, conn):
+        # Called when a retired worker has answered all of its events.
+        self._retired.append(self._processes.pop(conn))
+        self._in_flight.pop(conn, None)
+        yield conn.close()
+
     @idiokit.stream
     def main(self, _):
-        processes = []
-        connections = []
+        self._processes = {}
+        self._collected = []
+        self._retired = []
+
         try:
             for _ in xrange(self.concurrency):
-                process, connection = self._start_worker()
-                processes.append(process)
-                connections.append(connection)
+                self._add_worker()
 
             if self.concurrency == 1:
                 self.log.info(u"Started 1 worker process")
             else:
                 self.log.info(u"Started {0} worker processes".format(self.concurrency))
 
-            self._ready.succeed(distribute_encode(connections))
-            yield collect_decode(connections) | self._distribute() | self._log_stats()
+            if self.ordered and self._max_workers > 1:
+                self._reorder = ReorderBuffer(self.ordered_max_batches)
+
+            autoscaling = self._min_workers < self._max_workers
+            # Check for added workers every now and then.
+            timeout = RESCAN_INTERVAL if autoscaling else None
+            collect = collect_decode(self._collected, self._in_flight, timeout=timeout)
+
+            self._ready.succeed(distribute_encode(
+                list(self._workers),
+                self.ipc_batch_size,
+                self.ipc_batch_interval,
+                self.ipc_dispatch,
+                self._in_flight,
+                self._reorder))
+
+            if autoscaling:
+                yield collect | self._distribute() | self._log_stats() | self._autoscale()
+            else:
+                yield collect | self._distribute() | self._log_stats()
         finally:
-            for connection in connections:
+            for connection in list(self._processes):
                 yield connection.close()
 
+            processes = list(self._processes.values()) + self._retired
             for process in processes:
                 process.terminate()
             for process in processes:
                 process.wait()
 
 
-def roomgraph(conn):
+# The number of recent events kept per source room for estimating the
+# selectivity of the subrules of newly added rules.
+SAMPLE_SIZE = 64
+
+# How often (in seconds) the workers report rule profiles, when enabled.
+PROFILE_INTERVAL = 5.0
+
+
+class _RuleOrigins(object):
+    """
+    Remember which configured rules and destination rooms the optimized
+    rules of each source room came from. Different sessions' rules may
+    optimize to the same rule, which then gets evaluated only once.
+
+    >>> origins = _RuleOrigins()
+    >>> origins.inc("src", "optimized", "rule", "dst")
+    >>> origins.inc("src", "optimized", "other rule", "other dst")
+    >>> origins.get("src", "optimized")
+    [('other rule', 'other dst'), ('rule', 'dst')]
+
+    The origins are counted, as several sessions may share the same
+    rule and destination room.
+
+    >>> origins.inc("src", "optimized", "rule", "dst")
+    >>> origins.dec("src", "optimized", "rule", "dst")
+    >>> origins.dec("src", "optimized", "other rule", "other dst")
+    >>> origins.get("src", "optimized")
+    [('rule', 'dst')]
+    >>> origins.dec("src", "optimized", "rule", "dst")
+    >>> origins.get("src", "optimized")
+    []
+    """
+
+    def __init__(self):
+        self._origins = {}
+
+    def inc(self, src, optimized, rule, dst):
+        counts = self._origins.setdefault((src, optimized), {})
+        counts[(rule, dst)] = counts.get((rule, dst), 0) + 1
+
+    def dec(self, src, optimized, rule, dst):
+        counts = self._origins.get((src, optimized), None)
+        if counts is None or (rule, dst) not in counts:
+            return
+
+        counts[(rule, dst)] -= 1
+        if counts[(rule, dst)] <= 0:
+            del counts[(rule, dst)]
+        if not counts:
+            del self._origins[(src, optimized)]
+
+    def get(self, src, optimized):
+        return sorted(self._origins.get((src, optimized), ()))
+
+
+def _send_profile(conn, srcs, origins):
+    profile = []
+    for src, classifier in srcs.iteritems():
+        for rule, (evaluations, matches, seconds) in classifier.pop_profile().iteritems():
+            profile.append((src, rule, origins.get(src, rule), evaluations, matches, seconds))
+
+    if profile:
+        send_encoded(conn, ("profile", profile))
+
+
+class _MatchCache(object):
+    """
+    Remember the destinations recently classified events matched, keyed
+    by their source room and digest. Like parsecache.ParseCache the cache
+    keeps two generations of at most max_size results.
+
+    >>> cache = _MatchCache(max_size=10)
+    >>> cache.get("src", "digest") is None
+    True
+    >>> cache.set("src", "digest", frozenset(["dst"]))
+    >>> cache.get("src", "digest")
+    frozenset(['dst'])
+    >>> cache.hits, cache.misses
+    (1, 1)
+
+    Invalidating a source room forgets its results, e.g. when its rules
+    change.
+
+    >>> cache.invalidate("src")
+    >>> cache.get("src", "digest") is None
+    True
+    """
+
+    def __init__(self, max_size=CACHE_SIZE):
+        self._max_size = max_size
+        self._current = {}
+        self._old = {}
+
+        # Invalidated results are not removed, but their keys contain
+        # an outdated version number and so never get looked up again.
+        self._versions = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, src, digest):
+        return src, self._versions.get(src, 0), digest
+
+    def get(self, src, digest):
+        key = self._key(src, digest)
+
+        result = self._current.get(key, None)
+        if result is None:
+            result = self._old.pop(key, None)
+            if result is not None:
+                self._store(key, result)
+
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def _store(self, key, result):
+        if len(self._current) >= self._max_size:
+            self._old = self._current
+            self._current = {}
+        self._current[key] = result
+
+    def set(self, src, digest, dsts):
+        self._store(self._key(src, digest), dsts)
+
+    def invalidate(self, src):
+        self._versions[src] = self._versions.get(src, 0) + 1
+
+
+def _classify(classifier, cache, src, event):
+    if cache is None:
+        return frozenset(classifier.classify(event))
+
+    digest = events.hexdigest(event)
+    dsts = cache.get(src, digest)
+    if dsts is None:
+        dsts = frozenset(classifier.classify(event))
+        cache.set(src, digest, dsts)
+    return dsts
+
+
+def roomgraph(conn, profile=False, cache_size=CACHE_SIZE):
+    """
+    Classify events for the parent process. The parent sends ("events",
+    (batch_id, [(src, event), ...])), ("inc_rule", (src, rule, dst)) and
+    ("dec_rule", (src, rule, dst)) messages, and finally a ("stop", None)
+    message that the worker answers with ("stopped", None) before
+    returning.
+
+    The worker answers each batch of events with a ("matches", (batch_id,
+    count, hits, [(src, event, dsts), ...])) message giving the number of
+    events in the batch, how many of them were found from the
+    classification cache (of up to cache_size results, or no cache when
+    cache_size is 0) and listing the events that matched some rules. When
+    profiling, the worker also sends periodic ("profile", [(src, rule,
+    origins, evaluations, matches, seconds), ...]) messages, where rule
+    is the optimized rule the worker evaluated and origins lists the
+    (rule, dst) pairs it was added for.
+    """
+
     srcs = {}
+    samples = {}
+    origins = _RuleOrigins()
+    cache = _MatchCache(cache_size) if cache_size > 0 else None
+    next_profile = time.time() + PROFILE_INTERVAL
 
     while True:
         type_id, args = recv_decoded(conn)
-        if type_id == "event":
-            src, event = args
-            if src in srcs:
-                dsts = set(srcs[src].classify(event))
-                if dsts:
-                    send_encoded(conn, (src, event, dsts))
+        if type_id == "events":
+            batch_id, args = args
+            matches = []
+            hits = cache.hits if cache is not None else 0
+            for src, event in args:
+                if src in srcs:
+                    samples[src].append(event)
+                    dsts = _classify(srcs[src], cache, src, event)
+                    if dsts:
+                        matches.append((src, event, dsts))
+            if cache is not None:
+                hits = cache.hits - hits
+            send_encoded(conn, ("matches", (batch_id, len(args), hits, matches)))
+        elif type_id == "stop":
+            send_encoded(conn, ("stopped", None))
+            return
         elif type_id == "inc_rule":
-            src, rule, dst = args
+            src, original, dst = args
+            rule = rules.optimize(original)
+            if profile:
+                origins.inc(src, rule, original, dst)
             if src not in srcs:
-                srcs[src] = rules.Classifier()
-            srcs[src].inc(rule, dst)
+                srcs[src] = rules.Classifier(profile=profile)
+                samples[src] = collections.deque(maxlen=SAMPLE_SIZE)
+            srcs[src].inc(rule, dst, optimizer.selectivity(rule, samples[src]))
+            if cache is not None:
+                cache.invalidate(src)
         elif type_id == "dec_rule":
-            src, rule, dst = args
+            src, original, dst = args
+            rule = rules.optimize(original)
+            if profile:
+                origins.dec(src, rule, original, dst)
+            if cache is not None:
+                cache.invalidate(src)
             if src in srcs:
                 srcs[src].dec(rule, dst)
                 if srcs[src].is_empty():
                     del srcs[src]
+                    del samples[src]
         else:
             raise RuntimeError("unknown type id {0!r}".format(type_id))
 
+        if profile and time.time() >= next_profile:
+            _send_profile(conn, srcs, origins)
+            next_profile = time.time() + PROFILE_INTERVAL
+
 
 if __name__ == "__main__":
     if "ABUSEHELPER_SUBPROCESS" in os.environ:
@@ -291,7 +1187,10 @@ if __name__ == "__main__":
             os.close(wfd)
 
             conn.setblocking(True)
-            roomgraph(conn)
+            roomgraph(
+                conn,
+                profile="ABUSEHELPER_ROOMGRAPH_PROFILE" in os.environ,
+                cache_size=int(os.environ.get("ABUSEHELPER_ROOMGRAPH_CACHE_SIZE", CACHE_SIZE)))
         except _ConnectionLost:
             pass
         finally:
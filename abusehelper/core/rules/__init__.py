@@ -1,11 +1,12 @@
-from .atoms import String, RegExp, IP, DomainName
+from .atoms import String, StringSet, RegExp, IP, IPSet, DomainName
 from .rules import Rule, And, Or, No, Match, NonMatch, Fuzzy, Anything
-from .classifier import Classifier
+from .classifier import Classifier, KeyFilter
+from .optimizer import optimize
 from .rulelang import rule, parse, format
 
 __all__ = [
-    "String", "RegExp", "IP", "DomainName",
+    "String", "StringSet", "RegExp", "IP", "IPSet", "DomainName",
     "Rule", "And", "Or", "No", "Match", "NonMatch", "Fuzzy", "Anything",
-    "Classifier",
+    "Classifier", "KeyFilter", "optimize",
     "rule", "parse", "format"
 ]
@@ -278,3 +278,119 @@ class Pattern(object):
         if len(name) < self._length:
             return False
         return _issubdomain(name, self._labels)
+
+
+class _Node(object):
+    __slots__ = ["children", "patterns"]
+
+    def __init__(self):
+        self.children = {}
+        self.patterns = {}
+
+
+class PatternIndex(object):
+    r"""
+    Map domain name patterns to items so that all items whose pattern
+    contains a given name can be found with one walk down a trie of
+    reversed labels.
+
+    >>> index = PatternIndex()
+    >>> index.add(Pattern(0, ["domain", "example"]), "a")
+    >>> index.add(Pattern(1, ["example"]), "b")
+    >>> index.add(Pattern(2, ["example"]), "c")
+    >>> sorted(index.find(["domain", "example"]))
+    ['a', 'b']
+    >>> sorted(index.find(["sub", "domain", "example"]))
+    ['a', 'b', 'c']
+    >>> sorted(index.find(["example"]))
+    []
+    >>> index.contains(["other", "example"])
+    True
+    """
+
+    def __init__(self):
+        self._items = {}
+        self._root = _Node()
+
+    def add(self, pattern, item):
+        items = self._items.get(pattern, None)
+        if items is None:
+            items = set()
+            self._items[pattern] = items
+
+            node = self._root
+            for label in reversed(pattern._labels):
+                child = node.children.get(label, None)
+                if child is None:
+                    child = _Node()
+                    node.children[label] = child
+                node = child
+            node.patterns.setdefault(pattern._free, set()).add(pattern)
+        items.add(item)
+
+    def discard(self, pattern, item):
+        r"""
+        >>> index = PatternIndex()
+        >>> index.add(Pattern(0, ["domain", "example"]), "a")
+        >>> index.discard(Pattern(0, ["domain", "example"]), "a")
+        >>> index.find(["domain", "example"])
+        set([])
+        >>> len(index), index._root.children
+        (0, {})
+        """
+
+        items = self._items.get(pattern, None)
+        if items is None:
+            return
+
+        items.discard(item)
+        if items:
+            return
+        del self._items[pattern]
+
+        path = []
+        node = self._root
+        for label in reversed(pattern._labels):
+            path.append((node, label))
+            node = node.children[label]
+
+        patterns = node.patterns[pattern._free]
+        patterns.discard(pattern)
+        if not patterns:
+            del node.patterns[pattern._free]
+
+        for parent, label in reversed(path):
+            child = parent.children[label]
+            if child.children or child.patterns:
+                break
+            del parent.children[label]
+
+    def _walk(self, name):
+        length = len(name)
+
+        node = self._root
+        depth = 0
+        for label in reversed(name):
+            node = node.children.get(label, None)
+            if node is None:
+                return
+            depth += 1
+
+            for free, patterns in node.patterns.iteritems():
+                if depth + free <= length:
+                    yield patterns
+
+    def find(self, name):
+        result = set()
+        for patterns in self._walk(name):
+            for pattern in patterns:
+                result.update(self._items[pattern])
+        return result
+
+    def contains(self, name):
+        for _ in self._walk(name):
+            return True
+        return False
+
+    def __len__(self):
+        return len(self._items)
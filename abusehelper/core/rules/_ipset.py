@@ -0,0 +1,295 @@
+"""
+Large sets of IP ranges, loaded from text files and shared between
+processes through memory-mapped files.
+
+The source file lists one IP address, CIDR block or IP range per line.
+Empty lines and lines starting with # are ignored. The ranges are merged
+and sorted into a binary table file stored in a directory of the
+current user's own under the temporary directory. The table is named
+after the source file's path, size and modification time, so all the
+user's processes loading the same version of the source file map the
+same table file and share its pages, instead of each keeping a copy of
+their own. Lookups use binary search over the table.
+
+Table names are predictable, so the directory and the table files are
+checked to be owned by the current user and not writable by others
+before they are used. Tables failing the check get rebuilt.
+
+>>> import os
+>>> import tempfile
+>>> fd, path = tempfile.mkstemp()
+>>> _ = os.write(fd, b"# comment\\n192.0.2.0/25\\n192.0.2.128-192.0.2.255\\n\\n2001:db8::/32\\n")
+>>> os.close(fd)
+>>> table = load(path)
+>>> len(table)
+2
+>>> table.contains(iprange.IPRange.from_autodetected("192.0.2.0/24"))
+True
+>>> table.contains(iprange.IPRange.from_autodetected("198.51.100.1"))
+False
+>>> table.close()
+>>> remove_tables(path)
+>>> os.remove(path)
+"""
+
+import os
+import mmap
+import stat
+import errno
+import bisect
+import struct
+import hashlib
+import tempfile
+
+from . import iprange
+
+
+_MAGIC = b"AHIPSET1"
+_HEADER = struct.Struct("!8sQQ")
+
+# Table entries are big-endian (first, last) pairs, so comparing the
+# packed first addresses as byte strings orders them numerically.
+_WIDTHS = {32: 4, 128: 16}
+
+
+def _pack_ip(ip_num, width):
+    if width == 4:
+        return struct.pack("!I", ip_num)
+    return struct.pack("!QQ", ip_num >> 64, ip_num & 0xffffffffffffffff)
+
+
+def _merge(ranges):
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            if last > merged[-1][1]:
+                merged[-1] = merged[-1][0], last
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def parse_file(path):
+    """
+    Return the ranges listed in the given file as a dict mapping each
+    address width in bits (32 or 128) to a list of merged (first, last)
+    pairs sorted by first address. Raise ValueError for unparseable lines.
+    """
+
+    ranges = {32: [], 128: []}
+    with open(path, "rb") as source:
+        for line_number, line in enumerate(source, 1):
+            line = line.strip()
+            if not line or line.startswith(b"#"):
+                continue
+
+            try:
+                range = iprange.IPRange.from_autodetected(line.decode("ascii"))
+            except (ValueError, UnicodeDecodeError):
+                raise ValueError("invalid IP range on line {0} of {1!r}".format(line_number, path))
+            ranges[range.version.max_bits].append((range.first, range.last))
+
+    return dict((bits, _merge(x)) for (bits, x) in ranges.iteritems())
+
+
+def _write_table(table_path, ranges):
+    directory = os.path.dirname(table_path)
+    fd, tmp_path = tempfile.mkstemp(prefix=".ipset-", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as table:
+            table.write(_HEADER.pack(_MAGIC, len(ranges[32]), len(ranges[128])))
+            for bits in (32, 128):
+                width = _WIDTHS[bits]
+                for first, last in ranges[bits]:
+                    table.write(_pack_ip(first, width) + _pack_ip(last, width))
+
+        # Renaming is atomic, so other processes either see the whole
+        # table or none of it.
+        os.rename(tmp_path, table_path)
+    except:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+# Every _FENCE_STEP'th first address of a table is kept in a list in
+# process memory, so that most of the binary search runs in C with bisect
+# over the list, and only the last few steps access the mapped file.
+_FENCE_STEP = 64
+
+
+class _Section(object):
+    # A read-only sequence view over the first addresses of the
+    # entries of one address width, suitable for bisect.
+
+    def __init__(self, data, offset, count, width):
+        self._data = data
+        self._offset = offset
+        self._count = count
+        self._width = width
+        self._fence = [self[x] for x in xrange(0, count, _FENCE_STEP)]
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        start = self._offset + 2 * self._width * index
+        return self._data[start:start + self._width]
+
+    def find(self, first):
+        # Return the index of the last entry whose first address is at
+        # most the given one, or -1 if there is no such entry.
+
+        block = bisect.bisect_right(self._fence, first) - 1
+        if block < 0:
+            return -1
+
+        lo = block * _FENCE_STEP
+        hi = min(lo + _FENCE_STEP, self._count)
+        return bisect.bisect_right(self, first, lo + 1, hi) - 1
+
+    def last(self, index):
+        start = self._offset + 2 * self._width * index + self._width
+        return self._data[start:start + self._width]
+
+
+class Table(object):
+    def __init__(self, data):
+        magic, v4_count, v6_count = _HEADER.unpack_from(data, 0)
+        if magic != _MAGIC:
+            raise ValueError("not an IP set table")
+
+        offset = _HEADER.size
+        self._data = data
+        self._sections = {
+            32: _Section(data, offset, v4_count, _WIDTHS[32]),
+            128: _Section(data, offset + 2 * _WIDTHS[32] * v4_count, v6_count, _WIDTHS[128])
+        }
+
+    def __len__(self):
+        return sum(len(x) for x in self._sections.itervalues())
+
+    def contains(self, range):
+        bits = range.version.max_bits
+        section = self._sections[bits]
+        width = _WIDTHS[bits]
+
+        index = section.find(_pack_ip(range.first, width))
+        if index < 0:
+            return False
+        return section.last(index) >= _pack_ip(range.last, width)
+
+    def close(self):
+        self._data.close()
+
+
+def _is_private(info, file_type):
+    # Owned by the current user and writable by nobody else.
+    return (
+        file_type(info.st_mode) and
+        info.st_uid == os.getuid() and
+        not info.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+    )
+
+
+_directory = None
+
+
+def _table_directory():
+    global _directory
+
+    if _directory is not None:
+        return _directory
+
+    directory = os.path.join(tempfile.gettempdir(), "abusehelper-ipset-{0}".format(os.getuid()))
+    try:
+        os.mkdir(directory, 0o700)
+    except OSError as error:
+        if error.errno != errno.EEXIST:
+            raise
+
+    info = os.lstat(directory)
+    if not _is_private(info, stat.S_ISDIR) or info.st_mode & 0o077:
+        # Someone else got to the shared name first. Keep the tables in
+        # a private directory of this process instead.
+        directory = tempfile.mkdtemp(prefix="abusehelper-ipset-")
+
+    _directory = directory
+    return directory
+
+
+def _table_prefix(path):
+    path = os.path.abspath(path)
+    if isinstance(path, unicode):
+        path = path.encode("utf-8")
+    digest = hashlib.sha1(path).hexdigest()
+    return os.path.join(_table_directory(), "abusehelper-ipset-" + digest + "-")
+
+
+def table_path(path, stat):
+    """
+    Return the path of the table file for the given source path and its
+    os.stat result.
+    """
+
+    return _table_prefix(path) + "{0}-{1}".format(stat.st_size, int(stat.st_mtime * 1000))
+
+
+def _open_table(shared_path):
+    # Return the opened table file, or None if it doesn't exist or
+    # can't be trusted.
+
+    try:
+        table_file = open(shared_path, "rb")
+    except IOError as error:
+        if error.errno != errno.ENOENT:
+            raise
+        return None
+
+    if not _is_private(os.fstat(table_file.fileno()), stat.S_ISREG):
+        table_file.close()
+        return None
+    return table_file
+
+
+def remove_tables(path, keep=None):
+    """
+    Remove the table files built for the given source path, except for
+    the one named by keep. Processes that still have a removed table
+    mapped keep using it.
+    """
+
+    directory, name_prefix = os.path.split(_table_prefix(path))
+    for name in os.listdir(directory):
+        stale = os.path.join(directory, name)
+        if not name.startswith(name_prefix) or stale == keep:
+            continue
+        try:
+            os.remove(stale)
+        except OSError:
+            pass
+
+
+def load(path, stat=None):
+    """
+    Return a Table for the given source file, building the shared table
+    file first unless some process has already built it.
+    """
+
+    if stat is None:
+        stat = os.stat(path)
+
+    shared_path = table_path(path, stat)
+    table_file = _open_table(shared_path)
+    if table_file is None:
+        _write_table(shared_path, parse_file(path))
+        remove_tables(path, keep=shared_path)
+
+        table_file = _open_table(shared_path)
+        if table_file is None:
+            raise ValueError("could not create a trusted IP set table for " + repr(path))
+
+    with table_file:
+        return Table(mmap.mmap(table_file.fileno(), 0, access=mmap.ACCESS_READ))
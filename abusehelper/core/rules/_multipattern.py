@@ -0,0 +1,298 @@
+r"""
+Match a string against many regular expressions with few passes.
+
+RegExpIndex maps RegExp atoms to items. Atoms with plain literal patterns
+(such as the ones created with RegExp.from_string) are merged into an
+Aho-Corasick automaton that finds all of them in a single pass. The rest
+are grouped into alternations of named groups, each checked with a single
+search.
+
+>>> from .atoms import RegExp
+>>> index = RegExpIndex()
+>>> index.add(RegExp.from_string("evil"), "a")
+>>> index.add(RegExp.from_string("EVIL", ignore_case=True), "b")
+>>> index.add(RegExp("^[0-9]+$"), "c")
+>>> sorted(index.find(u"the evil one"))
+['a', 'b']
+>>> sorted(index.find(u"The Evil One"))
+['b']
+>>> sorted(index.find(u"123"))
+['c']
+>>> index.contains(u"good")
+False
+"""
+
+import re
+import string
+
+
+# Python 2's re module supports only 100 groups per regular expression.
+_MAX_GROUPS = 99
+
+_METACHARACTERS = frozenset(".^$*+?{}[]|()")
+
+# Only a backslash followed by an ASCII letter or digit has a special
+# meaning (such as \d or \1). re.escape escapes all other characters,
+# including non-ASCII letters.
+_SPECIAL_ESCAPES = frozenset(string.ascii_letters + string.digits)
+
+# Patterns using these constructs depend on their group numbering, group
+# names or global flags, so they can't be combined with others.
+_UNCOMBINABLE_REX = re.compile(r"\\[1-9]|\(\?P|\(\?\(|\(\?[iLmsux]")
+
+
+def _literal(pattern):
+    r"""
+    Return the string a pattern matches if the pattern is a plain
+    literal, None otherwise.
+
+    >>> _literal(re.escape(u"a.b"))
+    u'a.b'
+    >>> _literal(re.escape(u"\xe4"))
+    u'\xe4'
+    >>> _literal(u"a\\d")
+    >>> _literal(u"a|b")
+    >>> _literal(u"")
+    """
+
+    chars = []
+
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        if char == u"\\":
+            index += 1
+            if index >= len(pattern) or pattern[index] in _SPECIAL_ESCAPES:
+                return None
+            char = pattern[index]
+        elif char in _METACHARACTERS:
+            return None
+        chars.append(char)
+        index += 1
+
+    if not chars:
+        return None
+    return u"".join(chars)
+
+
+class _AhoCorasick(object):
+    def __init__(self, words):
+        goto = [{}]
+        outputs = [set()]
+
+        for word, output in words:
+            state = 0
+            for char in word:
+                next_state = goto[state].get(char, None)
+                if next_state is None:
+                    next_state = len(goto)
+                    goto[state][char] = next_state
+                    goto.append({})
+                    outputs.append(set())
+                state = next_state
+            outputs[state].add(output)
+
+        fail = [0] * len(goto)
+        queue = list(goto[0].values())
+        while queue:
+            state = queue.pop(0)
+            for char, next_state in goto[state].iteritems():
+                queue.append(next_state)
+
+                fallback = fail[state]
+                while fallback and char not in goto[fallback]:
+                    fallback = fail[fallback]
+                fail[next_state] = goto[fallback].get(char, 0)
+                outputs[next_state].update(outputs[fail[next_state]])
+
+        self._goto = goto
+        self._fail = fail
+        self._outputs = [frozenset(x) for x in outputs]
+
+    def _states(self, text):
+        goto = self._goto
+        fail = self._fail
+
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            yield state
+
+    def find(self, text):
+        outputs = self._outputs
+
+        result = set()
+        for state in self._states(text):
+            if outputs[state]:
+                result.update(outputs[state])
+        return result
+
+    def contains(self, text):
+        outputs = self._outputs
+
+        for state in self._states(text):
+            if outputs[state]:
+                return True
+        return False
+
+
+def _alternation_groups(pattern, flags):
+    # The number of groups an atom's pattern takes in an _Alternation.
+    return 2 * re.compile(pattern, flags).groups + 1
+
+
+class _Alternation(object):
+    def __init__(self, atoms, flags):
+        any_pattern = u"|".join(u"(?:{0})".format(x.pattern) for x in atoms)
+        self._any = re.compile(any_pattern, flags)
+
+        # At each position where some pattern matches, every pattern is
+        # tried in a lookahead of its own and captures a group when it
+        # matches. Scanning the positions once reveals all the matching
+        # patterns, not just the leftmost one.
+        self._all = re.compile(
+            u"(?={0})".format(any_pattern) +
+            u"".join(u"(?:(?=(?P<_{0}>{1}))|)".format(i, x.pattern) for (i, x) in enumerate(atoms)),
+            flags)
+        self._groups = [(self._all.groupindex["_" + str(i)], x) for (i, x) in enumerate(atoms)]
+
+    def find(self, text):
+        first = self._any.search(text)
+        if first is None:
+            return ()
+
+        result = []
+        groups = self._groups
+        for match in self._all.finditer(text, first.start()):
+            missing = []
+            for group in groups:
+                if match.start(group[0]) >= 0:
+                    result.append(group[1])
+                else:
+                    missing.append(group)
+
+            groups = missing
+            if not groups:
+                break
+        return result
+
+    def contains(self, text):
+        return self._any.search(text) is not None
+
+
+class _Matchers(object):
+    def __init__(self, atoms):
+        literals = []
+        folded = []
+        regexps = {}
+        self._others = []
+
+        for atom in atoms:
+            literal = _literal(atom.pattern)
+            if literal is not None and atom.ignore_case:
+                folded.append((literal.lower(), atom))
+            elif literal is not None:
+                literals.append((literal, atom))
+            elif _UNCOMBINABLE_REX.search(atom.pattern):
+                self._others.append(atom)
+            else:
+                regexps.setdefault(atom.ignore_case, []).append(atom)
+
+        self._literals = _AhoCorasick(literals) if literals else None
+        self._folded = _AhoCorasick(folded) if folded else None
+
+        self._alternations = []
+        for ignore_case, group in regexps.iteritems():
+            flags = re.U | re.S | (re.I if ignore_case else 0)
+
+            chunk = []
+            groups = 0
+            for atom in group:
+                atom_groups = _alternation_groups(atom.pattern, flags)
+                if chunk and groups + atom_groups > _MAX_GROUPS:
+                    self._add_alternation(chunk, flags)
+                    chunk = []
+                    groups = 0
+                chunk.append(atom)
+                groups += atom_groups
+            if chunk:
+                self._add_alternation(chunk, flags)
+
+    def _add_alternation(self, atoms, flags):
+        if len(atoms) == 1:
+            self._others.extend(atoms)
+            return
+
+        try:
+            self._alternations.append(_Alternation(atoms, flags))
+        except (re.error, AssertionError, OverflowError):
+            self._others.extend(atoms)
+
+    def find(self, text):
+        result = set()
+        if self._literals is not None:
+            result.update(self._literals.find(text))
+        if self._folded is not None:
+            result.update(self._folded.find(text.lower()))
+        for alternation in self._alternations:
+            result.update(alternation.find(text))
+        for atom in self._others:
+            if atom.match(text):
+                result.add(atom)
+        return result
+
+    def contains(self, text):
+        if self._literals is not None and self._literals.contains(text):
+            return True
+        if self._folded is not None and self._folded.contains(text.lower()):
+            return True
+        for alternation in self._alternations:
+            if alternation.contains(text):
+                return True
+        for atom in self._others:
+            if atom.match(text):
+                return True
+        return False
+
+
+class RegExpIndex(object):
+    def __init__(self):
+        self._items = dict()
+        self._matchers = None
+
+    def add(self, atom, item):
+        items = self._items.get(atom, None)
+        if items is None:
+            items = set()
+            self._items[atom] = items
+            self._matchers = None
+        items.add(item)
+
+    def discard(self, atom, item):
+        items = self._items.get(atom, None)
+        if items is None:
+            return
+
+        items.discard(item)
+        if not items:
+            del self._items[atom]
+            self._matchers = None
+
+    def _get_matchers(self):
+        if self._matchers is None:
+            self._matchers = _Matchers(self._items)
+        return self._matchers
+
+    def find(self, text):
+        result = set()
+        for atom in self._get_matchers().find(text):
+            result.update(self._items[atom])
+        return result
+
+    def contains(self, text):
+        return self._get_matchers().contains(text)
+
+    def __len__(self):
+        return len(self._items)
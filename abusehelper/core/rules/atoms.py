@@ -1,13 +1,64 @@
 from __future__ import absolute_import, unicode_literals
 
+import os
 import re
+import time
+import logging
 
 from . import core
 from . import iprange
+from . import _ipset
 from . import _domainname
+from . import _multipattern
+from .. import parsecache
+
+
+_log = logging.getLogger(__name__)
+
+
+def _parse_ip_range(value):
+    try:
+        return iprange.IPRange.from_autodetected(value)
+    except ValueError:
+        return None
+
+
+_ip_ranges = parsecache.cache("ip range", _parse_ip_range)
+_domain_names = parsecache.cache("domain name", _domainname.parse_name)
+
+
+def parse_ip_range(value):
+    """
+    Return the value parsed into an IP range, or None if the value is
+    not an IP address, a CIDR or an IP range. The results are cached.
+    """
+
+    return _ip_ranges(value)
+
+
+def parse_domain_name(value):
+    """
+    Return the value parsed into a tuple of domain name labels, or None
+    if the value is not a domain name. The results are cached.
+    """
+
+    return _domain_names(value)
 
 
 class Atom(core.Matcher):
+    # Atoms that can be looked up from an index instead of matching them
+    # one by one define the index type (with add, discard, find and
+    # contains methods), the value put into the index and how to parse
+    # the looked up values.
+    index_type = None
+
+    def index_key(self):
+        return None
+
+    @classmethod
+    def parse_indexed(cls, value):
+        return None
+
     def match(self, value):
         return False
 
@@ -39,7 +90,56 @@ class String(Atom):
         return cls(value)
 
 
+class StringSet(Atom):
+    """
+    Match any of the given strings exactly.
+
+    >>> StringSet(["1", "2"]).match("2")
+    True
+    >>> StringSet(["1", "2"]).match("3")
+    False
+    >>> StringSet(["2", "1"]) is StringSet(["1", "2", "1"])
+    True
+    """
+
+    def init(self, values):
+        Atom.init(self)
+
+        if isinstance(values, basestring):
+            raise TypeError("expected an iterable of strings, got a string")
+        self._values = frozenset(unicode(x) for x in values)
+
+    def unique_key(self):
+        return self._values
+
+    def __repr__(self):
+        return Atom.__repr__(self, sorted(self._values))
+
+    @property
+    def values(self):
+        return self._values
+
+    def match(self, value):
+        return value in self._values
+
+    def dump(self):
+        return sorted(self._values)
+
+    @classmethod
+    def load(cls, values):
+        return cls(values)
+
+
 class RegExp(Atom):
+    index_type = _multipattern.RegExpIndex
+
+    def index_key(self):
+        return self
+
+    @classmethod
+    def parse_indexed(cls, value):
+        return value
+
     _forbidden_flags = [
         (re.X, "re.X / re.VERBOSE"),
         (re.M, "re.M / re.MULTILINE"),
@@ -97,6 +197,15 @@ class RegExp(Atom):
 
 
 class IP(Atom):
+    index_type = iprange.IPRangeIndex
+
+    def index_key(self):
+        return self._range
+
+    @classmethod
+    def parse_indexed(cls, value):
+        return parse_ip_range(value)
+
     @property
     def range(self):
         return self._range
@@ -121,9 +230,8 @@ class IP(Atom):
         return unicode(self._range)
 
     def match(self, value):
-        try:
-            range = iprange.IPRange.from_autodetected(value)
-        except ValueError:
+        range = _ip_ranges(value)
+        if range is None:
             return False
         return self._range.contains(range)
 
@@ -135,7 +243,92 @@ class IP(Atom):
         return cls(value)
 
 
+class IPSet(Atom):
+    """
+    Match IP addresses and ranges contained in the IP ranges listed in a
+    file, one IP address, CIDR block or IP range per line (see _ipset).
+
+    Only the path gets pickled. Processes loading the same file share the
+    loaded ranges through a memory-mapped table file. The file is checked
+    for changes (and reloaded when it has changed) at most once per
+    check_interval seconds. When the file can not be loaded the error gets
+    logged and the previously loaded ranges are kept, and nothing matches
+    until the first load succeeds.
+    """
+
+    check_interval = 5.0
+
+    @property
+    def path(self):
+        return self._path
+
+    def init(self, path):
+        Atom.init(self)
+
+        self._path = os.path.abspath(path)
+        self._table = None
+        self._version = None
+        self._checked = None
+        self._error = None
+
+    def unique_key(self):
+        return self._path
+
+    def __repr__(self):
+        return Atom.__repr__(self, self._path)
+
+    def _current_table(self):
+        now = time.time()
+        if self._checked is not None and self._checked <= now < self._checked + self.check_interval:
+            return self._table
+        self._checked = now
+
+        try:
+            stat = os.stat(self._path)
+            version = stat.st_size, stat.st_mtime
+            if version != self._version:
+                table = _ipset.load(self._path, stat)
+                if self._table is not None:
+                    self._table.close()
+                self._table = table
+                self._version = version
+        except (IOError, OSError, ValueError) as error:
+            # Log each distinct error once instead of every check_interval.
+            if repr(error) != self._error:
+                self._error = repr(error)
+                _log.error("Could not load IP set %r: %r", self._path, error)
+        else:
+            self._error = None
+        return self._table
+
+    def match(self, value):
+        range = _ip_ranges(value)
+        if range is None:
+            return False
+
+        table = self._current_table()
+        if table is None:
+            return False
+        return table.contains(range)
+
+    def dump(self):
+        return self._path
+
+    @classmethod
+    def load(cls, path):
+        return cls(path)
+
+
 class DomainName(Atom):
+    index_type = _domainname.PatternIndex
+
+    def index_key(self):
+        return self._pattern
+
+    @classmethod
+    def parse_indexed(cls, value):
+        return parse_domain_name(value)
+
     @property
     def pattern(self):
         return self._pattern
@@ -157,7 +350,7 @@ class DomainName(Atom):
         return unicode(self._pattern)
 
     def match(self, value):
-        name = _domainname.parse_name(value)
+        name = _domain_names(value)
         if name is None:
             return False
         return self._pattern.contains(name)
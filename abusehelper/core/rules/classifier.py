@@ -1,12 +1,197 @@
+from __future__ import absolute_import
+
+import time
+
+from . import atoms
+from . import rules
+from . import compiler
+
+
+def _key_value(rule):
+    key = rule.key
+    if not isinstance(key, atoms.String):
+        return None
+
+    value = rule.value
+    if type(rule) is rules.Match:
+        if isinstance(value, (atoms.String, atoms.StringSet)) or _indexable(value):
+            return key.value, value
+    return key.value, None
+
+
+def _indexable(atom):
+    return getattr(atom, "index_type", None) is not None
+
+
+def _guard_cost(guard):
+    presences = 0
+    lookups = 0
+    for _, value in guard:
+        if value is None:
+            presences += 1
+        elif not isinstance(value, atoms.String):
+            lookups += 1
+    return presences, lookups, len(guard)
+
+
+def guard(rule):
+    """
+    Return a set of (key, value) pairs out of which at least one must be
+    present in an event for the given rule to match. The value is either
+    a String atom (the key must have that exact value), an indexable atom
+    such as IP or DomainName (the key must have a value matching the atom)
+    or None (it is enough for the key to be present with any value).
+    A key of None means that any key or value of the event has to match
+    the atom, as with Fuzzy rules. Return None when no such set can be
+    determined for the rule.
+
+    >>> sorted(guard(rules.Match("a", "b")))
+    [(u'a', String(u'b'))]
+    >>> sorted(guard(rules.NonMatch("a", "b")))
+    [(u'a', None)]
+    >>> sorted(guard(rules.Or(rules.Match("a", "b"), rules.Match("c"))))
+    [(u'a', String(u'b')), (u'c', None)]
+    >>> sorted(guard(rules.And(rules.Match("a"), rules.Match("c", atoms.IP("192.0.2.0/24")))))
+    [(u'c', IP(u'192.0.2.0/24'))]
+    >>> sorted((k, v.value) for (k, v) in guard(rules.Match("a", atoms.StringSet(["b", "c"]))))
+    [(u'a', u'b'), (u'a', u'c')]
+    >>> sorted(guard(rules.Fuzzy(atoms.String("a"))))
+    [(None, RegExp(u'a', ignore_case=True))]
+    >>> guard(rules.No(rules.Match("a", "b"))) is None
+    True
+    """
+
+    if isinstance(rule, rules.Fuzzy):
+        if not _indexable(rule.matcher):
+            return None
+        return frozenset([(None, rule.matcher)])
+
+    if isinstance(rule, rules.Match):
+        pair = _key_value(rule)
+        if pair is None:
+            return None
+
+        key, value = pair
+        if isinstance(value, atoms.StringSet):
+            return frozenset((key, atoms.String(x)) for x in value.values)
+        return frozenset([pair])
+
+    if isinstance(rule, rules.Or):
+        result = set()
+        for subrule in rule.subrules:
+            subguard = guard(subrule)
+            if subguard is None:
+                return None
+            result.update(subguard)
+        return frozenset(result)
+
+    if isinstance(rule, rules.And):
+        best = None
+        for subrule in rule.subrules:
+            subguard = guard(subrule)
+            if subguard is None:
+                continue
+            if best is None or _guard_cost(subguard) < _guard_cost(best):
+                best = subguard
+        return best
+
+    return None
+
+
 class Classifier(object):
-    def __init__(self):
+    """
+    Map objects to classes based on the rules registered for each class.
+
+    Rules are indexed by the key-value pairs an event must contain for
+    them to match (see guard), so that classify only evaluates the rules
+    that can possibly match the given event. Indexable atoms (such as IP
+    ranges and domain name patterns) are kept in per-key indexes of the
+    atom's index type. The rules are evaluated
+    using their compiled versions (see compiler.compile), optionally
+    ordered by the selectivity given to inc (see optimizer.selectivity).
+
+    >>> from ..events import Event
+    >>> c = Classifier()
+    >>> c.inc(rules.Match("a", "b"), "X")
+    >>> c.inc(rules.No(rules.Match("a", "b")), "Y")
+    >>> sorted(c.classify(Event(a="b")))
+    ['X']
+    >>> sorted(c.classify(Event(a="c")))
+    ['Y']
+
+    With profile=True the Classifier also keeps count of how many times
+    each rule has been evaluated, how many times it matched and how much
+    time the evaluations took (see pop_profile).
+    """
+
+    def __init__(self, profile=False):
         self._rules = dict()
+        self._compiled = dict()
+        self._profile = dict() if profile else None
+
+        self._index = dict()
+        self._atom_indexes = dict()
+        self._residual = set()
+
+    def _add_to_index(self, rule):
+        rule_guard = guard(rule)
+        if rule_guard is None:
+            self._residual.add(rule)
+            return
+
+        for key, value in rule_guard:
+            if value is not None and not isinstance(value, atoms.String):
+                indexes = self._atom_indexes.setdefault(key, dict())
+                atom_type = type(value)
+                atom_index = indexes.get(atom_type, None)
+                if atom_index is None:
+                    atom_index = atom_type.index_type()
+                    indexes[atom_type] = atom_index
+                atom_index.add(value.index_key(), rule)
+                continue
 
-    def inc(self, rule, class_id):
+            pair = key, (None if value is None else value.value)
+            bucket = self._index.get(pair, None)
+            if bucket is None:
+                bucket = set()
+                self._index[pair] = bucket
+            bucket.add(rule)
+
+    def _remove_from_index(self, rule):
+        rule_guard = guard(rule)
+        if rule_guard is None:
+            self._residual.discard(rule)
+            return
+
+        for key, value in rule_guard:
+            if value is not None and not isinstance(value, atoms.String):
+                indexes = self._atom_indexes.get(key, None)
+                atom_index = indexes and indexes.get(type(value), None)
+                if atom_index is None:
+                    continue
+
+                atom_index.discard(value.index_key(), rule)
+                if not len(atom_index):
+                    del indexes[type(value)]
+                    if not indexes:
+                        del self._atom_indexes[key]
+                continue
+
+            pair = key, (None if value is None else value.value)
+            bucket = self._index.get(pair, None)
+            if bucket is None:
+                continue
+            bucket.discard(rule)
+            if not bucket:
+                del self._index[pair]
+
+    def inc(self, rule, class_id, selectivity=None):
         classes = self._rules.get(rule, None)
         if classes is None:
             classes = dict()
             self._rules[rule] = classes
+            self._compiled[rule] = compiler.compile(rule, selectivity)
+            self._add_to_index(rule)
         classes[class_id] = classes.get(class_id, 0) + 1
 
     def dec(self, rule, class_id):
@@ -21,19 +206,199 @@ class Classifier(object):
             classes.pop(class_id, None)
             if not classes:
                 self._rules.pop(rule, None)
+                self._compiled.pop(rule, None)
+                self._remove_from_index(rule)
+
+    def _candidates(self, obj):
+        index = self._index
+        atom_indexes = self._atom_indexes
+        if not index and not atom_indexes:
+            return self._residual
+
+        candidates = set(self._residual)
+
+        indexes = atom_indexes.get(None, None)
+        if indexes is not None:
+            texts = list(obj.keys())
+            texts.extend(obj.values())
+            for atom_type, atom_index in indexes.iteritems():
+                for text in texts:
+                    parsed = atom_type.parse_indexed(text)
+                    if parsed is not None:
+                        candidates.update(atom_index.find(parsed))
+
+        for key in obj.keys():
+            bucket = index.get((key, None), None)
+            if bucket is not None:
+                candidates.update(bucket)
+
+            values = obj.values(key)
+            for value in values:
+                bucket = index.get((key, value), None)
+                if bucket is not None:
+                    candidates.update(bucket)
+
+            indexes = atom_indexes.get(key, None)
+            if indexes is not None:
+                for atom_type, atom_index in indexes.iteritems():
+                    for value in values:
+                        parsed = atom_type.parse_indexed(value)
+                        if parsed is not None:
+                            candidates.update(atom_index.find(parsed))
+        return candidates
 
     def classify(self, obj):
+        if self._profile is not None:
+            return self._classify_profiled(obj)
+
         result = set()
-        cache = dict()
 
-        for rule, classes in self._rules.iteritems():
+        for rule in self._candidates(obj):
+            classes = self._rules[rule]
             if result.issuperset(classes):
                 continue
 
-            if rule.match(obj, cache):
+            if self._compiled[rule](obj):
                 result.update(classes)
 
         return result
 
+    def _classify_profiled(self, obj):
+        result = set()
+        profile = self._profile
+
+        for rule in self._candidates(obj):
+            classes = self._rules[rule]
+            if result.issuperset(classes):
+                continue
+
+            start = time.time()
+            matched = self._compiled[rule](obj)
+            elapsed = time.time() - start
+
+            evaluations, matches, seconds = profile.get(rule, (0, 0, 0.0))
+            profile[rule] = evaluations + 1, matches + int(matched), seconds + elapsed
+
+            if matched:
+                result.update(classes)
+
+        return result
+
+    def pop_profile(self):
+        """
+        Return a dict mapping rules to (evaluations, matches, seconds)
+        tuples collected since the previous call, and start collecting
+        anew. Return an empty dict when profiling is not enabled.
+
+        >>> from ..events import Event
+        >>> c = Classifier(profile=True)
+        >>> c.inc(rules.Match("a", "b"), "X")
+        >>> c.classify(Event(a="b"))
+        set(['X'])
+        >>> evaluations, matches, seconds = c.pop_profile()[rules.Match("a", "b")]
+        >>> evaluations, matches
+        (1, 1)
+        >>> c.pop_profile()
+        {}
+        """
+
+        if self._profile is None:
+            return {}
+
+        profile = self._profile
+        self._profile = dict()
+        return profile
+
+    def is_empty(self):
+        return not self._rules
+
+
+class KeyFilter(object):
+    """
+    A cheap and conservative check for whether an object may match any
+    of a set of rules. Each rule requires the object to contain at least
+    one of a few keys, possibly with specific values (see guard), so an
+    object containing none of them can't match any of the rules.
+
+    >>> from ..events import Event
+    >>> f = KeyFilter()
+    >>> f.inc(rules.Match("a", "b"))
+    >>> f.inc(rules.Match("c", atoms.IP("192.0.2.0/24")))
+    >>> f.may_match(Event(a="b")), f.may_match(Event(a="x")), f.may_match(Event(c="x"))
+    (True, False, True)
+
+    A rule without such keys (such as a negation) may match any object.
+
+    >>> f.inc(rules.No(rules.Match("a", "b")))
+    >>> f.may_match(Event(x="y"))
+    True
+    """
+
+    def __init__(self):
+        self._rules = dict()
+        self._pairs = dict()
+        self._unguarded = 0
+
+    def _required(self, rule):
+        rule_guard = guard(rule)
+        if rule_guard is None:
+            return None
+
+        # Indexable atoms are too costly to check here, so settle for
+        # requiring the key.
+        required = set()
+        for key, value in rule_guard:
+            if key is None:
+                return None
+            if isinstance(value, atoms.String):
+                required.add((key, value.value))
+            else:
+                required.add((key, None))
+        return frozenset(required)
+
+    def inc(self, rule):
+        count, required = self._rules.get(rule, (0, None))
+        if count == 0:
+            required = self._required(rule)
+            if required is None:
+                self._unguarded += 1
+            else:
+                for pair in required:
+                    self._pairs[pair] = self._pairs.get(pair, 0) + 1
+        self._rules[rule] = count + 1, required
+
+    def dec(self, rule):
+        count, required = self._rules.get(rule, (0, None))
+        if count == 0:
+            return
+        if count > 1:
+            self._rules[rule] = count - 1, required
+            return
+
+        del self._rules[rule]
+        if required is None:
+            self._unguarded -= 1
+            return
+
+        for pair in required:
+            pair_count = self._pairs[pair] - 1
+            if pair_count > 0:
+                self._pairs[pair] = pair_count
+            else:
+                del self._pairs[pair]
+
+    def may_match(self, obj):
+        if self._unguarded > 0:
+            return True
+
+        pairs = self._pairs
+        for key in obj.keys():
+            if (key, None) in pairs:
+                return True
+            for value in obj.values(key):
+                if (key, value) in pairs:
+                    return True
+        return False
+
     def is_empty(self):
         return not self._rules
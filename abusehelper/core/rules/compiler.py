@@ -0,0 +1,253 @@
+"""
+Compile rule trees into flat Python functions.
+
+Matching a rule with Rule.match walks the rule tree recursively and
+records the result of each subrule into a cache dictionary. For typical
+rules most of the time goes to these calls and dictionary operations
+instead of the actual matching. The compiler generates the source code
+for one function per rule, with And, Or and No turned into Python's
+own boolean operators and the common Match forms turned into direct
+lookups. Alternative matches against indexable atoms (such as IP ranges
+or domain name patterns) for the same key are merged into index lookups.
+The subrules of And and Or rules are evaluated in the order given by
+optimizer.order.
+
+>>> from ..events import Event
+>>> match = compile(rules.And(rules.Match("a", "1"), rules.No(rules.Match("b"))))
+>>> match(Event(a="1"))
+True
+>>> match(Event(a="1", b="2"))
+False
+"""
+
+from __future__ import absolute_import
+
+from . import atoms
+from . import rules
+from . import optimizer
+
+
+def _store(slots, index, value):
+    value = bool(value)
+    slots[index] = value
+    return value
+
+
+def _index_group(rule):
+    # Return a (key, atom type) pair for rules that can be looked up from
+    # an index, None otherwise. Fuzzy rules get None as their key.
+
+    if type(rule) is rules.Fuzzy:
+        atom = rule.matcher
+        key = None
+    elif type(rule) is rules.Match and isinstance(rule.key, atoms.String):
+        atom = rule.value
+        key = rule.key.value
+    else:
+        return None
+
+    if getattr(atom, "index_type", None) is None:
+        return None
+    return key, type(atom)
+
+
+def _index_atom(rule):
+    if type(rule) is rules.Fuzzy:
+        return rule.matcher
+    return rule.value
+
+
+def _texts(attrs):
+    texts = list(attrs)
+    for values in attrs.itervalues():
+        texts.extend(values)
+    return texts
+
+
+def _in_index(atom_type, atom_index):
+    parse = atom_type.parse_indexed
+
+    def _in_index(values):
+        for value in values:
+            parsed = parse(value)
+            if parsed is not None and atom_index.contains(parsed):
+                return True
+        return False
+    return _in_index
+
+
+# Python's parser does not cope with deeply nested expressions, so leave
+# the deepest rule trees uncompiled.
+_MAX_DEPTH = 32
+
+
+class _Compiler(object):
+    def __init__(self, selectivity=None):
+        self._namespace = {"_store": _store}
+        self._constants = {}
+
+        self._selectivity = selectivity
+        self._costs = {}
+
+        self._counts = {}
+        self._slots = {}
+        self._depth = 0
+
+    def _constant(self, obj):
+        name = self._constants.get(id(obj), None)
+        if name is None:
+            name = "_k{0}".format(len(self._constants))
+            self._constants[id(obj)] = name
+            self._namespace[name] = obj
+        return name
+
+    def _count(self, rule, depth=1):
+        self._depth = max(self._depth, depth)
+        if depth > _MAX_DEPTH:
+            return
+
+        count = self._counts.get(rule, 0)
+        self._counts[rule] = count + 1
+        if count > 0:
+            return
+
+        if isinstance(rule, rules.And):
+            for subrule in rule.subrules:
+                self._count(subrule, depth + 1)
+        elif isinstance(rule, rules.No):
+            self._count(rule.subrule, depth + 1)
+
+    def _expr(self, rule):
+        code, shareable = self._node(rule)
+        if not shareable or self._counts[rule] < 2:
+            return code
+
+        index = self._slots.get(rule, None)
+        if index is None:
+            index = len(self._slots)
+            self._slots[rule] = index
+        return "(_slots[{0}] if _slots[{0}] is not None else _store(_slots, {0}, {1}))".format(index, code)
+
+    def _node(self, rule):
+        # Return the expression code for the rule and whether the
+        # expression is costly enough to be worth sharing.
+
+        if isinstance(rule, rules.Or):
+            return "(" + " or ".join(self._or_exprs(rule)) + ")", True
+
+        if isinstance(rule, rules.And):
+            return "(" + " and ".join(self._expr(x) for x in self._order(rule)) + ")", True
+
+        if isinstance(rule, rules.No):
+            return "(not " + self._expr(rule.subrule) + ")", False
+
+        if type(rule) is rules.Anything:
+            return "True", False
+
+        if type(rule) in (rules.Match, rules.NonMatch):
+            key = rule.key
+            value = rule.value
+
+            if key is None:
+                if value is None:
+                    return "_contains()", False
+                return "_contains(filter={0})".format(self._constant(rule.filter)), True
+
+            if isinstance(key, atoms.String):
+                key = self._constant(key.value)
+                if value is None:
+                    return "({0} in _attrs)".format(key), False
+                if type(rule) is rules.Match and isinstance(value, atoms.String):
+                    return "({0} in _get({1}, ()))".format(self._constant(value.value), key), False
+                if type(rule) is rules.Match and isinstance(value, atoms.StringSet):
+                    return "(not {0}.isdisjoint(_get({1}, ())))".format(self._constant(value.values), key), False
+                return "_contains({0}, filter={1})".format(key, self._constant(rule.filter)), True
+
+        return "{0}(event)".format(self._constant(rule.match)), True
+
+    def _order(self, rule):
+        return optimizer.order(rule, self._selectivity, self._costs)
+
+    def _or_exprs(self, rule):
+        # Alternative matches against indexable atoms of the same type
+        # and for the same key get merged into a single index lookup,
+        # evaluated at the position of the group's first member.
+
+        exprs = []
+        groups = {}
+        for subrule in self._order(rule):
+            group = _index_group(subrule)
+            if group is None or self._counts[subrule] > 1:
+                exprs.append(self._expr(subrule))
+            elif group in groups:
+                groups[group].append(subrule)
+            else:
+                groups[group] = [subrule]
+                exprs.append(group)
+
+        for index, group_key in enumerate(exprs):
+            if isinstance(group_key, tuple):
+                exprs[index] = self._group_expr(group_key, groups[group_key])
+        return exprs
+
+    def _group_expr(self, (key, atom_type), group):
+        if len(group) == 1:
+            return self._expr(group[0])
+
+        atom_index = atom_type.index_type()
+        for subrule in group:
+            atom_index.add(_index_atom(subrule).index_key(), subrule)
+
+        func = self._constant(_in_index(atom_type, atom_index))
+        if key is None:
+            return "{0}({1}(_attrs))".format(func, self._constant(_texts))
+        return "{0}(_get({1}, ()))".format(func, self._constant(key))
+
+    def compile(self, rule):
+        self._count(rule)
+        if self._depth > _MAX_DEPTH:
+            return rule.match
+        code = self._expr(rule)
+
+        lines = ["def _match(event):"]
+        lines.append("    _attrs = getattr(event, '_attrs', None)")
+        lines.append("    if _attrs is None:")
+        lines.append("        return bool({0}(event))".format(self._constant(rule.match)))
+        lines.append("    _get = _attrs.get")
+        lines.append("    _contains = event.contains")
+        if self._slots:
+            lines.append("    _slots = [None] * {0}".format(len(self._slots)))
+        lines.append("    return bool({0})".format(code))
+
+        exec "\n".join(lines) in self._namespace
+        return self._namespace["_match"]
+
+
+def compile(rule, selectivity=None):
+    """
+    Return a function that takes an event and returns whether the given
+    rule matches the event. The optional selectivity is passed on to
+    optimizer.order.
+
+    Subrules appearing several times in the rule are evaluated at most
+    once per call.
+
+    >>> from ..events import Event
+    >>> shared = rules.Match("a", atoms.RegExp("x"))
+    >>> match = compile(rules.Or(rules.And(shared, rules.Match("b")), rules.And(shared, rules.Match("c"))))
+    >>> match(Event(a="x", c="1"))
+    True
+    >>> match(Event(a="x"))
+    False
+
+    Fall back to Rule.match for rules that are too deeply nested to be
+    compiled.
+
+    >>> rule = rules.Match("a", "1")
+    >>> for _ in range(100):
+    ...     rule = rules.No(rule)
+    >>> compile(rule)(Event(a="1"))
+    True
+    """
+
+    return _Compiler(selectivity).compile(rule)
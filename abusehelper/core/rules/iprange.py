@@ -192,6 +192,34 @@ class IPRange(object):
         self._last = last
         self._hash = None
 
+    @property
+    def version(self):
+        return self._version
+
+    @property
+    def first(self):
+        return self._first
+
+    @property
+    def last(self):
+        return self._last
+
+    def cidr_blocks(self):
+        max_bits = self._version.max_bits
+
+        first = self._first
+        last = self._last
+        while first <= last:
+            bits = max_bits
+            while bits > 0:
+                size = 1 << (max_bits - bits + 1)
+                if first & (size - 1) or first + size - 1 > last:
+                    break
+                bits -= 1
+
+            yield first >> (max_bits - bits), bits
+            first += 1 << (max_bits - bits)
+
     def __hash__(self):
         if self._hash is None:
             self._hash = hash((self.__class__, self._version, self._first, self._last))
@@ -234,3 +262,104 @@ class IPRange(object):
             return first_str + u"/" + unicode(repr(bits))
 
         return first_str + u"-" + unicode(self._version.format(self._last))
+
+
+class IPRangeIndex(object):
+    """
+    Map IP ranges to items so that all items whose range contains a given
+    IP range can be found with roughly one lookup per prefix length in use.
+    The contains method just checks whether there are any such items.
+
+    Each range is split into CIDR blocks. The blocks are kept in one hash
+    table per version and prefix length, which amounts to a flattened
+    radix tree: looking up an address walks the tables from the shortest
+    prefix to the longest, like walking down the tree along the address's
+    bits.
+    """
+
+    def __init__(self):
+        self._items = dict()
+        self._tables = dict()
+        self._lengths = dict()
+
+    def add(self, range, item):
+        items = self._items.get(range, None)
+        if items is None:
+            items = set()
+            self._items[range] = items
+
+            tables = self._tables.setdefault(range.version, dict())
+            for prefix, bits in range.cidr_blocks():
+                table = tables.get(bits, None)
+                if table is None:
+                    table = dict()
+                    tables[bits] = table
+                    self._lengths[range.version] = sorted(tables)
+                table.setdefault(prefix, set()).add(range)
+        items.add(item)
+
+    def discard(self, range, item):
+        items = self._items.get(range, None)
+        if items is None:
+            return
+
+        items.discard(item)
+        if items:
+            return
+        del self._items[range]
+
+        tables = self._tables[range.version]
+        for prefix, bits in range.cidr_blocks():
+            table = tables[bits]
+            ranges = table[prefix]
+            ranges.discard(range)
+            if ranges:
+                continue
+
+            del table[prefix]
+            if table:
+                continue
+
+            del tables[bits]
+            self._lengths[range.version] = sorted(tables)
+
+    def contains(self, range):
+        version = range.version
+        tables = self._tables.get(version, None)
+        if not tables:
+            return False
+
+        max_bits = version.max_bits
+        first = range.first
+        for bits in self._lengths[version]:
+            ranges = tables[bits].get(first >> (max_bits - bits), None)
+            if ranges is None:
+                continue
+
+            for candidate in ranges:
+                if candidate.contains(range):
+                    return True
+        return False
+
+    def find(self, range):
+        result = set()
+
+        version = range.version
+        tables = self._tables.get(version, None)
+        if not tables:
+            return result
+
+        max_bits = version.max_bits
+        first = range.first
+        for bits in self._lengths[version]:
+            ranges = tables[bits].get(first >> (max_bits - bits), None)
+            if ranges is None:
+                continue
+
+            for candidate in ranges:
+                if candidate.contains(range):
+                    result.update(self._items[candidate])
+        return result
+
+    def __len__(self):
+        return len(self._items)
@@ -0,0 +1,261 @@
+"""
+Rewrite rules into equivalent but cheaper forms, and order subrules so
+that the cheap and decisive ones get evaluated first.
+
+optimize flattens nested And and Or rules, folds constants (such as
+Anything() inside And and Or, double negations and contradictions) and
+merges alternative exact matches for the same key into a single StringSet
+match. Duplicate subrules disappear as And and Or keep their subrules in
+sets.
+
+>>> rule = rules.And(rules.Match("a", "1"), rules.And(rules.Anything(), rules.No(rules.No(rules.Match("b")))))
+>>> optimize(rule) == rules.And(rules.Match("a", "1"), rules.Match("b"))
+True
+>>> optimize(rules.Or(rules.Match("a", "1"), rules.Match("a", "2")))
+Match(u'a', StringSet([u'1', u'2']))
+>>> optimize(rules.And(rules.Match("a"), rules.No(rules.Match("a"))))
+No(Anything())
+
+And and Or evaluate their subrules in no particular order. order returns
+the subrules of an And or Or rule in the order they should be evaluated
+(see compiler.compile), based on their estimated cost and, when given,
+their observed selectivity (see selectivity).
+
+>>> order(rules.Or(rules.Fuzzy(atoms.String("x")), rules.Match("a", "1")))
+[Match(u'a', u'1'), Fuzzy(String(u'x'))]
+"""
+
+from __future__ import absolute_import
+
+from . import atoms
+from . import rules
+
+
+NOTHING = rules.No(rules.Anything())
+
+
+def _children(rule):
+    if type(rule) in (rules.And, rules.Or):
+        return list(rule.subrules)
+    if type(rule) is rules.No:
+        return [rule.subrule]
+    return []
+
+
+def _flatten(rule_type, subrules):
+    flat = set()
+    for subrule in subrules:
+        if type(subrule) is rule_type:
+            flat.update(subrule.subrules)
+        else:
+            flat.add(subrule)
+    return flat
+
+
+def _contradicts(subrules):
+    for subrule in subrules:
+        if type(subrule) is rules.No and subrule.subrule in subrules:
+            return True
+    return False
+
+
+def _exact_values(rule):
+    if type(rule) is not rules.Match or not isinstance(rule.key, atoms.String):
+        return None
+    if isinstance(rule.value, atoms.String):
+        return [rule.value.value]
+    if isinstance(rule.value, atoms.StringSet):
+        return rule.value.values
+    return None
+
+
+def _merge_exact(subrules):
+    # Match(k, "1") or Match(k, "2") is the same as Match(k, {"1", "2"}).
+
+    by_key = {}
+    for subrule in subrules:
+        if _exact_values(subrule) is not None:
+            by_key.setdefault(subrule.key, []).append(subrule)
+
+    for key, group in by_key.iteritems():
+        if len(group) < 2:
+            continue
+
+        values = set()
+        for subrule in group:
+            subrules.discard(subrule)
+            values.update(_exact_values(subrule))
+        subrules.add(rules.Match(key, atoms.StringSet(values)))
+
+
+def _rewrite(rule, children):
+    rule_type = type(rule)
+
+    if rule_type is rules.No:
+        child, = children
+        if type(child) is rules.No:
+            return child.subrule
+        return rules.No(child)
+
+    if rule_type is rules.And:
+        subrules = _flatten(rules.And, children)
+        subrules.discard(rules.Anything())
+        if NOTHING in subrules or _contradicts(subrules):
+            return NOTHING
+        if not subrules:
+            return rules.Anything()
+        if len(subrules) == 1:
+            return subrules.pop()
+        return rules.And(*subrules)
+
+    if rule_type is rules.Or:
+        subrules = _flatten(rules.Or, children)
+        subrules.discard(NOTHING)
+        if rules.Anything() in subrules or _contradicts(subrules):
+            return rules.Anything()
+        _merge_exact(subrules)
+        if not subrules:
+            return NOTHING
+        if len(subrules) == 1:
+            return subrules.pop()
+        return rules.Or(*subrules)
+
+    return rule
+
+
+def optimize(rule):
+    """
+    Return a rule that matches exactly the same objects as the given
+    rule, with the rule tree simplified.
+
+    >>> optimize(rules.Or(rules.Match("a", "1"), rules.No(rules.Anything())))
+    Match(u'a', u'1')
+    """
+
+    # Walk the tree iteratively, as rule trees can be deeper than the
+    # recursion limit.
+    done = {}
+    stack = [rule]
+    while stack:
+        node = stack[-1]
+        if node in done:
+            stack.pop()
+            continue
+
+        children = _children(node)
+        pending = [x for x in children if x not in done]
+        if pending:
+            stack.extend(pending)
+            continue
+
+        stack.pop()
+        done[node] = _rewrite(node, [done[x] for x in children])
+    return done[rule]
+
+
+def cost(rule, _cache=None):
+    """
+    Return a rough estimate of the relative cost of matching the rule
+    against an event.
+    """
+
+    if _cache is None:
+        _cache = {}
+
+    result = _cache.get(rule, None)
+    if result is not None:
+        return result
+
+    rule_type = type(rule)
+    if rule_type in (rules.And, rules.Or):
+        result = sum(cost(x, _cache) for x in rule.subrules)
+    elif rule_type is rules.No:
+        result = cost(rule.subrule, _cache)
+    elif rule_type is rules.Anything:
+        result = 0
+    elif rule_type in (rules.Match, rules.NonMatch):
+        value = rule.value
+        if rule.key is None:
+            # Every value of the event may need to be checked.
+            result = 8
+        elif value is None or rule_type is rules.Match and isinstance(value, (atoms.String, atoms.StringSet)):
+            result = 1
+        elif isinstance(value, atoms.RegExp):
+            result = 4
+        else:
+            result = 2
+    elif rule_type is rules.Fuzzy:
+        # Every key and value of the event may need to be checked.
+        result = 16
+    else:
+        result = 8
+
+    _cache[rule] = result
+    return result
+
+
+# The assumed probability of a subrule matching, when not observed.
+_DEFAULT_SELECTIVITY = 0.5
+
+
+def order(rule, selectivity=None, _costs=None):
+    """
+    Return the subrules of the given And or Or rule in the order they
+    should be evaluated.
+
+    And rules can stop at the first non-matching subrule, so cheap
+    subrules that rarely match come first. Or rules can stop at the first
+    matching subrule, so cheap subrules that often match come first. The
+    optional selectivity is a mapping from subrules to the observed
+    probability of them matching.
+    """
+
+    if selectivity is None:
+        selectivity = {}
+    if _costs is None:
+        _costs = {}
+
+    def _key(subrule):
+        matching = selectivity.get(subrule, _DEFAULT_SELECTIVITY)
+        if type(rule) is rules.And:
+            decisive = 1.0 - matching
+        else:
+            decisive = matching
+        return cost(subrule, _costs) / max(decisive, 0.01)
+
+    return sorted(rule.subrules, key=_key)
+
+
+def selectivity(rule, sample):
+    """
+    Return a dict mapping the rule and each of its subrules to the
+    fraction of objects in the sample they match, smoothed so that small
+    samples don't give probabilities of exactly 0 or 1.
+
+    >>> from ..events import Event
+    >>> observed = selectivity(rules.Match("a"), [Event(a="1"), Event(b="1")])
+    >>> observed[rules.Match("a")]
+    0.5
+    """
+
+    sample = list(sample)
+    if not sample:
+        return {}
+
+    nodes = set()
+    stack = [rule]
+    while stack:
+        node = stack.pop()
+        if node not in nodes:
+            nodes.add(node)
+            stack.extend(_children(node))
+
+    counts = dict.fromkeys(nodes, 0)
+    for obj in sample:
+        cache = {}
+        for node in nodes:
+            if node.match(obj, cache):
+                counts[node] += 1
+
+    total = float(len(sample) + 2)
+    return dict((node, (count + 1) / total) for (node, count) in counts.iteritems())
@@ -54,6 +54,7 @@ formatter = Formatter()
 
 
 unquoted_rex = re.compile(r"([^\s\\\(\)\"\*!=/]+)")
+set_item_rex = re.compile(r"([^\s\\\(\)\"\*!=/,\{\}]+)")
 quoted_rex = re.compile(r'("(?:\\u[0-9a-fA-F]{4}|\\[\\"/fbnrt]|[^\\"])*")')
 
 
@@ -104,6 +105,62 @@ def format_string(format, string):
         yield json.dumps(value)
 
 
+@parser_singleton
+def stringset_parser((string, start, end), ws_chars=frozenset(" \t\n\r")):
+    if not start < end or string[start] != "{":
+        yield None, None
+    start += 1
+
+    values = []
+    while True:
+        while start < end and string[start] in ws_chars:
+            start += 1
+        if not start < end:
+            yield None, None
+
+        if string[start] == "}" and not values:
+            start += 1
+            break
+
+        if string[start] == '"':
+            match = quoted_rex.match(string, start, end)
+            if not match:
+                yield None, None
+            values.append(json.loads(match.group(1)))
+        else:
+            match = set_item_rex.match(string, start, end)
+            if not match:
+                yield None, None
+            values.append(match.group(1))
+        start = match.end()
+
+        while start < end and string[start] in ws_chars:
+            start += 1
+        if not start < end:
+            yield None, None
+
+        if string[start] == "}":
+            start += 1
+            break
+        if string[start] != ",":
+            yield None, None
+        start += 1
+
+    yield None, (atoms.StringSet(values), (string, start, end))
+
+
+@formatter.handler(atoms.StringSet)
+def format_stringset(format, stringset):
+    items = []
+    for value in sorted(stringset.values):
+        match = set_item_rex.match(value)
+        if match and match.end() == len(value):
+            items.append(value)
+        else:
+            items.append(json.dumps(value))
+    yield "{" + ", ".join(items) + "}"
+
+
 ip_parser = transform(atoms.IP, iprange.IPRange.parser)
 
 
@@ -115,6 +172,11 @@ def format_ip(format, ip):
 domainname_parser = transform(atoms.DomainName, _domainname.pattern_parser)
 
 
+@formatter.handler(atoms.IPSet)
+def format_ipset(format, ipset):
+    yield "ipset(" + json.dumps(ipset.path) + ")"
+
+
 @formatter.handler(atoms.DomainName)
 def format_domainname(format, name):
     yield unicode(name.pattern)
@@ -154,7 +216,7 @@ def format_fuzzy(format, fuzzy):
 @formatter.handler(rules.NonMatch)
 def format_non_match(format, obj):
     yield format(obj.key) if obj.key is not None else "*"
-    if isinstance(obj.value, atoms.IP):
+    if isinstance(obj.value, (atoms.IP, atoms.IPSet, atoms.StringSet)):
         yield " not in "
     else:
         yield "!="
@@ -164,7 +226,7 @@ def format_non_match(format, obj):
 @formatter.handler(rules.Match)
 def format_match(format, obj):
     yield format(obj.key) if obj.key is not None else "*"
-    if isinstance(obj.value, atoms.IP):
+    if isinstance(obj.value, (atoms.IP, atoms.IPSet, atoms.StringSet)):
         yield " in "
     else:
         yield "="
@@ -236,14 +298,19 @@ def _create_parser():
             start += 1
         yield None, (None, (string, start, end))
 
+    ipset_parser = transform(
+        lambda path: atoms.IPSet(path.value),
+        seq(txt("ipset", ignore_case=True), maybe(ws), txt("("), maybe(ws), string_parser, maybe(ws), txt(")"), pick=4)
+    )
+
     match_tail = union(
         seq(maybe(ws), txt("="), maybe(txt("=")), maybe(ws), union(star_parser, regexp_parser, string_parser), pick=-1),
-        seq(ws, txt("in", ignore_case=True), ws, union(ip_parser, domainname_parser), pick=-1),
+        seq(ws, txt("in", ignore_case=True), ws, union(stringset_parser, ipset_parser, ip_parser, domainname_parser), pick=-1),
     )
 
     non_match_tail = union(
         seq(maybe(ws), txt("!="), maybe(ws), union(star_parser, regexp_parser, string_parser), pick=-1),
-        seq(ws, txt("not", ignore_case=True), ws, txt("in", ignore_case=True), ws, union(ip_parser, domainname_parser), pick=-1),
+        seq(ws, txt("not", ignore_case=True), ws, txt("in", ignore_case=True), ws, union(stringset_parser, ipset_parser, ip_parser, domainname_parser), pick=-1),
     )
 
     basic = union(
@@ -162,9 +162,18 @@ class Fuzzy(Rule):
     def atom(self):
         return self._atom
 
+    @property
+    def matcher(self):
+        return self._matcher
+
     def init(self, atom):
         Rule.init(self)
 
+        # Sets have no syntax of their own in the rule language, they can
+        # only be used with "in" and "not in" (Match and NonMatch).
+        if isinstance(atom, (atoms.StringSet, atoms.IPSet)):
+            raise TypeError("{0} can not be used with Fuzzy".format(type(atom).__name__))
+
         self._atom = atom
 
         if isinstance(atom, atoms.String):
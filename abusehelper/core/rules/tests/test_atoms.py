@@ -1,10 +1,15 @@
 from __future__ import unicode_literals
 
+import os
 import re
 import pickle
+import shutil
+import logging
+import tempfile
 import unittest
 
-from ..atoms import String, RegExp, IP, DomainName
+from .. import _ipset, atoms
+from ..atoms import String, StringSet, RegExp, IP, IPSet, DomainName
 
 
 class TestString(unittest.TestCase):
@@ -25,6 +30,33 @@ class TestString(unittest.TestCase):
             self.assertEqual(option, eval(repr(option)))
 
 
+class TestStringSet(unittest.TestCase):
+    def test_matching(self):
+        self.assertTrue(StringSet(["a", "b"]).match("b"))
+        self.assertFalse(StringSet(["a", "b"]).match("B"))
+        self.assertFalse(StringSet([]).match(""))
+
+    def test_constructor_rejects_plain_strings(self):
+        self.assertRaises(TypeError, StringSet, "ab")
+
+    def test_equality(self):
+        self.assertEqual(StringSet(["a", "b"]), StringSet(("b", "a", "a")))
+        self.assertNotEqual(StringSet(["a", "b"]), StringSet(["a"]))
+
+    _options = [
+        StringSet([]),
+        StringSet(["a", "b c", "\xe4"])
+    ]
+
+    def test_pickling_and_unpickling(self):
+        for option in self._options:
+            self.assertEqual(option, pickle.loads(pickle.dumps(option)))
+
+    def test_repr(self):
+        for option in self._options:
+            self.assertEqual(option, eval(repr(option)))
+
+
 class TestRegExp(unittest.TestCase):
     def test_from_string(self):
         self.assertEqual(
@@ -118,6 +150,92 @@ class TestIP(unittest.TestCase):
             self.assertEqual(option, eval(repr(option)))
 
 
+class TestIPSet(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "ranges.txt")
+        self._write(["# networks", "192.0.2.0/25", "", "192.0.2.128-192.0.2.200", "2001:db8::/32"], 1000)
+
+    def tearDown(self):
+        _ipset.remove_tables(self.path)
+        shutil.rmtree(self.directory)
+
+    def _write(self, lines, mtime):
+        with open(self.path, "wb") as ranges:
+            ranges.write("\n".join(lines).encode("ascii"))
+        os.utime(self.path, (mtime, mtime))
+
+    def test_matching(self):
+        ipset = IPSet(self.path)
+        self.assertTrue(ipset.match("192.0.2.0"))
+        self.assertTrue(ipset.match("192.0.2.0-192.0.2.200"))
+        self.assertTrue(ipset.match("2001:db8::1"))
+        self.assertFalse(ipset.match("192.0.2.201"))
+        self.assertFalse(ipset.match("192.0.2.0/24"))
+        self.assertFalse(ipset.match("198.51.100.1"))
+        self.assertFalse(ipset.match("not an ip"))
+
+    def test_reloads_changed_files(self):
+        ipset = IPSet(self.path)
+        ipset.check_interval = 0.0
+        self.assertTrue(ipset.match("192.0.2.1"))
+
+        self._write(["198.51.100.0/24"], 2000)
+        self.assertFalse(ipset.match("192.0.2.1"))
+        self.assertTrue(ipset.match("198.51.100.1"))
+
+    def test_keeps_previous_ranges_when_reloading_fails(self):
+        ipset = IPSet(self.path)
+        ipset.check_interval = 0.0
+        self.assertTrue(ipset.match("192.0.2.1"))
+
+        self._write(["198.51.100.0/24", "invalid"], 2000)
+        self.assertTrue(ipset.match("192.0.2.1"))
+
+    def test_load_errors_are_logged_once(self):
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+
+        logger = logging.getLogger(atoms.__name__)
+        logger.addHandler(handler)
+        try:
+            ipset = IPSet(os.path.join(self.directory, "missing.txt"))
+            ipset.check_interval = 0.0
+            self.assertFalse(ipset.match("192.0.2.1"))
+            self.assertFalse(ipset.match("192.0.2.1"))
+        finally:
+            logger.removeHandler(handler)
+        self.assertEqual(1, len(records))
+
+    def test_table_directory_is_private(self):
+        _ipset.load(self.path).close()
+
+        info = os.stat(os.path.dirname(_ipset.table_path(self.path, os.stat(self.path))))
+        self.assertEqual(os.getuid(), info.st_uid)
+        self.assertEqual(0, info.st_mode & 0o077)
+
+    def test_untrusted_tables_are_rebuilt(self):
+        shared_path = _ipset.table_path(self.path, os.stat(self.path))
+        _ipset._write_table(shared_path, {32: [(0, 2 ** 32 - 1)], 128: []})
+        os.chmod(shared_path, 0o666)
+
+        table = _ipset.load(self.path)
+        try:
+            self.assertEqual(2, len(table))
+        finally:
+            table.close()
+        self.assertEqual(0, os.stat(shared_path).st_mode & 0o022)
+
+    def test_pickling_and_unpickling(self):
+        ipset = IPSet(self.path)
+        self.assertEqual(ipset, pickle.loads(pickle.dumps(ipset)))
+
+    def test_repr(self):
+        ipset = IPSet(self.path)
+        self.assertEqual(ipset, eval(repr(ipset)))
+
+
 class TestDomainName(unittest.TestCase):
     def test_non_wildcard_label_should_(self):
         self.assertTrue(DomainName("domain.example").match("domain.example"))
@@ -1,8 +1,11 @@
 from __future__ import unicode_literals
 
+import re
 import unittest
+import itertools
 from ...events import Event
 
+from .. import atoms
 from .. import rules
 from .. import classifier
 
@@ -31,3 +34,142 @@ class TestClassifier(unittest.TestCase):
         c.dec(rules.Match("a", "b"), "Y")
         self.assertEqual([], sorted(c.classify(Event(a="b"))))
         self.assertTrue(c.is_empty())
+
+    def test_indexed_rules_classify_like_unindexed(self):
+        matchers = [
+            rules.Match("a", "1"),
+            rules.Match("a", "2"),
+            rules.Match("b"),
+            rules.Match("b", re.compile("^[12]$")),
+            rules.Match("ip", atoms.IP("192.0.2.0/24")),
+            rules.Match("ip", atoms.IP("192.0.2.0-192.0.2.10")),
+            rules.Match("domain", atoms.DomainName("*.example")),
+            rules.Match("domain", atoms.DomainName("domain.example")),
+            rules.NonMatch("a", "1"),
+            rules.No(rules.Match("a", "1")),
+            rules.Fuzzy(atoms.String("2")),
+            rules.Fuzzy(atoms.String("EXAMPLE")),
+            rules.Fuzzy(atoms.RegExp("^[ab]$")),
+            rules.Fuzzy(atoms.IP("192.0.2.0/28")),
+            rules.Match("domain", atoms.RegExp("sub\\.")),
+            rules.Match("a", atoms.StringSet(["2", "3"])),
+            rules.NonMatch("a", atoms.StringSet(["1"])),
+            rules.Or(rules.Match("b", atoms.StringSet(["1"])), rules.Match("c", atoms.StringSet(["2", "x"]))),
+            rules.Anything()
+        ]
+        events = [
+            Event(),
+            Event(a="1"),
+            Event(a=["1", "2"]),
+            Event(b="1"),
+            Event(a="3", b="x"),
+            Event(c="2"),
+            Event(ip="192.0.2.5"),
+            Event(ip=["192.0.2.100", "x"], a="1"),
+            Event(domain="domain.example"),
+            Event(domain=["example", "sub.other.example"], b="2")
+        ]
+
+        c = classifier.Classifier()
+        expected = dict((id(event), set()) for event in events)
+        for index, (first, second) in enumerate(itertools.product(matchers, repeat=2)):
+            for rule in [first, rules.And(first, second), rules.Or(first, second)]:
+                class_id = (index, rule)
+                c.inc(rule, class_id)
+                for event in events:
+                    if rule.match(event):
+                        expected[id(event)].add(class_id)
+
+        for event in events:
+            self.assertEqual(expected[id(event)], c.classify(event))
+
+    def test_dec_removes_rules_from_the_index(self):
+        c = classifier.Classifier()
+        c.inc(rules.Match("a", "b"), "X")
+        c.inc(rules.No(rules.Match("a", "b")), "Y")
+        c.dec(rules.Match("a", "b"), "X")
+        c.dec(rules.No(rules.Match("a", "b")), "Y")
+        self.assertEqual(set(), c.classify(Event(a="b")))
+        self.assertEqual({}, c._index)
+        self.assertEqual(set(), c._residual)
+
+    def test_profile(self):
+        c = classifier.Classifier(profile=True)
+        c.inc(rules.Match("a", "b"), "X")
+        c.inc(rules.Match("c"), "Y")
+
+        self.assertEqual(set(["X"]), c.classify(Event(a="b")))
+        self.assertEqual(set(["X", "Y"]), c.classify(Event(a="b", c="d")))
+        self.assertEqual(set(["Y"]), c.classify(Event(a="x", c="x")))
+
+        profile = c.pop_profile()
+        self.assertEqual((2, 2), profile[rules.Match("a", "b")][:2])
+        self.assertEqual((2, 2), profile[rules.Match("c")][:2])
+        self.assertTrue(all(seconds >= 0.0 for (_, _, seconds) in profile.values()))
+        self.assertEqual({}, c.pop_profile())
+
+    def test_no_profile_by_default(self):
+        c = classifier.Classifier()
+        c.inc(rules.Match("a", "b"), "X")
+        c.classify(Event(a="b"))
+        self.assertEqual({}, c.pop_profile())
+
+
+class TestKeyFilter(unittest.TestCase):
+    def test_never_filters_out_matching_objects(self):
+        matchers = [
+            rules.Match("a", "1"),
+            rules.Match("b"),
+            rules.Match("b", re.compile("^[12]$")),
+            rules.Match("ip", atoms.IP("192.0.2.0/24")),
+            rules.Match("a", atoms.StringSet(["2", "3"])),
+            rules.NonMatch("a", "1"),
+            rules.No(rules.Match("a", "1")),
+            rules.Fuzzy(atoms.String("2")),
+            rules.Anything()
+        ]
+        events = [
+            Event(),
+            Event(a="1"),
+            Event(a=["1", "2"]),
+            Event(b="1"),
+            Event(a="3", b="x"),
+            Event(c="2"),
+            Event(ip="192.0.2.5"),
+            Event(ip="198.51.100.1")
+        ]
+
+        for first, second in itertools.product(matchers, repeat=2):
+            for rule in [first, rules.And(first, second), rules.Or(first, second)]:
+                f = classifier.KeyFilter()
+                f.inc(rule)
+                for event in events:
+                    if rule.match(event):
+                        self.assertTrue(f.may_match(event), repr((rule, event)))
+
+    def test_filters_out_objects_without_required_keys(self):
+        f = classifier.KeyFilter()
+        f.inc(rules.Match("a", "1"))
+        f.inc(rules.And(rules.Match("b"), rules.Match("c", "x")))
+        self.assertFalse(f.may_match(Event()))
+        self.assertFalse(f.may_match(Event(a="2", d="1")))
+        self.assertTrue(f.may_match(Event(a="1")))
+        self.assertTrue(f.may_match(Event(c="x")))
+
+    def test_inc_and_dec(self):
+        f = classifier.KeyFilter()
+        f.inc(rules.Match("a"))
+        f.inc(rules.Match("a"))
+        f.inc(rules.No(rules.Match("a")))
+
+        f.dec(rules.No(rules.Match("a")))
+        self.assertFalse(f.may_match(Event(b="1")))
+
+        f.dec(rules.Match("a"))
+        self.assertTrue(f.may_match(Event(a="1")))
+        self.assertFalse(f.is_empty())
+
+        f.dec(rules.Match("a"))
+        self.assertFalse(f.may_match(Event(a="1")))
+        self.assertTrue(f.is_empty())
+        self.assertEqual({}, f._pairs)
@@ -0,0 +1,105 @@
+from __future__ import unicode_literals
+
+import re
+import random
+import unittest
+
+from ..atoms import Atom, String, StringSet, RegExp, IP, DomainName
+from ..rules import And, Or, No, Match, NonMatch, Fuzzy, Anything
+from ..compiler import compile
+
+from ...events import Event
+
+
+class TestCompile(unittest.TestCase):
+    _leaves = [
+        Match("a", "1"),
+        Match("a"),
+        Match(value="2"),
+        Match(value=re.compile("^[12]$")),
+        Match(),
+        Match("a", RegExp("^[0-9]+$")),
+        Match("ip", IP("192.0.2.0/24")),
+        Match("domain", DomainName("*.example")),
+        Match("a", StringSet(["1", "2"])),
+        NonMatch("a", "1"),
+        NonMatch("a", StringSet(["x"])),
+        NonMatch("b"),
+        Fuzzy(String("1")),
+        Anything()
+    ]
+
+    _events = [
+        Event(),
+        Event(a="1"),
+        Event(a=["1", "x"]),
+        Event(a="2", b="1"),
+        Event(ip="192.0.2.1"),
+        Event(ip="198.51.100.1", domain="sub.domain.example"),
+        Event(domain="example", c="3")
+    ]
+
+    def _random_rule(self, rand, depth):
+        if depth <= 0 or rand.random() < 0.3:
+            return rand.choice(self._leaves)
+
+        kind = rand.choice([And, Or, No])
+        if kind is No:
+            return No(self._random_rule(rand, depth - 1))
+        return kind(*[self._random_rule(rand, depth - 1) for _ in range(rand.randint(1, 3))])
+
+    def test_compiled_rules_match_like_the_originals(self):
+        rand = random.Random(0)
+        for _ in range(500):
+            rule = self._random_rule(rand, 5)
+            compiled = compile(rule)
+            for event in self._events:
+                self.assertEqual(bool(rule.match(event)), compiled(event), repr(rule))
+
+    def test_shared_subrules_get_evaluated_once(self):
+        calls = []
+
+        class Counting(Atom):
+            def match(self, value):
+                calls.append(value)
+                return True
+
+        shared = Match("a", Counting())
+        rule = And(Or(shared, Match("b")), Or(shared, Match("c")))
+        self.assertTrue(compile(rule)(Event(a="1")))
+        self.assertEqual(calls, ["1"])
+
+    def test_alternative_indexable_matches_get_merged(self):
+        rule = Or(
+            Match("ip", IP("192.0.2.0/25")),
+            Match("ip", IP("192.0.2.200-192.0.2.210")),
+            Match("ip", IP("2001:db8::/32")),
+            Match("other", IP("198.51.100.0/24"))
+        )
+        compiled = compile(rule)
+        for ip in ["192.0.2.1", "192.0.2.150", "192.0.2.205", "2001:db8::1", "198.51.100.1", "x"]:
+            for event in [Event(ip=ip), Event(other=ip), Event(ip=["x", ip])]:
+                self.assertEqual(bool(rule.match(event)), compiled(event))
+
+        rule = Or(
+            Match("domain", DomainName("*.example")),
+            Match("domain", DomainName("domain.test")),
+            Match("domain", IP("192.0.2.0/24"))
+        )
+        compiled = compile(rule)
+        for domain in ["example", "a.example", "domain.test", "sub.domain.test", "other.test", "192.0.2.1"]:
+            for event in [Event(domain=domain), Event(other=domain), Event(domain=["x", domain])]:
+                self.assertEqual(bool(rule.match(event)), compiled(event))
+
+    def test_alternative_fuzzy_matches_get_merged(self):
+        rule = Or(
+            Fuzzy(String("evil")),
+            Fuzzy(String("bad")),
+            Fuzzy(RegExp("^[0-9]+$")),
+            Fuzzy(RegExp("^x(y)?z$", ignore_case=True)),
+            Fuzzy(IP("192.0.2.0/24"))
+        )
+        compiled = compile(rule)
+        for text in ["EVIL", "so bad", "123", "XYZ", "xz", "192.0.2.1", "good"]:
+            for event in [Event(a=text), Event({text: "a"}), Event(a=["x", text])]:
+                self.assertEqual(bool(rule.match(event)), compiled(event))
@@ -0,0 +1,77 @@
+from __future__ import unicode_literals
+
+import random
+import unittest
+
+from ..iprange import IPRange, IPRangeIndex
+
+
+class TestIPRange(unittest.TestCase):
+    def test_cidr_blocks_of_a_cidr(self):
+        range = IPRange.from_cidr("192.0.2.0", 24)
+        self.assertEqual([(0xc00002, 24)], list(range.cidr_blocks()))
+
+    def test_cidr_blocks_cover_the_range(self):
+        range = IPRange.from_range("192.0.2.3", "192.0.3.17")
+
+        covered = []
+        for prefix, bits in range.cidr_blocks():
+            block = IPRange(range.version, prefix << (32 - bits), ((prefix + 1) << (32 - bits)) - 1)
+            covered.append(block)
+            self.assertTrue(range.contains(block))
+
+        for left, right in zip(covered, covered[1:]):
+            self.assertEqual(left.last + 1, right.first)
+        self.assertEqual(covered[0].first, range.first)
+        self.assertEqual(covered[-1].last, range.last)
+
+    def test_cidr_blocks_of_everything(self):
+        range = IPRange.from_range("::", "ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff")
+        self.assertEqual([(0, 0)], list(range.cidr_blocks()))
+
+
+class TestIPRangeIndex(unittest.TestCase):
+    def test_find(self):
+        index = IPRangeIndex()
+        index.add(IPRange.from_autodetected("192.0.2.0/24"), "a")
+        index.add(IPRange.from_autodetected("192.0.2.0-192.0.2.130"), "b")
+        index.add(IPRange.from_autodetected("2001:db8::/32"), "c")
+
+        self.assertEqual(set(["a", "b"]), index.find(IPRange.from_ip("192.0.2.1")))
+        self.assertEqual(set(["a"]), index.find(IPRange.from_ip("192.0.2.200")))
+        self.assertEqual(set(["a"]), index.find(IPRange.from_autodetected("192.0.2.100-192.0.2.200")))
+        self.assertEqual(set(["c"]), index.find(IPRange.from_ip("2001:db8::1")))
+        self.assertEqual(set(), index.find(IPRange.from_ip("::192.0.2.1")))
+
+    def test_discard(self):
+        index = IPRangeIndex()
+        range = IPRange.from_autodetected("192.0.2.0/24")
+        index.add(range, "a")
+        index.add(range, "b")
+
+        index.discard(range, "a")
+        self.assertEqual(set(["b"]), index.find(IPRange.from_ip("192.0.2.1")))
+
+        index.discard(range, "b")
+        self.assertEqual(set(), index.find(IPRange.from_ip("192.0.2.1")))
+        self.assertEqual(0, len(index))
+
+    def test_find_matches_contains(self):
+        rand = random.Random(0)
+
+        def random_range():
+            first = rand.randint(0, 2 ** 12)
+            return IPRange.from_range(*[
+                "10.0.{0}.{1}".format(x >> 8, x & 0xff)
+                for x in (first, first + rand.randint(0, 512))
+            ])
+
+        ranges = [random_range() for _ in xrange(200)]
+        index = IPRangeIndex()
+        for item, ip_range in enumerate(ranges):
+            index.add(ip_range, item)
+
+        for _ in xrange(200):
+            query = random_range()
+            expected = set(item for item, ip_range in enumerate(ranges) if ip_range.contains(query))
+            self.assertEqual(expected, index.find(query))
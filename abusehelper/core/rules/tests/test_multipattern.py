@@ -0,0 +1,70 @@
+from __future__ import unicode_literals
+
+import random
+import unittest
+
+from ..atoms import RegExp
+from .._multipattern import RegExpIndex
+
+
+class TestRegExpIndex(unittest.TestCase):
+    def _check(self, atoms, texts):
+        index = RegExpIndex()
+        for item, atom in enumerate(atoms):
+            index.add(atom, item)
+
+        for text in texts:
+            expected = set(item for item, atom in enumerate(atoms) if atom.match(text))
+            self.assertEqual(expected, index.find(text), text)
+            self.assertEqual(bool(expected), index.contains(text), text)
+
+    def test_mixed_patterns(self):
+        atoms = [
+            RegExp.from_string("abc"),
+            RegExp.from_string("bc"),
+            RegExp.from_string("a.b"),
+            RegExp.from_string("\xc4", ignore_case=True),
+            RegExp("^a"),
+            RegExp("(a)(b)\\2"),
+            RegExp("(?i)xy"),
+            RegExp("c$", ignore_case=True)
+        ]
+        texts = ["", "abc", "xabcx", "a.b", "axb", "\xe4", "abb", "XY", "C", "bcd"]
+        self._check(atoms, texts)
+
+    def test_overlapping_patterns(self):
+        atoms = [
+            RegExp("a[bc]"),
+            RegExp("b+"),
+            RegExp("[a-z]{3}"),
+            RegExp("c\\d"),
+            RegExp("^x|y$")
+        ]
+        texts = ["ab", "abc", "bbb", "c1", "xab", "aby", "yyy", "AB"]
+        self._check(atoms, texts)
+
+    def test_many_groups(self):
+        rand = random.Random(0)
+
+        atoms = []
+        for index in xrange(300):
+            atoms.append(RegExp("({0})+[a-c]{{{1}}}".format(index, rand.randint(1, 3))))
+            atoms.append(RegExp.from_string("word{0} ".format(index), ignore_case=bool(index % 2)))
+
+        texts = []
+        for _ in xrange(100):
+            texts.append("{0}abc WORD{1} ".format(rand.randint(0, 400), rand.randint(0, 400)))
+        self._check(atoms, texts)
+
+    def test_discard(self):
+        index = RegExpIndex()
+        index.add(RegExp.from_string("a"), "x")
+        index.add(RegExp.from_string("a"), "y")
+        self.assertEqual(set(["x", "y"]), index.find("a"))
+
+        index.discard(RegExp.from_string("a"), "x")
+        self.assertEqual(set(["y"]), index.find("a"))
+
+        index.discard(RegExp.from_string("a"), "y")
+        self.assertEqual(set(), index.find("a"))
+        self.assertEqual(0, len(index))
@@ -0,0 +1,116 @@
+from __future__ import unicode_literals
+
+import sys
+import random
+import unittest
+
+from ..atoms import String, StringSet, RegExp, IP, DomainName
+from ..rules import And, Or, No, Match, NonMatch, Fuzzy, Anything
+from ..optimizer import NOTHING, optimize, order, selectivity
+from ..compiler import compile
+
+from ...events import Event
+
+
+class TestOptimize(unittest.TestCase):
+    _leaves = [
+        Match("a", "1"),
+        Match("a", "2"),
+        Match("a", StringSet(["2", "x"])),
+        Match("b", "1"),
+        Match("a"),
+        Match(value="2"),
+        Match("a", RegExp("^[0-9]+$")),
+        Match("ip", IP("192.0.2.0/24")),
+        Match("domain", DomainName("*.example")),
+        NonMatch("a", "1"),
+        NonMatch("b"),
+        Fuzzy(String("1")),
+        Anything(),
+        NOTHING
+    ]
+
+    _events = [
+        Event(),
+        Event(a="1"),
+        Event(a=["1", "x"]),
+        Event(a="2", b="1"),
+        Event(a="x", b="2"),
+        Event(ip="192.0.2.1"),
+        Event(ip="198.51.100.1", domain="sub.domain.example"),
+        Event(domain="example", c="3")
+    ]
+
+    def _random_rule(self, rand, depth):
+        if depth <= 0 or rand.random() < 0.3:
+            return rand.choice(self._leaves)
+
+        kind = rand.choice([And, Or, No])
+        if kind is No:
+            return No(self._random_rule(rand, depth - 1))
+        return kind(*[self._random_rule(rand, depth - 1) for _ in range(rand.randint(1, 4))])
+
+    def test_optimized_rules_match_like_the_originals(self):
+        rand = random.Random(0)
+        for _ in range(1000):
+            rule = self._random_rule(rand, 5)
+            optimized = optimize(rule)
+            for event in self._events:
+                self.assertEqual(bool(rule.match(event)), bool(optimized.match(event)), repr(rule))
+
+    def test_ordered_rules_match_like_the_originals(self):
+        rand = random.Random(1)
+        for _ in range(300):
+            rule = optimize(self._random_rule(rand, 5))
+            observed = selectivity(rule, rand.sample(self._events, 3))
+            compiled = compile(rule, observed)
+            for event in self._events:
+                self.assertEqual(bool(rule.match(event)), compiled(event), repr(rule))
+
+    def test_flatten(self):
+        a = Match("a")
+        b = Match("b")
+        c = Match("c")
+        self.assertEqual(And(a, b, c), optimize(And(a, And(b, And(c, a)))))
+        self.assertEqual(Or(a, b, c), optimize(Or(Or(a, b), Or(c))))
+        self.assertEqual(Or(a, And(b, c)), optimize(Or(a, And(b, And(c)))))
+
+    def test_constant_folding(self):
+        a = Match("a")
+        self.assertEqual(a, optimize(No(No(a))))
+        self.assertEqual(No(a), optimize(No(No(No(a)))))
+        self.assertEqual(a, optimize(And(a, Anything())))
+        self.assertEqual(Anything(), optimize(Or(a, Anything())))
+        self.assertEqual(NOTHING, optimize(And(a, NOTHING)))
+        self.assertEqual(a, optimize(Or(a, NOTHING)))
+        self.assertEqual(NOTHING, optimize(And(a, No(a))))
+        self.assertEqual(Anything(), optimize(Or(a, No(a))))
+
+    def test_merge_exact_matches(self):
+        self.assertEqual(
+            Or(Match("a", StringSet(["1", "2", "3"])), Match("b", "1")),
+            optimize(Or(Match("a", "1"), Match("a", StringSet(["2", "3"])), Match("b", "1"))))
+        self.assertEqual(
+            Or(NonMatch("a", "1"), NonMatch("a", "2")),
+            optimize(Or(NonMatch("a", "1"), NonMatch("a", "2"))))
+
+    def test_allow_recursion_deeper_than_the_recursion_limit(self):
+        rule = Match("a", "b")
+        for _ in xrange(2 * sys.getrecursionlimit() + 1):
+            rule = No(rule)
+        self.assertEqual(No(Match("a", "b")), optimize(rule))
+
+
+class TestOrder(unittest.TestCase):
+    def test_cheap_rules_come_first(self):
+        cheap = Match("a", "1")
+        costly = Fuzzy(String("x"))
+        self.assertEqual([cheap, costly], order(And(costly, cheap)))
+        self.assertEqual([cheap, costly], order(Or(costly, cheap)))
+
+    def test_selectivity(self):
+        a = Match("a")
+        b = Match("b")
+        observed = {a: 0.9, b: 0.1}
+        self.assertEqual([b, a], order(And(a, b), observed))
+        self.assertEqual([a, b], order(Or(a, b), observed))
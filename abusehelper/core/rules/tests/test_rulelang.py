@@ -3,7 +3,7 @@ from __future__ import unicode_literals
 import sys
 import unittest
 
-from ..atoms import String, RegExp, IP, DomainName
+from ..atoms import String, StringSet, RegExp, IP, IPSet, DomainName
 from ..rules import And, Or, No, Match, NonMatch, Fuzzy, Anything
 from ..rulelang import format, parse, rule
 
@@ -69,6 +69,16 @@ class TestParse(unittest.TestCase):
         self.assertEqual(Match("a", DomainName("\xe4.example")), parse("a in \xc4.example"))
         self.assertEqual(Match("a", DomainName("\xe4.example")), parse("a in xn--4ca.example"))
 
+        self.assertEqual(Match("a", StringSet(["1", "2"])), parse('a in {1, 2}'))
+        self.assertEqual(Match("a", StringSet(["1", "2"])), parse('a in {"2",1}'))
+        self.assertEqual(Match("a", StringSet(["x y", "}"])), parse('a in { "x y" , "}" }'))
+        self.assertEqual(Match("a", StringSet([])), parse('a in {}'))
+        self.assertRaises(ValueError, parse, 'a in {1, 2')
+        self.assertRaises(ValueError, parse, 'a in {1,}')
+
+        self.assertEqual(Match("a", IPSet("/tmp/x y")), parse('a in ipset("/tmp/x y")'))
+        self.assertEqual(Match("a", IPSet("/tmp/x")), parse('a in IPSET ( "/tmp/x" )'))
+
     def test_no(self):
         x = Fuzzy(String("x"))
 
@@ -112,6 +122,9 @@ class TestParse(unittest.TestCase):
         self.assertEqual(NonMatch("a", DomainName("\xe4.example")), parse("a not in \xc4.example"))
         self.assertEqual(NonMatch("a", DomainName("\xe4.example")), parse("a not in xn--4ca.example"))
 
+        self.assertEqual(NonMatch("a", StringSet(["1", "2"])), parse('a not in {1, 2}'))
+        self.assertEqual(NonMatch("a", IPSet("/tmp/x")), parse('a not in ipset("/tmp/x")'))
+
     def test_fuzzy(self):
         self.assertEqual(parse('a'), Fuzzy(String('a')))
         self.assertEqual(parse('" a "'), Fuzzy(String(' a ')))
@@ -162,6 +175,26 @@ class TestFormat(unittest.TestCase):
         self.assertEqual("domain.example", format(Fuzzy(DomainName("domain.example"))))
         self.assertEqual("*.example", format(Fuzzy(DomainName("*.example"))))
 
+    def test_stringset(self):
+        self.assertEqual('a in {1, 2}', format(Match("a", StringSet(["2", "1"]))))
+        self.assertEqual('a not in {"", "x y", "{"}', format(NonMatch("a", StringSet(["x y", "{", ""]))))
+        self.assertEqual('a in {}', format(Match("a", StringSet([]))))
+
+        rule = Match("a", StringSet(["1", "a,b", "\"", "\xe4"]))
+        self.assertEqual(rule, parse(format(rule)))
+
+    def test_ipset(self):
+        self.assertEqual('a in ipset("/tmp/x")', format(Match("a", IPSet("/tmp/x"))))
+        self.assertEqual('a not in ipset("/tmp/x")', format(NonMatch("a", IPSet("/tmp/x"))))
+
+    def test_sets_roundtrip(self):
+        for value in [StringSet(["1", "x y"]), IPSet("/tmp/x y")]:
+            for match in [Match("a", value), NonMatch("a", value), Match(value=value), NonMatch(value=value)]:
+                self.assertEqual(match, parse(format(match)))
+
+            # Sets can only be used with "in" and "not in".
+            self.assertRaises(TypeError, Fuzzy, value)
+
     def test_allow_recursion_deeper_than_the_recursion_limit(self):
         limit = 2 * sys.getrecursionlimit()
 
@@ -4,7 +4,7 @@ import re
 import pickle
 import unittest
 
-from ..atoms import String, RegExp, IP, DomainName
+from ..atoms import String, StringSet, RegExp, IP, IPSet, DomainName
 from ..rules import And, Or, No, Match, NonMatch, Fuzzy
 
 from ...events import Event
@@ -182,6 +182,10 @@ class TestFuzzy(unittest.TestCase):
         self.assertFalse(rule.match(Event({"A": "xy"})))
         self.assertFalse(rule.match(Event({"xy": "A"})))
 
+    def test_sets_are_rejected(self):
+        self.assertRaises(TypeError, Fuzzy, StringSet(["a"]))
+        self.assertRaises(TypeError, Fuzzy, IPSet("/tmp/x"))
+
     _options = [
         Fuzzy(String("a")),
         Fuzzy(RegExp("a")),
@@ -47,6 +47,8 @@ class Serializer(object):
             self.register("rs", Rule(rules.String))
             self.register("ri", Rule(rules.IP))
             self.register("rd", Rule(rules.DomainName))
+            self.register("rt", Rule(rules.StringSet))
+            self.register("rp", Rule(rules.IPSet))
 
     def register(self, name, serializer):
         with self._lock:
@@ -12,7 +12,7 @@ from idiokit.xmpp.core import XMPPError
 from idiokit.xmpp.jid import JID
 from idiokit.xmlcore import Element
 
-from . import serialize
+from . import serialize, hashring
 
 
 SERVICE_NS = "abusehelper#service"
@@ -30,6 +30,38 @@ class Unavailable(Stop):
     pass
 
 
+def partition_owner(providers, key):
+    """
+    Return the provider (e.g. a JID) the given partition key belongs
+    to, or None when there are no providers. Every lobby member gets
+    the same answer for the same set of providers, and a provider
+    leaving only moves the keys that belonged to it.
+
+    >>> providers = ["lobby@example/a", "lobby@example/b"]
+    >>> owner = partition_owner(providers, u"room@example")
+    >>> owner in providers
+    True
+    >>> owner == partition_owner(reversed(providers), u"room@example")
+    True
+    >>> partition_owner([], u"room@example") is None
+    True
+    """
+
+    by_name = dict((unicode(provider), provider) for provider in providers)
+    name = hashring.HashRing(by_name).get(key)
+    return by_name.get(name, None)
+
+
+def _partition_key(partition, conf):
+    if partition is None:
+        return None
+
+    value = conf.get(partition, None)
+    if not isinstance(value, basestring):
+        return None
+    return unicode(value)
+
+
 class Lobby(idiokit.Proxy):
     def __init__(self, xmpp, room):
         self.xmpp = xmpp
@@ -40,19 +72,35 @@ class Lobby(idiokit.Proxy):
         self.catalogue = dict()
         self.waiters = dict()
         self.guarded = dict()
+        self.watchers = set()
 
         for participant in self.room.participants:
             self._update_catalogue(participant.name, participant.payload)
 
         idiokit.Proxy.__init__(self, self.room | self._run())
 
+    def _providers(self, service_id):
+        providers = dict()
+        for jid, service_ids in self.catalogue.items():
+            if service_id in service_ids:
+                providers[jid] = service_ids[service_id]
+        return providers
+
+    def _choose(self, providers, conf):
+        # Services offered with a partition key name get their sessions
+        # divided between the providers by the session configuration's
+        # value for that key. Otherwise any provider will do.
+        partitions = set(providers.values())
+        if len(partitions) == 1:
+            key = _partition_key(partitions.pop(), conf)
+            if key is not None:
+                return partition_owner(providers, key)
+        return random.choice(list(providers))
+
     @idiokit.stream
     def session(self, service_id, *path, **conf):
         while True:
-            matches = list()
-            for jid, service_ids in self.catalogue.items():
-                if service_id in service_ids:
-                    matches.append(jid)
+            matches = self._providers(service_id)
 
             if not matches:
                 event = idiokit.Event()
@@ -65,7 +113,7 @@ class Lobby(idiokit.Proxy):
                         self.waiters.pop(service_id, None)
                 continue
 
-            jid = random.choice(matches)
+            jid = self._choose(matches, conf)
             task = self._establish_session(jid, service_id, path, conf)
             self.guarded.setdefault((jid, service_id), set()).add(task)
             try:
@@ -112,23 +160,54 @@ class Lobby(idiokit.Proxy):
             raise SessionError(
                 "no session ID for service " + repr(service_id) + "received")
 
+    @idiokit.stream
+    def moved(self, service_id, key):
+        """
+        Return the provider of the service sessions with the given
+        partition key belong to, when it is some other provider than
+        this lobby member. Return right away when that is already the
+        case (e.g. the session was requested by a member that hadn't yet
+        seen a new provider joining), otherwise wait until the providers
+        change so that it is.
+        """
+
+        while True:
+            providers = self._providers(service_id)
+            if self.room.jid in providers:
+                owner = partition_owner(providers, key)
+                if owner != self.room.jid:
+                    idiokit.stop(owner)
+
+            event = idiokit.Event()
+            self.watchers.add(event)
+            try:
+                yield event
+            finally:
+                self.watchers.discard(event)
+
     def _update_catalogue(self, jid, payload=None):
-        previous = self.catalogue.pop(jid, set())
+        previous = self.catalogue.pop(jid, dict())
 
         if payload:
-            self.catalogue[jid] = set()
+            self.catalogue[jid] = dict()
             for services in payload.named("services", SERVICE_NS):
                 for service in services.children("service").with_attrs("id"):
                     service_id = service.get_attr("id")
-                    self.catalogue[jid].add(service_id)
+                    self.catalogue[jid][service_id] = service.get_attr("partition", None)
 
                     for event in self.waiters.pop(service_id, ()):
                         event.succeed()
 
-        for service_id in previous - self.catalogue.get(jid, set()):
+        for service_id in set(previous) - set(self.catalogue.get(jid, ())):
             for task in self.guarded.pop((jid, service_id), ()):
                 task.throw(Unavailable())
 
+        if previous != self.catalogue.get(jid, dict()):
+            watchers = list(self.watchers)
+            self.watchers.clear()
+            for event in watchers:
+                event.succeed()
+
     def handle_iq(self, iq, payload):
         if not iq.with_attrs("from", type="set"):
             return False
@@ -216,8 +295,10 @@ class Lobby(idiokit.Proxy):
     def _update_presence(self):
         services = Element("services", xmlns=SERVICE_NS)
         for service_id, service in self.services.items():
-            element = Element("service", id=service_id)
-            services.add(element)
+            attrs = dict(id=service_id)
+            if service.partition is not None:
+                attrs["partition"] = service.partition
+            services.add(Element("service", **attrs))
         self.xmpp.core.presence(services, to=self.room.jid)
 
     @idiokit.stream
@@ -268,6 +349,10 @@ def unlock_file(fileobj):
 
 
 class Service(object):
+    # The name of the session configuration key used for dividing
+    # sessions between several providers of the service, or None.
+    partition = None
+
     def __init__(self, state_file=None):
         self.file = None
         self.sessions = dict()
@@ -1,6 +1,9 @@
 import pickle
+import hashlib
 import unittest
 
+from idiokit.xmlcore import Element
+
 from .. import events
 
 
@@ -8,3 +11,117 @@ class TestEvent(unittest.TestCase):
     def test_pickling(self):
         e = events.Event({"a": "b"})
         self.assertEqual(e, pickle.loads(pickle.dumps(e)))
+
+    def test_unpickled_values_are_shared_between_events(self):
+        a = pickle.loads(pickle.dumps(events.Event(a="1"), pickle.HIGHEST_PROTOCOL))
+        b = pickle.loads(pickle.dumps(events.Event(a="1"), pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(events.Event(a="1"), a)
+        self.assertTrue(a.value("a") is b.value("a"))
+
+    def test_unpickling_set_based_state(self):
+        # Events pickled by older versions contain sets of values.
+        self.assertEqual(events.Event({"a": set([u"b", u"c"])}), events.Event(a=["c", "b"]))
+
+    def test_insertion_order_does_not_affect_equality(self):
+        e1 = events.Event()
+        e1.add("a", "1")
+        e1.add("a", "2")
+
+        e2 = events.Event()
+        e2.add("a", "2", "1")
+        self.assertEqual(e1, e2)
+
+    def test_values_are_shared_between_events(self):
+        e1 = events.Event({"key": "value"})
+        e2 = events.Event({"key": "value"})
+        self.assertTrue(e1.value("key") is e2.value("key"))
+
+    def test_union_and_difference_keep_the_original_intact(self):
+        e = events.Event(a=["1", "2"])
+        e.union(a="3").add("a", "4")
+        e.difference(a="1").discard("a", "2")
+        self.assertEqual(e, events.Event(a=["1", "2"]))
+
+
+class TestCompactFormat(unittest.TestCase):
+    def _roundtrip(self, batch):
+        message = Element("message")
+        message.add(events.batch_to_elements(batch, include_body=False, compact=True))
+        return list(events.Event.from_elements(message))
+
+    def test_roundtrip(self):
+        batch = [
+            events.Event(),
+            events.Event(a="1"),
+            events.Event({u"\xe4": [u"\u20ac", u"x" * 300], "a": "2"})
+        ]
+        self.assertEqual(self._roundtrip(batch), batch)
+
+    def test_decoded_values_are_shared(self):
+        a, b = self._roundtrip([events.Event(a="1"), events.Event(a="1")])
+        self.assertTrue(a.value("a") is b.value("a"))
+
+    def test_malformed_data_raises_value_error(self):
+        data = events._encode_compact([events.Event(a="1")])
+        self.assertRaises(ValueError, events._decode_compact, data[:-1])
+        self.assertRaises(ValueError, events._decode_compact, "\x00" + data[1:])
+
+    def test_malformed_stanzas_are_skipped(self):
+        payloads = [
+            "not base64!",
+            "\x01\xff\xff\xff\xff\x0f".encode("base64"),
+            "\x01\x00\x01\x01\x05\x01a".encode("base64"),
+            "\x01\x01\x01\xff\x00".encode("base64")
+        ]
+
+        for payload in payloads:
+            message = Element("message")
+            bad = Element("c", xmlns=events.EVENT_NS)
+            bad.text = payload
+            message.add(bad)
+            message.add(events.batch_to_elements([events.Event(a="1")], include_body=False, compact=True))
+            self.assertEqual([events.Event(a="1")], list(events.Event.from_elements(message)))
+
+
+class TestFrozenEvent(unittest.TestCase):
+    def test_pickling(self):
+        e = events.FrozenEvent({"a": "b"})
+        unpickled = pickle.loads(pickle.dumps(e))
+        self.assertEqual(e, unpickled)
+        self.assertTrue(isinstance(unpickled, events.FrozenEvent))
+
+    def test_hash_equals_for_equal_events(self):
+        e1 = events.FrozenEvent(a=["1", "2"], b="3")
+        e2 = events.FrozenEvent(events.Event(b="3", a=["2", "1"]))
+        self.assertEqual(hash(e1), hash(e2))
+
+    def test_digest_is_cached_per_hash_function(self):
+        e = events.FrozenEvent(a="b")
+        self.assertEqual(events.hexdigest(e, hashlib.md5), events.hexdigest(events.Event(e), hashlib.md5))
+        self.assertEqual(events.hexdigest(e, hashlib.sha1), events.hexdigest(events.Event(e), hashlib.sha1))
+        self.assertTrue(e.hexdigest(hashlib.md5) is e.hexdigest(hashlib.md5))
+
+    def test_elements_are_cached_per_options(self):
+        e = events.FrozenEvent(a=["1", "2"], b="3")
+        self.assertTrue(e.to_elements() is e.to_elements())
+        self.assertTrue(e.to_elements(include_body=False) is e.to_elements(include_body=False))
+        self.assertFalse(e.to_elements() is e.to_elements(include_body=False))
+        self.assertEqual(e._body_text(1), events.Event(e)._body_text(1))
+
+        message = Element("message")
+        message.add(events.batch_to_elements([e, events.FrozenEvent(c="4")], body_limit=1))
+        self.assertEqual([e, events.Event(c="4")], list(events.Event.from_elements(message)))
+
+    def test_union_and_difference_return_frozen_events(self):
+        e = events.FrozenEvent(a=["1", "2"])
+        self.assertTrue(isinstance(e.union(b="3"), events.FrozenEvent))
+        self.assertTrue(isinstance(e.difference(a="1"), events.FrozenEvent))
+        self.assertEqual(e.difference(a="1"), events.Event(a="2"))
+
+    def test_mutation_raises_type_error(self):
+        e = events.FrozenEvent(a="b")
+        self.assertRaises(TypeError, e.add, "a", "c")
+        self.assertRaises(TypeError, e.update, "a", ["c"])
+        self.assertRaises(TypeError, e.discard, "a", "b")
+        self.assertRaises(TypeError, e.clear, "a")
+        self.assertRaises(TypeError, e.pop, "a")
@@ -0,0 +1,45 @@
+import unittest
+
+from ..hashring import HashRing
+
+
+class TestHashRing(unittest.TestCase):
+    def test_empty_ring(self):
+        self.assertEqual(None, HashRing().get("key"))
+
+    def test_keys_are_spread_over_the_nodes(self):
+        ring = HashRing(["a", "b", "c", "d"])
+
+        counts = {}
+        for index in xrange(4000):
+            node = ring.get("key " + str(index))
+            counts[node] = counts.get(node, 0) + 1
+
+        self.assertEqual(set(["a", "b", "c", "d"]), set(counts))
+        for count in counts.values():
+            self.assertTrue(500 < count < 1500, counts)
+
+    def test_adding_a_node_moves_keys_only_to_it(self):
+        ring = HashRing(["a", "b", "c"])
+        keys = ["key " + str(index) for index in xrange(1000)]
+        before = dict((key, ring.get(key)) for key in keys)
+
+        ring.add("d")
+        moved = [key for key in keys if ring.get(key) != before[key]]
+        self.assertTrue(moved)
+        self.assertTrue(all(ring.get(key) == "d" for key in moved))
+
+    def test_add_and_remove_are_idempotent(self):
+        ring = HashRing(["a"])
+        ring.add("a")
+        self.assertEqual(1, len(ring))
+
+        ring.remove("b")
+        ring.remove("a")
+        ring.remove("a")
+        self.assertEqual(0, len(ring))
+        self.assertEqual(None, ring.get("key"))
+
+    def test_unicode_keys(self):
+        ring = HashRing(["a", "b"])
+        self.assertEqual(ring.get(u"\xe4".encode("utf-8")), ring.get(u"\xe4"))
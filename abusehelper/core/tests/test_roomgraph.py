@@ -0,0 +1,156 @@
+import random
+import socket
+import unittest
+import threading
+
+from .. import events, rules
+from ..roomgraph import ReorderBuffer, _MatchCache, _RuleOrigins, _send_profile, DISPATCH_STRATEGIES, roomgraph, send_encoded, recv_decoded
+
+
+class TestReorderBuffer(unittest.TestCase):
+    def test_keeps_the_order_per_source(self):
+        rand = random.Random(0)
+
+        for _ in xrange(100):
+            reorder = ReorderBuffer(max_pending=1000)
+            batches = []
+            for batch_id in xrange(50):
+                batch = [(rand.choice("abcde"), batch_id) for _ in xrange(rand.randint(1, 3))]
+                reorder.add(batch_id, set(src for (src, _) in batch))
+                batches.append((batch_id, batch))
+
+            released = []
+            rand.shuffle(batches)
+            for batch_id, batch in batches:
+                self.assertFalse(reorder.is_full())
+                for result in reorder.complete(batch_id, batch):
+                    released.extend(result)
+
+            self.assertEqual(sum(len(batch) for (_, batch) in batches), len(released))
+            for src in "abcde":
+                order = [batch_id for (x, batch_id) in released if x == src]
+                self.assertEqual(sorted(order), order)
+
+    def test_is_full(self):
+        reorder = ReorderBuffer(max_pending=2)
+        reorder.add(0, ["a"])
+        reorder.add(1, ["a"])
+        self.assertTrue(reorder.is_full())
+
+        self.assertEqual([], reorder.complete(1, "second"))
+        self.assertTrue(reorder.is_full())
+
+        self.assertEqual(["first", "second"], reorder.complete(0, "first"))
+        self.assertFalse(reorder.is_full())
+
+
+class TestMatchCache(unittest.TestCase):
+    def test_bounded_size(self):
+        cache = _MatchCache(max_size=2)
+        for index in xrange(10):
+            cache.set("src", index, frozenset([index]))
+        self.assertTrue(len(cache._current) + len(cache._old) <= 4)
+        self.assertEqual(frozenset([9]), cache.get("src", 9))
+
+    def test_invalidate_only_the_given_source(self):
+        cache = _MatchCache()
+        cache.set("a", "digest", frozenset(["x"]))
+        cache.set("b", "digest", frozenset(["y"]))
+        cache.invalidate("a")
+        self.assertEqual(None, cache.get("a", "digest"))
+        self.assertEqual(frozenset(["y"]), cache.get("b", "digest"))
+
+    def test_empty_results_are_cached(self):
+        cache = _MatchCache()
+        cache.set("a", "digest", frozenset())
+        self.assertEqual(frozenset(), cache.get("a", "digest"))
+
+
+class TestWorker(unittest.TestCase):
+    def setUp(self):
+        self.conn, worker_conn = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.worker = threading.Thread(target=roomgraph, args=(worker_conn,))
+        self.worker.daemon = True
+        self.worker.start()
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_stop_answers_pending_events_first(self):
+        send_encoded(self.conn, ("inc_rule", ("src", rules.Match("a", "1"), "dst")))
+        send_encoded(self.conn, ("events", (0, [("src", events.Event(a="1")), ("src", events.Event(a="2"))])))
+        send_encoded(self.conn, ("events", (1, [("other", events.Event(a="1"))])))
+        send_encoded(self.conn, ("stop", None))
+
+        self.assertEqual(
+            ("matches", (0, 2, 0, [("src", events.Event(a="1"), frozenset(["dst"]))])),
+            recv_decoded(self.conn))
+        self.assertEqual(("matches", (1, 1, 0, [])), recv_decoded(self.conn))
+        self.assertEqual(("stopped", None), recv_decoded(self.conn))
+
+        self.worker.join(5.0)
+        self.assertFalse(self.worker.is_alive())
+
+    def test_cache_hits_are_reported_and_invalidated_by_rule_changes(self):
+        event = events.Event(a="1")
+        send_encoded(self.conn, ("inc_rule", ("src", rules.Match("a", "1"), "x")))
+        send_encoded(self.conn, ("events", (0, [("src", event), ("src", event)])))
+        self.assertEqual(1, recv_decoded(self.conn)[1][2])
+
+        send_encoded(self.conn, ("inc_rule", ("src", rules.Match("a"), "y")))
+        send_encoded(self.conn, ("events", (1, [("src", event)])))
+        _, (_, _, hits, matches) = recv_decoded(self.conn)
+        self.assertEqual(0, hits)
+        self.assertEqual([("src", event, frozenset(["x", "y"]))], matches)
+
+        send_encoded(self.conn, ("stop", None))
+        self.assertEqual(("stopped", None), recv_decoded(self.conn))
+
+
+class TestProfile(unittest.TestCase):
+    def setUp(self):
+        self.conn, self.worker_conn = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    def tearDown(self):
+        self.conn.close()
+        self.worker_conn.close()
+
+    def test_profiles_name_the_rules_and_rooms_of_the_sessions(self):
+        first = rules.Or(rules.Match("a", "1"), rules.Match("a", "2"))
+        second = rules.Match("a", rules.StringSet(["1", "2"]))
+        optimized = rules.optimize(first)
+
+        classifier = rules.Classifier(profile=True)
+        origins = _RuleOrigins()
+        for rule, dst in [(first, "x"), (second, "y")]:
+            classifier.inc(rules.optimize(rule), dst)
+            origins.inc("src", rules.optimize(rule), rule, dst)
+        classifier.classify(events.Event(a="1"))
+
+        _send_profile(self.worker_conn, {"src": classifier}, origins)
+        type_id, profile = recv_decoded(self.conn)
+        self.assertEqual("profile", type_id)
+
+        [(src, rule, rule_origins, evaluations, matches, _)] = profile
+        self.assertEqual(("src", optimized, 1, 1), (src, rule, evaluations, matches))
+        self.assertEqual(set([(first, "x"), (second, "y")]), set(rule_origins))
+
+
+class TestEventDigestDispatch(unittest.TestCase):
+    def setUp(self):
+        self.conns = ["a", "b", "c"]
+        self.dispatch = DISPATCH_STRATEGIES["event-digest"](self.conns, None)
+
+    def _conn(self, src, event):
+        return self.dispatch.choose(self.dispatch.key(src, event))
+
+    def test_identical_events_go_to_the_same_worker(self):
+        for index in xrange(100):
+            event = events.Event(a=unicode(index), b=[u"x", u"y"])
+            same = events.Event(b=[u"y", u"x"], a=unicode(index))
+            self.assertEqual(self._conn("src", event), self._conn("src", same))
+            self.assertEqual(self._conn("src", event), self._conn("src", events.FrozenEvent(same)))
+
+    def test_events_are_spread_over_the_workers(self):
+        conns = set(self._conn("src", events.Event(a=unicode(index))) for index in xrange(100))
+        self.assertEqual(set(self.conns), conns)
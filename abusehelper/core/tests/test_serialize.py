@@ -63,6 +63,8 @@ class TestSerialize(unittest.TestCase):
             rules.Match(u"a", rules.String(u"a")),
             rules.Match(u"b", rules.RegExp(u"b")),
             rules.Match(u"c", rules.IP(u"192.0.2.0")),
-            rules.Match(u"d", rules.DomainName(u"domain.example"))
+            rules.Match(u"d", rules.DomainName(u"domain.example")),
+            rules.Match(u"e", rules.StringSet([u"1", u"2"])),
+            rules.Match(u"f", rules.IPSet(u"/tmp/ranges.txt"))
         )
         self.assertEqual(serialize.load(serialize.dump(rule)), rule)
@@ -0,0 +1,287 @@
+import itertools
+import unittest
+import contextlib
+
+import idiokit
+from idiokit.xmpp.jid import JID
+from idiokit.xmlcore import Element
+
+from .. import services
+from ..services import partition_owner, _partition_key
+
+
+class TestPartitionOwner(unittest.TestCase):
+    def setUp(self):
+        self.providers = ["lobby@example/roomgraph-" + str(index) for index in xrange(4)]
+        self.keys = [u"source" + str(index) + u"@example" for index in xrange(1000)]
+
+    def test_rooms_are_spread_over_the_providers(self):
+        owners = set(partition_owner(self.providers, key) for key in self.keys)
+        self.assertEqual(set(self.providers), owners)
+
+    def test_a_leaving_provider_moves_only_its_rooms(self):
+        before = dict((key, partition_owner(self.providers, key)) for key in self.keys)
+
+        gone = self.providers.pop()
+        for key in self.keys:
+            owner = partition_owner(self.providers, key)
+            self.assertTrue(owner in self.providers)
+            if before[key] != gone:
+                self.assertEqual(before[key], owner)
+
+    def test_no_providers(self):
+        self.assertEqual(None, partition_owner([], u"source@example"))
+
+
+class TestPartitionKey(unittest.TestCase):
+    def test_key_is_taken_from_the_configuration(self):
+        self.assertEqual(u"source@example", _partition_key("src_room", {"src_room": "source@example"}))
+
+    def test_missing_partition_or_value(self):
+        self.assertEqual(None, _partition_key(None, {"src_room": "source@example"}))
+        self.assertEqual(None, _partition_key("src_room", {}))
+        self.assertEqual(None, _partition_key("src_room", {"src_room": ["a", "b"]}))
+
+
+@idiokit.stream
+def _forward():
+    while True:
+        element = yield idiokit.next()
+        yield idiokit.send(element)
+
+
+class _Participant(object):
+    def __init__(self, name, payload):
+        self.name = name
+        self.payload = payload
+
+
+class _Room(idiokit.Proxy):
+    def __init__(self, jid, participants):
+        self.jid = jid
+        self.participants = participants
+        self._inbox = _forward()
+
+        idiokit.Proxy.__init__(self, self._inbox)
+
+    def deliver(self, element):
+        self._inbox.send(element)
+
+
+class _Member(object):
+    # One lobby member's connection to the stand-in server. It offers
+    # just as much of xmpp.core as services.Lobby uses.
+
+    def __init__(self, server, jid, participants):
+        self.core = self
+        self.handlers = []
+        self.room = _Room(jid, participants)
+
+        self._server = server
+
+    @contextlib.contextmanager
+    def iq_handler(self, handler, *args):
+        self.handlers.append(handler)
+        try:
+            yield
+        finally:
+            self.handlers.remove(handler)
+
+    def presence(self, payload, to):
+        self._server.presence(self.room.jid, payload)
+
+    def message(self, to, payload):
+        self._server.message(self.room.jid, to, payload)
+
+    def iq_set(self, payload, to):
+        return self._server.iq_set(self.room.jid, to, payload)
+
+    def iq_result(self, iq, payload):
+        self._server.iq_result(iq, payload)
+
+    def build_error(self, type, condition, text):
+        return text
+
+    def iq_error(self, iq, error):
+        self._server.iq_error(iq, error)
+
+
+class _Server(object):
+    # A stand-in XMPP server hosting one multi-user chat room, the lobby.
+    # Every presence is reflected to all members, including the sender.
+
+    def __init__(self):
+        self.members = dict()
+        self.presences = dict()
+        self.errors = []
+
+        self._ids = itertools.count()
+        self._pending = dict()
+
+    def join(self, name):
+        jid = JID("lobby@example/" + name)
+        participants = [_Participant(x, y.children()) for (x, y) in self.presences.items()]
+        member = _Member(self, jid, participants)
+        self.members[jid] = member
+        return services.Lobby(member, member.room)
+
+    def leave(self, lobby):
+        jid = lobby.room.jid
+        del self.members[jid]
+        self.presences.pop(jid, None)
+        self._broadcast(Element("presence", type="unavailable", **{"from": unicode(jid)}))
+
+    def _broadcast(self, element):
+        for member in self.members.values():
+            member.room.deliver(element)
+
+    def presence(self, sender, payload):
+        presence = Element("presence", **{"from": unicode(sender)})
+        presence.add(payload)
+        self.presences[sender] = presence
+        self._broadcast(presence)
+
+    def message(self, sender, to, payload):
+        member = self.members.get(JID(to), None)
+        if member is not None:
+            message = Element("message", **{"from": unicode(sender)})
+            message.add(payload)
+            member.room.deliver(message)
+
+    def iq_set(self, sender, to, payload):
+        iq = Element("iq", type="set", id=unicode(next(self._ids)), **{"from": unicode(sender)})
+        iq.add(payload)
+
+        result = idiokit.Event()
+        self._pending[iq.get_attr("id")] = result
+
+        member = self.members.get(JID(to), None)
+        if member is not None:
+            for handler in member.handlers:
+                if handler(iq, payload):
+                    break
+        return result
+
+    def iq_result(self, iq, payload):
+        result = Element("iq", type="result")
+        result.add(payload)
+        self._pending.pop(iq.get_attr("id")).succeed(result)
+
+    def iq_error(self, iq, error):
+        # Answer with an empty result, which the requester turns into
+        # a SessionError.
+        self.errors.append(error)
+        self._pending.pop(iq.get_attr("id")).succeed(Element("iq", type="result"))
+
+
+class _PartitionedService(services.Service):
+    # Serves one room per session and hands the room off like
+    # RoomGraphBot does, only without the delay.
+    partition = "room"
+
+    def __init__(self, lobby):
+        services.Service.__init__(self)
+
+        self.lobby = lobby
+        self.rooms = set()
+
+    @idiokit.stream
+    def session(self, state, room):
+        self.rooms.add(room)
+        try:
+            yield self.lobby.moved("test", room)
+            raise services.Stop()
+        finally:
+            self.rooms.discard(room)
+
+
+@idiokit.stream
+def _keep_session(lobby, service_id, **conf):
+    # Request the session again whenever it ends, like the runtime.
+    while True:
+        session = yield lobby.session(service_id, **conf)
+        try:
+            yield session
+        except services.Stop:
+            pass
+
+
+@idiokit.stream
+def _wait_until(func, timeout=5.0, interval=0.01):
+    for _ in xrange(int(timeout / interval)):
+        if func():
+            return
+        yield idiokit.sleep(interval)
+    raise AssertionError("condition not met in {0} seconds".format(timeout))
+
+
+class TestPartitionedLobby(unittest.TestCase):
+    def setUp(self):
+        self.server = _Server()
+        self.client = self.server.join("runtime")
+        self.rooms = [u"source" + str(index) + u"@example" for index in xrange(20)]
+        self.streams = []
+
+    def _start(self, name):
+        lobby = self.server.join(name)
+        service = _PartitionedService(lobby)
+        self.streams.append(lobby.offer("test", service))
+        return lobby, service
+
+    def _request_all(self):
+        for room in self.rooms:
+            self.streams.append(_keep_session(self.client, "test", room=room))
+
+    def _owned(self, lobbies, service):
+        providers = [lobby.room.jid for lobby in lobbies]
+        return set(x for x in self.rooms if partition_owner(providers, x) == service.lobby.room.jid)
+
+    def test_a_joining_instance_gets_its_rooms_handed_off(self):
+        @idiokit.stream
+        def test():
+            first, first_service = self._start("first")
+            self._request_all()
+            yield _wait_until(lambda: first_service.rooms == set(self.rooms))
+
+            second, second_service = self._start("second")
+            lobbies = [first, second]
+            yield _wait_until(lambda: (
+                first_service.rooms == self._owned(lobbies, first_service) and
+                second_service.rooms == self._owned(lobbies, second_service)))
+
+            self.assertTrue(second_service.rooms)
+            self.assertEqual(set(), first_service.rooms & second_service.rooms)
+            self.assertEqual([], self.server.errors)
+        idiokit.main_loop(test())
+
+    def test_rooms_fail_over_to_the_remaining_instances(self):
+        @idiokit.stream
+        def test():
+            first, first_service = self._start("first")
+            second, second_service = self._start("second")
+            self._request_all()
+            yield _wait_until(lambda: first_service.rooms | second_service.rooms == set(self.rooms))
+
+            # The second instance vanishes without ending its sessions.
+            self.server.leave(second)
+            yield _wait_until(lambda: first_service.rooms == set(self.rooms))
+            self.assertEqual([], self.server.errors)
+        idiokit.main_loop(test())
+
+    def test_moved_checks_the_owner_right_away(self):
+        @idiokit.stream
+        def test():
+            first, _ = self._start("first")
+            second, _ = self._start("second")
+            providers = [first.room.jid, second.room.jid]
+            yield _wait_until(lambda: set(first.catalogue) >= set(providers))
+
+            for room in self.rooms:
+                owner = partition_owner(providers, room)
+                if owner == second.room.jid:
+                    moved_to = yield first.moved("test", room)
+                    self.assertEqual(second.room.jid, moved_to)
+                    break
+            else:
+                self.fail("no room belongs to the second instance")
+        idiokit.main_loop(test())
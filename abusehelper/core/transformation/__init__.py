@@ -39,11 +39,11 @@ class Transformation(bot.ServiceBot):
         self._dsts = taskfarm.TaskFarm(self._dst)
         self._pipes = taskfarm.TaskFarm(self._pipe, grace_period=0.0)
 
-    def _pipe(self, src, dst, key):
+    def _pipe(self, src, dst, key, stanza_options):
         return idiokit.pipe(
             self._srcs.inc(src),
             self.transform(*key),
-            events.events_to_elements(),
+            events.events_to_elements(*stanza_options),
             self._dsts.inc(dst))
 
     def _src(self, src):
@@ -75,12 +75,22 @@ class Transformation(bot.ServiceBot):
         yield idiokit.Event()
 
     @idiokit.stream
-    def session(self, _, src_room, dst_room, **keys):
+    def session(self, _, src_room, dst_room,
+                stanza_batch_size=1, stanza_batch_bytes=None,
+                stanza_batch_interval=1.0, stanza_body=events.BODY_FULL,
+                stanza_format=events.FORMAT_LEGACY, **keys):
         keyset = yield idiokit.pipe(
             self.transform_keys(src_room=src_room, dst_room=dst_room, **keys),
             _collect_set())
 
-        pipes = [self._pipes.inc(src_room, dst_room, key) for key in keyset]
+        stanza_options = (
+            stanza_batch_size,
+            stanza_batch_bytes,
+            stanza_batch_interval,
+            stanza_body,
+            stanza_format
+        )
+        pipes = [self._pipes.inc(src_room, dst_room, key, stanza_options) for key in keyset]
         yield idiokit.pipe(*pipes)
 
     @idiokit.stream
@@ -0,0 +1,670 @@
+"""
+Micro-benchmarks for AbuseHelper's hot paths.
+
+Run a benchmark with:
+
+    python -m abusehelper.tools.benchmark BENCHMARK [options]
+
+Use the --help option for a list of available benchmarks.
+"""
+
+import os
+import sys
+import time
+import socket
+import pickle
+import random
+import shutil
+import tempfile
+import optparse
+import threading
+
+from idiokit.xmlcore import Element
+from abusehelper.core import events, parsecache
+from abusehelper.core import rules
+from abusehelper.core.rules import atoms, compiler, _ipset
+
+
+_benchmarks = []
+
+
+def benchmark(name):
+    def _benchmark(func):
+        _benchmarks.append((name, func))
+        return func
+    return _benchmark
+
+
+def deep_size(obj, seen=None):
+    """
+    Return the approximate memory footprint of an object and the objects
+    it refers to. Shared objects are counted only once.
+
+    >>> deep_size(u"a") == sys.getsizeof(u"a")
+    True
+    >>> value = u"abc"
+    >>> deep_size((value, value)) == sys.getsizeof((value, value)) + sys.getsizeof(value)
+    True
+    """
+
+    if seen is None:
+        seen = set()
+
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.iterkeys())
+            stack.extend(obj.itervalues())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+    return size
+
+
+_FEEDS = [
+    (u"abuse.ch zeus", u"c&c", 0.3),
+    (u"shadowserver drone", u"botnet drone", 0.4),
+    (u"spamhaus drop", u"hijacked network", 0.1),
+    (u"phishtank", u"phishing", 0.2)
+]
+
+
+def feed_events(count, seed=0):
+    """
+    Yield a reproducible mix of events resembling the output of the
+    common feeds: mostly recurring keys and feed-level values with a few
+    per-event values such as IP addresses and timestamps.
+    """
+
+    rand = random.Random(seed)
+    weights = [weight for _, _, weight in _FEEDS]
+
+    for index in xrange(count):
+        pick = rand.random() * sum(weights)
+        for feed, type_, weight in _FEEDS:
+            pick -= weight
+            if pick <= 0:
+                break
+
+        ip = u"198.51.{0}.{1}".format(rand.randint(0, 255), rand.randint(1, 254))
+        attrs = {
+            u"feed": feed,
+            u"type": type_,
+            u"ip": ip,
+            u"asn": unicode(rand.choice([64496, 64497, 64498, 64499, 64500])),
+            u"cc": rand.choice([u"FI", u"SE", u"NO", u"DK", u"EE"]),
+            u"source time": u"2018-04-04 12:{0:02d}:{1:02d}Z".format(
+                rand.randint(0, 59), rand.randint(0, 59))
+        }
+        if type_ == u"phishing":
+            attrs[u"url"] = u"http://{0}.example/login/{1}".format(
+                rand.randint(0, 1000), index)
+            attrs[u"domain name"] = u"{0}.example".format(rand.randint(0, 1000))
+        if type_ == u"botnet drone":
+            attrs[u"malware family"] = rand.choice([u"conficker", u"gozi", u"necurs"])
+            attrs[u"port"] = [u"80", u"443"]
+        yield attrs
+
+
+@benchmark("events-memory")
+def events_memory(options):
+    """compare the memory use of the set based and the packed event layouts"""
+
+    dicts = list(feed_events(options.count))
+
+    legacy = []
+    for attrs in dicts:
+        legacy.append(dict(
+            (unicode(key), set([value] if isinstance(value, basestring) else value))
+            for (key, value) in attrs.iteritems()
+        ))
+
+    packed = [events.Event(attrs) for attrs in dicts]
+
+    legacy_size = deep_size(legacy)
+    packed_size = deep_size([event._attrs for event in packed])
+
+    print "{0} events".format(options.count)
+    print "  dict of sets:   {0:>12} bytes".format(legacy_size)
+    print "  packed tuples:  {0:>12} bytes ({1:.1%})".format(
+        packed_size, float(packed_size) / legacy_size)
+
+
+@benchmark("combiner")
+def combiner(options):
+    """union expert augmentations into pending events like Combiner does"""
+
+    experts = range(options.experts)
+    originals = [events.FrozenEvent(attrs) for attrs in feed_events(options.count)]
+    augments = []
+    for index, event in enumerate(originals):
+        augments.append([
+            events.Event({
+                u"expert {0} key".format(expert): u"value {0}".format(index % 100),
+                u"asn": event.values(u"asn")
+            })
+            for expert in experts
+        ])
+
+    def run(flatten):
+        start = time.time()
+        for event, augmentations in zip(originals, augments):
+            for augment in augmentations:
+                event = event.union(augment)
+                if flatten:
+                    event._attrs
+            event.items()
+        return time.time() - start
+
+    copying = run(True)
+    layered = run(False)
+
+    print "{0} events, {1} experts".format(options.count, options.experts)
+    print "  copy on every union:  {0:.3f} seconds".format(copying)
+    print "  layered unions:       {0:.3f} seconds ({1:.1%})".format(layered, layered / copying)
+
+
+def _serialize(elements):
+    message = Element("message")
+    message.add(elements)
+    return message.serialize()
+
+
+@benchmark("body")
+def body(options):
+    """serialize events to stanzas with the full, truncated and no body"""
+
+    originals = list(events.Event(attrs) for attrs in feed_events(options.count))
+
+    print "{0} events".format(options.count)
+    results = []
+    for policy in [events.BODY_FULL, "3", events.BODY_NONE]:
+        keys = events.body_options(policy)
+
+        start = time.time()
+        size = 0
+        for event in originals:
+            size += len(_serialize(event.to_elements(**keys)))
+        results.append((policy, time.time() - start, size))
+
+    _, full_time, full_size = results[0]
+    for policy, elapsed, size in results:
+        print "  body={0:<6} {1:.3f} seconds ({2:.1%}), {3} bytes ({4:.1%})".format(
+            policy, elapsed, elapsed / full_time, size, float(size) / full_size)
+
+
+@benchmark("event-formats")
+def event_formats(options):
+    """encode and decode event batches in the legacy and compact formats"""
+
+    originals = list(events.Event(attrs) for attrs in feed_events(options.count))
+    batches = [
+        originals[i:i + options.batch_size]
+        for i in xrange(0, len(originals), options.batch_size)
+    ]
+
+    print "{0} events, {1} events per stanza".format(options.count, options.batch_size)
+    results = []
+    for name, compact in [(events.FORMAT_LEGACY, False), (events.FORMAT_COMPACT, True)]:
+        start = time.time()
+        messages = []
+        size = 0
+        for batch in batches:
+            message = Element("message")
+            message.add(events.batch_to_elements(batch, include_body=False, compact=compact))
+            size += len(message.serialize())
+            messages.append(message)
+        encoded = time.time() - start
+
+        start = time.time()
+        for message in messages:
+            for _ in events.Event.from_elements(message):
+                pass
+        decoded = time.time() - start
+        results.append((name, encoded, decoded, size))
+
+    _, legacy_encoded, legacy_decoded, legacy_size = results[0]
+    for name, encoded, decoded, size in results:
+        print "  {0:<7} encode {1:.3f} seconds ({2:.1%}), decode {3:.3f} seconds ({4:.1%}), {5} bytes ({6:.1%})".format(
+            name,
+            encoded, encoded / legacy_encoded,
+            decoded, decoded / legacy_decoded,
+            size, float(size) / legacy_size)
+
+
+@benchmark("fan-out")
+def fan_out(options):
+    """build stanzas for events sent to several rooms, with and without freezing the events first"""
+
+    originals = list(events.Event(attrs) for attrs in feed_events(options.count))
+
+    print "{0} events, {1} rooms per event".format(options.count, options.rooms)
+    results = []
+    for name, convert in [("event", events.Event), ("frozen", events.FrozenEvent)]:
+        start = time.time()
+        for event in originals:
+            event = convert(event)
+            for _ in xrange(options.rooms):
+                message = Element("message")
+                message.add(events.batch_to_elements([event]))
+        built = time.time() - start
+        results.append((name, built))
+
+    _, plain = results[0]
+    for name, built in results:
+        print "  {0:<6} {1:.3f} seconds ({2:.1%})".format(name, built, built / plain)
+
+
+@benchmark("parse-cache")
+def parse_cache(options):
+    """match IP and domain name atoms against events with and without parse caching"""
+
+    originals = [events.Event(attrs) for attrs in feed_events(options.count)]
+    patterns = [
+        atoms.IP(u"198.51.{0}.0/24".format(x)) for x in xrange(options.experts)
+    ] + [
+        atoms.DomainName(u"{0}.example".format(x)) for x in xrange(options.experts)
+    ]
+
+    def run():
+        start = time.time()
+        for event in originals:
+            for pattern in patterns:
+                for key in (u"ip", u"domain name"):
+                    for value in event.values(key):
+                        pattern.match(value)
+        return time.time() - start
+
+    caches = atoms._ip_ranges, atoms._domain_names
+    try:
+        atoms._ip_ranges = atoms._parse_ip_range
+        atoms._domain_names = atoms._domainname.parse_name
+        uncached = run()
+    finally:
+        atoms._ip_ranges, atoms._domain_names = caches
+    cached = run()
+
+    print "{0} events, {1} atoms".format(options.count, len(patterns))
+    print "  without caching:  {0:.3f} seconds".format(uncached)
+    print "  with caching:     {0:.3f} seconds ({1:.1%})".format(cached, cached / uncached)
+    for name, (hits, misses, size) in sorted(parsecache.stats().items()):
+        print "  {0!r}: {1} hits, {2} misses, {3} cached".format(name, hits, misses, size)
+
+
+def session_rules(count, seed=0):
+    """
+    Return a reproducible list of distinct rules resembling the ones
+    used by roomgraph sessions: each rule selects the events of one
+    constituency (an ASN or a netblock), often limited to some feeds or
+    types and sometimes excluding some countries.
+    """
+
+    rand = random.Random(seed)
+
+    result = []
+    for index in xrange(count):
+        if index % 2:
+            parts = [rules.Match(u"asn", unicode(64496 + index // 2))]
+        else:
+            ip = u"198.{0}.{1}.0/24".format(51 + index // 512, (index // 2) % 256)
+            parts = [rules.Match(u"ip", atoms.IP(ip))]
+
+        feed, type_, _ = rand.choice(_FEEDS)
+        if rand.random() < 0.5:
+            parts.append(rules.Match(u"feed", feed))
+        elif rand.random() < 0.5:
+            parts.append(rules.Match(u"type", type_))
+        if rand.random() < 0.2:
+            parts.append(rules.No(rules.Match(u"cc", rand.choice([u"FI", u"SE", u"NO"]))))
+        if rand.random() < 0.1:
+            parts = [rules.Or(rules.And(*parts), rules.Match(u"domain name", atoms.DomainName(u"*.example")))]
+        result.append(rules.And(*parts) if len(parts) > 1 else parts[0])
+    return result
+
+
+@benchmark("classifier")
+def classifier(options):
+    """classify events with roomgraph-like session rules"""
+
+    originals = [events.Event(attrs) for attrs in feed_events(options.count)]
+
+    indexed = rules.Classifier()
+    for index, rule in enumerate(session_rules(options.rules)):
+        indexed.inc(rule, index)
+
+    def linear(obj):
+        result = set()
+        cache = dict()
+        for rule, classes in indexed._rules.iteritems():
+            if result.issuperset(classes):
+                continue
+            if rule.match(obj, cache):
+                result.update(classes)
+        return result
+
+    timings = []
+    for classify in [linear, indexed.classify]:
+        start = time.time()
+        for event in originals:
+            classify(event)
+        timings.append(time.time() - start)
+
+    linear_time, indexed_time = timings
+    print "{0} events, {1} rules".format(options.count, options.rules)
+    print "  linear scan:  {0:.3f} seconds".format(linear_time)
+    print "  indexed:      {0:.3f} seconds ({1:.1%})".format(indexed_time, indexed_time / linear_time)
+
+
+@benchmark("classify-cache")
+def classify_cache(options):
+    """classify re-sent events in a roomgraph worker with and without the result cache"""
+
+    from abusehelper.core import roomgraph
+
+    # Polled feeds re-send most of their events: replay each event three
+    # times, a poll interval apart.
+    unique = [events.Event(attrs) for attrs in feed_events(options.count // 3)]
+    poll = 1000
+    originals = []
+    for index in xrange(0, len(unique), poll):
+        originals.extend(unique[index:index + poll] * 3)
+
+    indexed = rules.Classifier()
+    for index, rule in enumerate(session_rules(options.rules)):
+        indexed.inc(rule, index)
+
+    print "{0} events ({1} unique), {2} rules".format(len(originals), len(unique), options.rules)
+    results = []
+    for name, cache in [("uncached", None), ("cached", roomgraph._MatchCache())]:
+        start = time.time()
+        for event in originals:
+            roomgraph._classify(indexed, cache, u"src@rooms.example", event)
+        results.append((name, time.time() - start))
+
+    _, uncached = results[0]
+    for name, elapsed in results:
+        print "  {0:<8} {1:.3f} seconds ({2:.1%})".format(name, elapsed, elapsed / uncached)
+
+
+@benchmark("compiler")
+def compile_rules(options):
+    """match roomgraph-like session rules with Rule.match and compiled rules"""
+
+    originals = [events.Event(attrs) for attrs in feed_events(options.count)]
+    session = session_rules(options.rules)
+
+    start = time.time()
+    compiled = [compiler.compile(rule) for rule in session]
+    compile_time = time.time() - start
+
+    start = time.time()
+    for event in originals:
+        cache = dict()
+        for rule in session:
+            rule.match(event, cache)
+    interpreted = time.time() - start
+
+    start = time.time()
+    for event in originals:
+        for match in compiled:
+            match(event)
+    elapsed = time.time() - start
+
+    print "{0} events, {1} rules".format(options.count, options.rules)
+    print "  compiling:  {0:.3f} seconds".format(compile_time)
+    print "  Rule.match: {0:.3f} seconds".format(interpreted)
+    print "  compiled:   {0:.3f} seconds ({1:.1%})".format(elapsed, elapsed / interpreted)
+
+
+def _compare_matching(originals, session):
+    def run(match):
+        start = time.time()
+        for event in originals:
+            for index, rule in enumerate(session):
+                match(index, rule, event)
+        return time.time() - start
+
+    interpreted = run(lambda index, rule, event: rule.match(event))
+
+    compiled = [compiler.compile(rule) for rule in session]
+    compiled_time = run(lambda index, rule, event: compiled[index](event))
+
+    indexed = rules.Classifier()
+    for index, rule in enumerate(session):
+        indexed.inc(rule, index)
+    start = time.time()
+    for event in originals:
+        indexed.classify(event)
+    indexed_time = time.time() - start
+
+    print "  Rule.match:          {0:.3f} seconds".format(interpreted)
+    print "  compiled:            {0:.3f} seconds ({1:.1%})".format(compiled_time, compiled_time / interpreted)
+    print "  indexed classifier:  {0:.3f} seconds ({1:.1%})".format(indexed_time, indexed_time / interpreted)
+
+
+@benchmark("ip-rules")
+def ip_rules(options):
+    """classify events with rules matching each a number of netblocks"""
+
+    rand = random.Random(0)
+    originals = [events.Event(attrs) for attrs in feed_events(options.count)]
+
+    session = []
+    for _ in xrange(options.rules):
+        netblocks = set()
+        while len(netblocks) < 20:
+            netblocks.add(u"198.{0}.{1}.0/24".format(rand.randint(50, 52), rand.randint(0, 255)))
+        session.append(rules.Or(*[rules.Match(u"ip", atoms.IP(x)) for x in netblocks]))
+
+    print "{0} events, {1} rules with 20 netblocks each".format(options.count, options.rules)
+    _compare_matching(originals, session)
+
+
+@benchmark("domain-rules")
+def domain_rules(options):
+    """classify events with rules matching each a number of domain name patterns"""
+
+    rand = random.Random(0)
+    originals = [events.Event(attrs) for attrs in feed_events(options.count)]
+
+    session = []
+    for _ in xrange(options.rules):
+        patterns = set()
+        while len(patterns) < 20:
+            patterns.add(u"{0}{1}.example".format(rand.choice([u"", u"*."]), rand.randint(0, 1000)))
+        session.append(rules.Or(*[rules.Match(u"domain name", atoms.DomainName(x)) for x in patterns]))
+
+    print "{0} events, {1} rules with 20 domain name patterns each".format(options.count, options.rules)
+    _compare_matching(originals, session)
+
+
+@benchmark("fuzzy-rules")
+def fuzzy_rules(options):
+    """classify events with rules matching each a number of fuzzy strings and regexps"""
+
+    rand = random.Random(0)
+    originals = [events.Event(attrs) for attrs in feed_events(options.count)]
+
+    session = []
+    for _ in xrange(options.rules):
+        subrules = set()
+        while len(subrules) < 20:
+            if rand.random() < 0.8:
+                atom = atoms.String(u"login/{0}".format(rand.randint(0, 10 ** 6)))
+            else:
+                atom = atoms.RegExp(u"^{0}[0-9]+\\.example$".format(rand.randint(0, 100)))
+            subrules.add(rules.Fuzzy(atom))
+        session.append(rules.Or(*subrules))
+
+    print "{0} events, {1} rules with 20 fuzzy matches each".format(options.count, options.rules)
+    _compare_matching(originals, session)
+
+
+@benchmark("ip-set")
+def ip_set(options):
+    """match events against 100000 netblocks as IP rules and as a file-backed IPSet"""
+
+    rand = random.Random(0)
+    originals = [events.Event(attrs) for attrs in feed_events(options.count)]
+
+    netblocks = set()
+    while len(netblocks) < 100000:
+        netblocks.add(u"{0}.{1}.{2}.0/24".format(rand.choice([10, 198]), rand.randint(0, 255), rand.randint(0, 255)))
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "netblocks.txt")
+    try:
+        with open(path, "wb") as netblock_file:
+            netblock_file.write("\n".join(netblocks).encode("ascii"))
+
+        ip_rule = rules.Or(*[rules.Match(u"ip", atoms.IP(x)) for x in netblocks])
+        ipset_rule = rules.Match(u"ip", atoms.IPSet(path))
+
+        for name, rule in [("IP rules:", ip_rule), ("IPSet:", ipset_rule)]:
+            start = time.time()
+            match = compiler.compile(rule)
+            match(events.Event(ip=u"192.0.2.0"))
+            setup = time.time() - start
+
+            start = time.time()
+            for event in originals:
+                match(event)
+            elapsed = time.time() - start
+
+            pickled = len(pickle.dumps(rule, pickle.HIGHEST_PROTOCOL))
+            print "{0:<10} setup {1:.3f} seconds, matching {2:.3f} seconds, pickled {3} bytes".format(
+                name, setup, elapsed, pickled)
+    finally:
+        _ipset.remove_tables(path)
+        shutil.rmtree(directory)
+
+
+def _start_roomgraph_workers(count):
+    # Fork worker processes running roomgraph.roomgraph(), like the ones
+    # RoomGraphBot starts, and return the parent ends of their sockets.
+
+    from abusehelper.core import roomgraph
+
+    conns = []
+    for _ in xrange(count):
+        own_conn, other_conn = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        if os.fork() == 0:
+            own_conn.close()
+            for conn in conns:
+                conn.close()
+            try:
+                roomgraph.roomgraph(other_conn)
+            except roomgraph._ConnectionLost:
+                pass
+            finally:
+                os._exit(0)
+        other_conn.close()
+        conns.append(own_conn)
+    return conns
+
+
+def _replay(originals, session, workers, batch_size):
+    from abusehelper.core import roomgraph
+
+    src = u"src@rooms.example"
+    conns = _start_roomgraph_workers(workers)
+    for index, rule in enumerate(session):
+        for conn in conns:
+            roomgraph.send_encoded(conn, ("inc_rule", (src, rule, index)))
+
+    matched = []
+
+    def collect(conn):
+        count = 0
+        try:
+            while True:
+                type_id, args = roomgraph.recv_decoded(conn)
+                if type_id == "matches":
+                    count += len(args[3])
+        except roomgraph._ConnectionLost:
+            matched.append(count)
+
+    threads = [threading.Thread(target=collect, args=(conn,)) for conn in conns]
+    for thread in threads:
+        thread.start()
+
+    start = time.time()
+    for index in xrange(0, len(originals), batch_size):
+        batch = [(src, event) for event in originals[index:index + batch_size]]
+        roomgraph.send_encoded(conns[(index // batch_size) % len(conns)], ("events", (index, batch)))
+    for conn in conns:
+        conn.shutdown(socket.SHUT_WR)
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    for conn in conns:
+        conn.close()
+    for _ in conns:
+        os.wait()
+    return elapsed, sum(matched)
+
+
+@benchmark("roomgraph-ipc")
+def roomgraph_ipc(options):
+    """replay events through roomgraph worker processes one by one and in batches"""
+
+    originals = [events.Event(attrs) for attrs in feed_events(options.count)]
+    session = session_rules(options.rules)
+
+    print "{0} events, {1} rules, {2} workers".format(options.count, options.rules, options.workers)
+    unbatched, matched = _replay(originals, session, options.workers, 1)
+    print "  one event per message:  {0:.3f} seconds ({1:.0f} events/s), {2} matched".format(
+        unbatched, options.count / unbatched, matched)
+
+    batched, matched = _replay(originals, session, options.workers, options.batch_size)
+    print "  {0} events per message: {1:.3f} seconds ({2:.0f} events/s, {3:.1%}), {4} matched".format(
+        options.batch_size, batched, options.count / batched, batched / unbatched, matched)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.set_usage("Usage: %prog [options] BENCHMARK")
+    parser.add_option(
+        "--count", type="int", default=100000,
+        help="the number of events to use (default: %default)")
+    parser.add_option(
+        "--rules", type="int", default=500,
+        help="the number of classifier rules (default: %default)")
+    parser.add_option(
+        "--batch-size", type="int", default=10,
+        help="the number of events per stanza (default: %default)")
+    parser.add_option(
+        "--experts", type="int", default=8,
+        help="the number of augmenting experts (default: %default)")
+    parser.add_option(
+        "--rooms", type="int", default=20,
+        help="the number of destination rooms per event (default: %default)")
+    parser.add_option(
+        "--workers", type="int", default=2,
+        help="the number of roomgraph worker processes (default: %default)")
+
+    descriptions = ["", "Available benchmarks:"]
+    for name, func in _benchmarks:
+        descriptions.append("  {0:<20} {1}".format(name, func.__doc__))
+    parser.epilog = "\n".join(descriptions)
+    parser.format_epilog = lambda formatter: parser.epilog + "\n"
+
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("expected exactly one benchmark name")
+
+    for name, func in _benchmarks:
+        if name == args[0]:
+            return func(options)
+    parser.error("unknown benchmark " + repr(args[0]))
+
+
+if __name__ == "__main__":
+    main()